@@ -1,48 +1,2621 @@
 import os
 import pathlib
-from flask import Flask, render_template, request, jsonify, session, send_from_directory, abort
+from flask import Flask, render_template, request, jsonify, session, send_from_directory, abort, g, Response
 from werkzeug.utils import secure_filename
 import time
 import uuid
+import hashlib
+import math
 import io
 import tempfile
 import base64
 from PIL import Image
 from dotenv import load_dotenv
 import json
+import re
+import random
+import bisect
+import threading
+import queue
+import zlib
+from array import array
+import contextlib
+import contextvars
+import copy
+import functools
 import traceback
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
+from datetime import datetime, timedelta, timezone
 from supabase import create_client, Client
 from flask_cors import CORS  # CORS için
 
 # PDF işleme için
-from PyPDF2 import PdfReader
 import fitz  # PyMuPDF - PDF görüntüleme ve resim çıkarma için
+import gzip
+
+try:
+    import brotli  # İsteğe bağlı; yüklüyse 'br' sıkıştırması kullanılır
+except ImportError:
+    brotli = None
 
 # Google Gemini AI için
 import google.generativeai as genai
 from google.generativeai.types import content_types, generation_types
+from google.api_core import exceptions as google_exceptions
+
+# .env dosyasını yükle
+load_dotenv()
+
+# Supabase istemcisini başlat
+supabase_url = os.environ.get("SUPABASE_URL")
+supabase_key = os.environ.get("SUPABASE_SERVICE_KEY", os.environ.get("SUPABASE_KEY"))
+supabase: Client = create_client(supabase_url, supabase_key)
+
+# Konfigürasyon
+ALLOWED_EXTENSIONS = {'pdf'}
+ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+UPLOAD_FOLDER = 'uploads'  # Geçici yükleme işlemleri için
+
+# pdfs tablosuna toplu kayıt: tek sorguda aranan/eklenen dosya adı sayısı
+PDF_RECORD_CHUNK = 100
+
+# Toplu soru-cevap ayarları
+BATCH_MAX_QUESTIONS = 50  # Tek istekte kabul edilen en fazla soru
+BATCH_PACK_SIZE = int(os.environ.get("BATCH_PACK_SIZE", 10))  # Bir model çağrısına giden soru sayısı
+BATCH_MAX_PARALLEL_PACKS = int(os.environ.get("BATCH_MAX_PARALLEL_PACKS", 3))  # Aynı anda çalışan paket sayısı
+
+# Model çağrı ayarları
+MODEL_CALL_TIMEOUT = float(os.environ.get("MODEL_CALL_TIMEOUT", 90))  # Tek bir denemenin en uzun süresi (saniye)
+MODEL_MAX_RETRIES = int(os.environ.get("MODEL_MAX_RETRIES", 3))  # Geçici hatalarda yeniden deneme sayısı
+MODEL_BACKOFF_BASE = float(os.environ.get("MODEL_BACKOFF_BASE", 0.5))  # İlk bekleme süresi (saniye)
+MODEL_BACKOFF_MAX = float(os.environ.get("MODEL_BACKOFF_MAX", 8))  # En uzun bekleme süresi (saniye)
+MODEL_HEDGE_PERCENTILE = float(os.environ.get("MODEL_HEDGE_PERCENTILE", 0))  # Örn. 95; 0 ise hedge kapalı
+MODEL_HEDGE_MIN_SAMPLES = 20  # Hedge gecikmesini hesaplamak için gereken en az örnek
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", 120))  # Bir isteğin model çağrıları için toplam süre
+
+# Model yönlendirme: her çağrının model katmanı ve çıktı sınırı moda, soru uzunluğuna, bağlam boyutuna
+# ve gözlenen gecikmeye göre seçilir. Katmanlar hızlıdan güçlüye sıralıdır; yedek hep daha hızlı katmana iner.
+MODEL_PROFILES = json.loads(os.environ.get("MODEL_PROFILES") or "null") or {
+    "fast": {"model": "gemini-1.5-flash-8b", "max_context_tokens": 1000000},
+    "standard": {"model": "gemini-1.5-flash", "max_context_tokens": 1000000},
+}
+MODEL_DEFAULT_TIER = os.environ.get("MODEL_DEFAULT_TIER", "standard")  # Sohbet oturumu ve önbellek anahtarları bu katmanın modeliyle
+MODEL_ROUTES = {
+    # mod: (katman, en fazla çıktı tokenı)
+    "chat": ("standard", 2048),
+    "chat_short": ("fast", 1024),  # Küçük bağlamlı kısa sorular
+    "chat_image": ("standard", 2048),
+    "batch": ("standard", 8192),
+    "multi": ("standard", 2048),
+    "overview": ("fast", 512),
+    "quiz": ("standard", 8192),
+    "quiz_bank": ("standard", 8192),
+    "summary": ("standard", 8192),
+    "summary_section": ("standard", 1024),
+    "summary_combine": ("standard", 8192),
+    "concepts": ("standard", 4096),
+}
+MODEL_ROUTES.update({mode: tuple(route) for mode, route in json.loads(os.environ.get("MODEL_ROUTES") or "{}").items()})
+ROUTE_SHORT_QUESTION_CHARS = 160  # Bundan kısa sorular kısa sayılır
+ROUTE_SHORT_CONTEXT_TOKENS = 32000  # Kısa soru hızlı katmana ancak bağlam bundan küçükse gider
+ROUTE_LATENCY_PERCENTILE = 90  # Son zamana yetişip yetişmeyeceği bu gecikme yüzdeliğiyle tahmin edilir
+ROUTE_LATENCY_MIN_SAMPLES = 5
+ROUTE_PRIMARY_RETRIES = 1  # Yedek katman varken seçilen katmanda yapılan yeniden deneme
+
+# Kabul kontrolü (admission control): model çağrıları öncelik şeritlerinde sıraya girer
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", 16))  # Aynı anda çalışan toplam model çağrısı
+ADMISSION_LANES = {
+    # şerit: öncelik (küçük olan önce), eşzamanlılık sınırı, en uzun bekleme (saniye),
+    # ayrılmış slot (toplamdan yalnızca bu şeridin kullanabileceği kısım)
+    "interactive": {"priority": 0, "limit": 12, "max_wait": 10.0, "reserved": 4},
+    "generation": {"priority": 1, "limit": 6, "max_wait": 5.0},
+    "ingestion": {"priority": 2, "limit": 4, "max_wait": 2.0},
+    "speculative": {"priority": 3, "limit": 2, "max_wait": 1.0},  # Kimsenin beklemediği ön hazırlık
+}
+for _lane, _settings in json.loads(os.environ.get("ADMISSION_LANES", "{}")).items():  # Örn. '{"generation": {"limit": 2}}'
+    ADMISSION_LANES.setdefault(_lane, {"priority": 1, "limit": 4, "max_wait": 5.0}).update(_settings)
+
+# Bağlam (context) bütçesi ayarları - token değerleri tahminidir
+CONTEXT_TOKEN_BUDGETS = {
+    "chat": 100000,
+    "batch": 150000,
+    "quiz": 150000,
+    "summary": 300000,
+    "concepts": 200000,
+    "overview": 60000,
+    "summary_chunk": 60000,
+    "multi": 60000,
+}
+CONTEXT_TOKEN_BUDGETS.update(json.loads(os.environ.get("CONTEXT_TOKEN_BUDGETS", "{}")))  # Örn. '{"chat": 50000}'
+OUTPUT_TOKEN_RESERVE = 8192  # Cevap için ayrılan token (max_output_tokens)
+CONTEXT_HISTORY_RESERVE = int(os.environ.get("CONTEXT_HISTORY_RESERVE", 16000))  # Sohbet geçmişi için en az ayrılan token
+PDF_PAGE_TOKENS = 258  # Model her PDF sayfasını bir görüntü olarak sayar
+CHARS_PER_TOKEN = 4  # Metin için yaklaşık karakter/token oranı
+API_PAYLOAD_MAX_MB = float(os.environ.get("API_PAYLOAD_MAX_MB", 10))  # Satır içi PDF verisi için üst sınır
+PAGE_COST_CACHE_SIZE = 256  # Sayfa maliyetleri saklanan belge sürümü sayısı
+SUBDOCUMENT_CACHE_MB = int(os.environ.get("SUBDOCUMENT_CACHE_MB", 256))  # Kesilmiş PDF önbelleği
+
+# Belge türevleri (metin, indeks) önbelleği ve çoklu belge ayarları
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "pdf_assistant_artifacts"))
+DOCUMENT_CACHE_SIZE = int(os.environ.get("DOCUMENT_CACHE_SIZE", 64))  # Bellekte tutulan belge sayısı
+DOCUMENT_REVALIDATE_SECONDS = int(os.environ.get("DOCUMENT_REVALIDATE_SECONDS", 300))  # Storage ile tazelik kontrolü aralığı
+MULTI_MAX_DOCUMENTS = int(os.environ.get("MULTI_MAX_DOCUMENTS", 10))  # Tek soruda en fazla belge
+PASSAGE_CHARS = 1200  # Bir pasajın yaklaşık uzunluğu
+PAGE_PASSAGE_CACHE_SIZE = int(os.environ.get("PAGE_PASSAGE_CACHE_SIZE", 20000))  # İndekslenmiş sayfa sayısı
+GENERATION_CACHE_SIZE = int(os.environ.get("GENERATION_CACHE_SIZE", 256))  # Bellekte tutulan özet/kavram sayısı
+SUMMARY_MAX_PARALLEL = int(os.environ.get("SUMMARY_MAX_PARALLEL", 4))  # Aynı anda özetlenen bölüm sayısı
+SUMMARY_REDUCE_FANIN = 8  # Bir birleştirme çağrısına giren özet sayısı
+QUIZ_BANK_ENABLED = os.environ.get("QUIZ_BANK_ENABLED", "1") == "1"  # Quizler hazır soru havuzundan seçilir
+QUIZ_BANK_CHUNK_PAGES = int(os.environ.get("QUIZ_BANK_CHUNK_PAGES", 20))  # Bir model çağrısının soru ürettiği sayfa sayısı
+QUIZ_BANK_QUESTIONS_PER_CHUNK = int(os.environ.get("QUIZ_BANK_QUESTIONS_PER_CHUNK", 10))
+QUIZ_BANK_PARALLEL = 3  # Aynı anda üretilen bölüm sayısı
+QUIZ_BANK_CACHE_SIZE = 64  # Bellekte tutulan soru havuzu (belge sürümü) sayısı
+QUIZ_BANK_BUILDERS = 2  # Arka planda aynı anda oluşturulan soru havuzu sayısı
+STREAMING_INGEST_MIN_MB = int(os.environ.get("STREAMING_INGEST_MIN_MB", 32))  # Bu boyuttan büyük PDF'ler sayfa sayfa işlenir
+INGEST_MEMORY_CEILING_MB = int(os.environ.get("INGEST_MEMORY_CEILING_MB", 16))  # Yazılmayı bekleyen sayfa verisi sınırı
+PAGE_TEXT_CACHE_PAGES = 64  # Sayfa sayfa saklanan metinlerden bellekte tutulan sayfa sayısı
+PAGE_TEXT_BLOCK_PAGES = int(os.environ.get("PAGE_TEXT_BLOCK_PAGES", 4))  # Bellekte birlikte sıkıştırılan sayfa sayısı
+PAGE_TEXT_COMPRESSION_LEVEL = 6
+LOAD_ALLOCATION_BUDGET = 0.5  # Bir PDF yüklemesinin indirilen dosya dışındaki bellek ayırma sınırı (PDF boyutunun katı)
+
+# Bellek profili (tracemalloc): açıkken her aşama ve route için bellek tepe değerleri ve ayırma noktaları tutulur
+MEMORY_PROFILING = os.environ.get("MEMORY_PROFILING", "0") == "1"  # /admin/memory ile çalışırken de açılıp kapatılabilir
+MEMORY_PROFILING_FRAMES = int(os.environ.get("MEMORY_PROFILING_FRAMES", 10))  # Ayırma başına saklanan çağrı çerçevesi
+MEMORY_PROFILING_TOP = 10  # Raporlanan en büyük ayırma noktası sayısı
+MEMORY_PROFILING_SITE_EVERY = int(os.environ.get("MEMORY_PROFILING_SITE_EVERY", 20))  # Ayırma noktaları her N çalışmada bir ölçülür (snapshot pahalı)
+MEMORY_PROFILING_MAX_SNAPSHOTS = 8  # /admin/memory'nin sakladığı snapshot sayısı
+
+# Sayfa önizleme (render) ayarları
+PDF_CACHE_MB = int(os.environ.get("PDF_CACHE_MB", 256))  # Render için bellekte tutulan PDF dosyaları
+RENDER_CACHE_MB = int(os.environ.get("RENDER_CACHE_MB", 128))  # Bellekteki render önbelleği
+RENDER_ZOOM_MIN = 0.25
+RENDER_ZOOM_MAX = 4.0
+RENDER_ZOOM_STEP = 0.25  # Zoom bu adıma yuvarlanır, önbellek anahtarları sınırlı kalır
+RENDER_FORMATS = {"png": "image/png", "jpeg": "image/jpeg"}
+RENDER_JPEG_QUALITY = 85
+RENDER_PRERENDER_PAGES = int(os.environ.get("RENDER_PRERENDER_PAGES", 3))  # Yüklemede önceden render edilen sayfa sayısı
+RENDER_PRERENDER_ZOOM = 0.5  # Küçük resim (thumbnail) zoom değeri
+
+# Soruya göre görsel seçimi: görsel ağırlıklı PDF'lerde sadece ilgili şekiller gönderilir
+IMAGE_CONTEXT_MIN_SHARE = float(os.environ.get("IMAGE_CONTEXT_MIN_SHARE", 0.5))  # Görsellerin PDF boyutundaki payı bundan büyükse
+IMAGE_CONTEXT_MAX_IMAGES = int(os.environ.get("IMAGE_CONTEXT_MAX_IMAGES", 3))  # Soru başına eklenen en fazla görsel
+IMAGE_CONTEXT_MIN_SCORE = 0.5  # Bu puanın altındaki görseller eklenmez
+IMAGE_CONTEXT_MAX_SIDE = 768  # Eklenen görsellerin en uzun kenarı (piksel)
+IMAGE_CONTEXT_SEARCH_TOKENS = 2000  # Sayfa ilgisini ölçmek için aranan pasaj bütçesi
+IMAGE_CAPTION_DISTANCE = 36  # Görselin altında/üstünde başlık aranan mesafe (pt)
+IMAGE_CAPTION_CHARS = 300
+IMAGE_DECORATIVE_PAGES = 3  # Aynı görsel bu kadar sayfada varsa süs (logo, arka plan) sayılır
+IMAGE_MIN_SIDE = 32  # Bundan küçük görseller süs sayılır
+
+# Yük (payload) seçimi: metin ağırlıklı PDF'ler modele PDF yerine sayfa metinleriyle gönderilir
+PAYLOAD_TEXT_FIRST = os.environ.get("PAYLOAD_TEXT_FIRST", "1") == "1"
+PAYLOAD_TEXT_MAX_IMAGE_SHARE = float(os.environ.get("PAYLOAD_TEXT_MAX_IMAGE_SHARE", 0.1))  # Görsellerin PDF boyutundaki payı en fazla bu kadarsa belge metin ağırlıklıdır
+PAYLOAD_TEXT_MIN_QUALITY = 0.98  # Okunabilir karakter oranı bundan düşükse (bozuk font eşlemesi) PDF gönderilir
+PAYLOAD_WEAK_PAGE_CHARS = 40  # Görseli olup bundan az metni olan sayfa taranmış sayılır
+PAYLOAD_SCANNED_PAGE_SHARE = 0.5  # Sayfaların en az bu kadarı taranmışsa belge taranmış (scanned) sayılır
+PAYLOAD_PAGE_MARKER_TOKENS = 8  # "--- Page N ---" işaretinin tahmini token maliyeti
+
+# Yanıt sıkıştırma ayarları
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))  # Bundan küçük yanıtlar sıkıştırılmaz
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+# Koşullu GET (ETag, 304) yalnızca statik ve içerikle adreslenen yanıtlarda; canlı ve yan etkili uçlar her istekte çalışır
+CONDITIONAL_GET_ENDPOINTS = {"static", "serve_image", "page_image"}
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/javascript",
+    "application/javascript", "application/json", "image/svg+xml"
+}
+STATIC_COMPRESSION_CACHE_SIZE = 64  # Sıkıştırılmış statik dosya sayısı
+
+# Önbellek ısıtma (warm-up): popüler PDF'ler ilk kullanıcıdan önce işlenir
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") == "1"
+WARMUP_INTERVAL_SECONDS = int(os.environ.get("WARMUP_INTERVAL_SECONDS", 0))  # 0 ise zamanlayıcı kapalı
+WARMUP_TOP_DOCUMENTS = int(os.environ.get("WARMUP_TOP_DOCUMENTS", 10))  # Isıtılan en fazla belge
+WARMUP_LOOKBACK_DAYS = int(os.environ.get("WARMUP_LOOKBACK_DAYS", 7))  # Sıralamada bakılan aktivite süresi
+WARMUP_HALF_LIFE_HOURS = 24  # Bir aktivitenin ağırlığı bu sürede yarıya iner
+WARMUP_ACTIVITY_ROWS = 5000  # Tablo başına okunan en fazla aktivite kaydı
+WARMUP_ACTIVITY_WEIGHTS = {"qa_sessions": 1.0, "generated_content": 2.0}  # Üretimler daha pahalı, daha ağır sayılır
+WARMUP_TIME_BUDGET_SECONDS = float(os.environ.get("WARMUP_TIME_BUDGET_SECONDS", 60))
+WARMUP_MEMORY_BUDGET_MB = int(os.environ.get("WARMUP_MEMORY_BUDGET_MB", 256))  # Isıtmanın belleğe eklediği en fazla veri
+
+# Oturum başına asistan havuzu: sohbet, turlar arasında yüklü PDF ve sohbet oturumuyla bellekte kalır
+ASSISTANT_POOL_MAX = int(os.environ.get("ASSISTANT_POOL_MAX", 64))  # Bellekte tutulan en fazla sohbet (oturum, belge)
+ASSISTANT_IDLE_SECONDS = int(os.environ.get("ASSISTANT_IDLE_SECONDS", 1800))  # Bu süre kullanılmayan sohbet bırakılır
+ASSISTANT_WAIT_SECONDS = 30  # Aynı sohbetin önceki isteğinin bitmesini bekleme süresi
+
+# Spekülatif ön hazırlık: PDF seçilince, kullanıcı okuyup yazarken belge yüklenir ve en çok istenen üretim hazırlanır
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_TIME_BUDGET_SECONDS = float(os.environ.get("PREFETCH_TIME_BUDGET_SECONDS", 90))  # Ön hazırlığın model çağrıları için süre
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 2))
+PREFETCH_GENERATIONS = ("summary", "key_concepts")  # Geçmişe göre aralarından biri hazırlanır (eşitlikte ilki)
+PREFETCH_SUMMARY_DETAIL = "medium"  # /chat'in varsayılan özet ayrıntısı
+PREFETCH_HISTORY_ROWS = 500  # Tercih için okunan en fazla üretim kaydı
+PREFETCH_JOIN_SECONDS = 30  # Hazırlanmakta olan üretimi isteyen kullanıcının bekleme süresi
+
+# Yanıtın beklemediği kayıt işleri (resim yükleme, soru-cevap ve içerik kayıtları)
+BOOKKEEPING_WORKERS = int(os.environ.get("BOOKKEEPING_WORKERS", 4))
+
+SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_NONE"
+    }
+]
+
+app = Flask(__name__)
+CORS(app)  # CORS desteği ekle
+app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'gizli-anahtar-burada')
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024  # 64 MB max upload olarak artırıldı
+app.config['SESSION_TYPE'] = 'filesystem'
+app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # Session ömrü (saniye)
+app.config['JSON_AS_ASCII'] = False  # UTF-8 karakter desteği
+
+class Metrics:
+    """
+    Minimal thread-safe metrics registry (counters, gauges and histograms with
+    labels) rendered in the Prometheus text exposition format.
+
+    Recording is a dictionary update under a lock; the text output is only
+    built when /metrics is scraped.
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}  # name -> (type, help, buckets)
+        self._values = {}  # name -> {label tuple: value or [bucket counts, sum, count]}
+        self._collectors = []
+
+    def describe(self, name: str, metric_type: str, help_text: str, buckets: tuple = None):
+        """Registers a metric family ('counter', 'gauge' or 'histogram')"""
+        with self._lock:
+            self._families[name] = (metric_type, help_text, tuple(buckets or self.DEFAULT_BUCKETS))
+            self._values.setdefault(name, {})
+
+    def add_collector(self, collector):
+        """Registers a function called at scrape time that returns extra exposition lines"""
+        self._collectors.append(collector)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self._families.get(name, (None, None, self.DEFAULT_BUCKETS))[2]
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def cache(self, cache_name: str, hit: bool):
+        """Counts a cache lookup"""
+        self.inc("pdf_assistant_cache_requests_total", cache=cache_name, result="hit" if hit else "miss")
+
+    @contextlib.contextmanager
+    def span(self, stage: str):
+        """Times a pipeline stage into pdf_assistant_stage_seconds (and profiles its memory, see MemoryProfiler)"""
+        started = time.perf_counter()
+        with memory_profiler.track("stage", stage):
+            try:
+                yield
+            finally:
+                self.observe("pdf_assistant_stage_seconds", time.perf_counter() - started, stage=stage)
+
+    def timed(self, stage: str):
+        """Decorator form of `span`"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        pairs = (
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in labels
+        )
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text format (version 0.0.4)"""
+        with self._lock:
+            families = dict(self._families)
+            values = {
+                name: {key: ([list(v[0]), v[1], v[2]] if isinstance(v, list) else v) for key, v in series.items()}
+                for name, series in self._values.items()
+            }
+
+        lines = []
+        for name, series in values.items():
+            metric_type, help_text, buckets = families.get(name, ("untyped", "", self.DEFAULT_BUCKETS))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for key, value in series.items():
+                if metric_type != "histogram":
+                    lines.append(f"{name}{self._format_labels(key)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{self._format_labels(key + (('le', f'{bound:g}'),))} {bucket_count}")
+                lines.append(f"{name}_bucket{self._format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._format_labels(key)} {total}")
+                lines.append(f"{name}_count{self._format_labels(key)} {count}")
+
+        for collector in self._collectors:
+            try:
+                lines.extend(collector())
+            except Exception as e:
+                print(f"Metrics collector error: {str(e)}")
+
+        return "\n".join(lines) + "\n"
+
+# Uygulama genelindeki metrikler
+metrics = Metrics()
+metrics.describe("pdf_assistant_request_seconds", "histogram", "HTTP request latency by route, mode and status.")
+metrics.describe("pdf_assistant_requests_in_flight", "gauge", "HTTP requests currently being processed, by route.")
+metrics.describe("pdf_assistant_stage_seconds", "histogram", "Latency of PDF pipeline stages.")
+metrics.describe("pdf_assistant_cache_requests_total", "counter", "Cache lookups by cache and result.")
+metrics.describe("pdf_assistant_model_call_seconds", "histogram", "Latency of single model call attempts by model and kind.")
+metrics.describe("pdf_assistant_admission_wait_seconds", "histogram", "Time model calls waited for an admission slot, by lane.")
+metrics.describe("pdf_assistant_context_images_total", "counter", "PDF images attached to questions about figure-heavy documents.")
+metrics.describe("pdf_assistant_context_image_bytes_total", "counter", "Image bytes attached to questions (sent) or left out of the PDF (skipped).")
+metrics.describe("pdf_assistant_bookkeeping_errors_total", "counter", "Background record writes that failed, by task.")
+metrics.describe("pdf_assistant_payloads_total", "counter", "Document payloads sent to the model, by payload (pdf or text) and reason.")
+metrics.describe("pdf_assistant_payload_saved_bytes_total", "counter", "Bytes saved by sending page texts instead of the PDF.")
+metrics.describe("pdf_assistant_payload_saved_tokens_total", "counter", "Estimated tokens saved by sending page texts instead of the PDF.")
+
+class MemoryProfiler:
+    """
+    Opt-in tracemalloc instrumentation of pipeline stages, routes and
+    ingestion stages.
+
+    While enabled, every tracked block records the traced memory it kept
+    (allocated minus freed) and the traced peak above its starting point.
+    The first run of a block and every MEMORY_PROFILING_SITE_EVERY-th run
+    after it also diff snapshots taken around the block; the top allocation
+    sites of the sampled run with the largest peak are kept. Named snapshots
+    can be taken and diffed (see /admin/memory).
+
+    tracemalloc has a single process-wide peak, so peaks of nested stages
+    and concurrent requests overlap and are upper bounds. Attribute memory
+    on a worker with little concurrency.
+
+    Starting and stopping, and every tracing check with the snapshot or
+    reading that depends on it, happen under the lock, so stopping never
+    races a snapshot. A block that outlives its tracing session is counted
+    but records no memory.
+    """
+
+    def __init__(self, frames: int = MEMORY_PROFILING_FRAMES, top: int = MEMORY_PROFILING_TOP,
+                 site_every: int = MEMORY_PROFILING_SITE_EVERY, max_snapshots: int = MEMORY_PROFILING_MAX_SNAPSHOTS):
+        self.frames = frames
+        self.top = top
+        self.site_every = max(1, site_every)
+        self.max_snapshots = max_snapshots
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._active = 0
+        self._session = 0  # tracemalloc sessions started by start()
+        self._stats = {}  # (kind, name) -> counters and top sites
+        self._snapshots = {}  # id -> snapshot entry; insertion order is oldest first
+
+    def start(self):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self._session += 1
+            self.enabled = True
+
+    def stop(self):
+        """Stops tracing; collected statistics and snapshots are kept"""
+        with self._lock:
+            self.enabled = False
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._snapshots = {}
+
+    def _take_snapshot(self):
+        """Call with the lock held and tracing checked"""
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def _top_sites(self, snapshot, base, key_type: str = "lineno", limit: int = None) -> list:
+        """Allocation sites that grew most from `base` to `snapshot`"""
+        sites = []
+        for stat in snapshot.compare_to(base, key_type):
+            if stat.size_diff <= 0:
+                continue
+            sites.append({
+                "site": str(stat.traceback[0]) if key_type != "traceback" else stat.traceback.format(),
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff,
+                "size": stat.size,
+            })
+            if len(sites) >= (limit or self.top):
+                break
+        return sites
+
+    @contextlib.contextmanager
+    def track(self, kind: str, name: str):
+        """Records the memory of the block under `kind` ('stage', 'route' or 'ingest') and `name`"""
+        if not self.enabled:
+            yield
+            return
+        with self._lock:
+            tracing = self.enabled and tracemalloc.is_tracing()
+            if tracing:
+                stats = self._stats.setdefault((kind, name), {
+                    "count": 0, "retained_bytes": 0, "max_retained_bytes": 0, "max_peak_bytes": 0, "top_sites": [],
+                })
+                sample = stats["count"] % self.site_every == 0
+                stats["count"] += 1
+                # Reset the process-wide peak only when no other block is measuring it
+                if self._active == 0:
+                    tracemalloc.reset_peak()
+                self._active += 1
+                session = self._session
+                before = self._take_snapshot() if sample else None
+                start_size = tracemalloc.get_traced_memory()[0]
+        if not tracing:  # stopped since the check above
+            yield
+            return
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                # Stopped (or stopped and restarted) during the block: nothing to compare against
+                tracing = tracemalloc.is_tracing() and self._session == session
+                size, peak = tracemalloc.get_traced_memory() if tracing else (start_size, start_size)
+                after = self._take_snapshot() if sample and tracing else None
+            sites = self._top_sites(after, before) if after is not None else None
+            with self._lock:
+                stats["retained_bytes"] += size - start_size
+                stats["max_retained_bytes"] = max(stats["max_retained_bytes"], size - start_size)
+                if peak - start_size >= stats["max_peak_bytes"]:
+                    stats["max_peak_bytes"] = peak - start_size
+                    if sites is not None:
+                        stats["top_sites"] = sites
+
+    def report(self) -> dict:
+        """Collected statistics per kind and name, largest peak first"""
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: item[1]["max_peak_bytes"], reverse=True)
+            result = {}
+            for (kind, name), stats in items:
+                result.setdefault(kind, {})[name] = {**stats, "top_sites": list(stats["top_sites"])}
+            return result
+
+    def status(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        with self._lock:
+            snapshots = [
+                {"id": snapshot_id, "label": entry["label"], "taken_at": entry["taken_at"],
+                 "traced_bytes": entry["traced_bytes"], "path": entry["path"]}
+                for snapshot_id, entry in self._snapshots.items()
+            ]
+        return {"enabled": self.enabled, "traced_bytes": current, "traced_peak_bytes": peak, "snapshots": snapshots}
+
+    def snapshot(self, label: str = "", dump: bool = False) -> str:
+        """
+        Takes and keeps a snapshot; returns its id. With `dump` the snapshot
+        is also written under ARTIFACT_DIR/memory for offline analysis
+        (tracemalloc.Snapshot.load).
+
+        Raises:
+            ValueError: If profiling is not enabled
+        """
+        with self._lock:
+            if not (self.enabled and tracemalloc.is_tracing()):
+                raise ValueError("Memory profiling is not enabled.")
+            snapshot = self._take_snapshot()
+        snapshot_id = uuid.uuid4().hex[:8]
+        path = None
+        if dump:
+            path = os.path.join(ARTIFACT_DIR, "memory", f"{os.getpid()}-{snapshot_id}.snapshot")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            snapshot.dump(path)
+        with self._lock:
+            self._snapshots[snapshot_id] = {
+                "label": label, "taken_at": time.time(), "snapshot": snapshot, "path": path,
+                "traced_bytes": sum(trace.size for trace in snapshot.traces),
+            }
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.pop(next(iter(self._snapshots)))
+        return snapshot_id
+
+    def diff(self, base_id: str, target_id: str = None, key_type: str = "lineno", limit: int = None) -> list:
+        """
+        Allocation sites that grew from snapshot `base_id` to `target_id`
+        (a fresh snapshot if not given). key_type 'traceback' groups by the
+        whole call stack, 'filename' by module.
+
+        Raises:
+            ValueError: If a snapshot id or the key type is unknown
+        """
+        if key_type not in ("lineno", "filename", "traceback"):
+            raise ValueError(f"Unknown key type: {key_type}")
+        with self._lock:
+            base = self._snapshots.get(base_id)
+            target = self._snapshots.get(target_id) if target_id else None
+            if base is None or (target_id and target is None):
+                raise ValueError("Unknown snapshot id.")
+            if target is None and not (self.enabled and tracemalloc.is_tracing()):
+                raise ValueError("Memory profiling is not enabled.")
+            target_snapshot = target["snapshot"] if target else self._take_snapshot()
+        return self._top_sites(target_snapshot, base["snapshot"], key_type, limit)
+
+# Bellek profili; MEMORY_PROFILING=1 ile ya da /admin/memory üzerinden açılır
+memory_profiler = MemoryProfiler()
+if MEMORY_PROFILING:
+    memory_profiler.start()
+
+def _collect_memory_profile():
+    """Exposes the largest traced peak and the retained memory per stage and route while profiling"""
+    if not memory_profiler.enabled:
+        return []
+    report = memory_profiler.report()
+    gauges = {
+        "max_peak_bytes": ("pdf_assistant_memory_peak_bytes", "Largest traced memory peak above the start of a stage or route."),
+        "retained_bytes": ("pdf_assistant_memory_retained_bytes", "Traced memory kept after a stage or route, summed over runs."),
+    }
+    lines = []
+    for field, (name, help_text) in gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for kind, names in report.items():
+            for label, stats in names.items():
+                lines.append(f'{name}{{kind="{kind}",name="{label}"}} {stats[field]}')
+    return lines
+
+metrics.add_collector(_collect_memory_profile)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # Tanımlıysa /metrics için Bearer token gerekir
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", METRICS_TOKEN)  # Yoksa /admin uçları yalnızca localhost'tan çağrılabilir
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by entry count and/or total
+    size (as measured by `sizeof`).
+    """
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None, sizeof=len):
+        self._lock = threading.Lock()
+        self._items = {}  # dict keeps insertion order; re-inserting marks as recently used
+        self._sizes = {}
+        self._bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        size = self._sizeof(value) if self.max_bytes else 0
+        with self._lock:
+            if key in self._items:
+                self._items.pop(key)
+                self._bytes -= self._sizes.pop(key)
+            self._items[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            while self._items and (
+                (self.max_entries and len(self._items) > self.max_entries) or
+                (self.max_bytes and self._bytes > self.max_bytes and len(self._items) > 1)
+            ):
+                oldest = next(iter(self._items))
+                self._items.pop(oldest)
+                self._bytes -= self._sizes.pop(oldest)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._bytes -= self._sizes.pop(key)
+            return self._items.pop(key)
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._items)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+def document_version(pdf_bytes: bytes) -> str:
+    """Content hash that identifies one version of a PDF"""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+def measure_page_costs(pdf_bytes: bytes, page_texts: list = None) -> list:
+    """
+    Estimates what each page costs when sent to the model.
+
+    Returns:
+        List of (tokens, bytes, text_tokens) per page. `tokens` is the PDF
+        page cost plus the text on the page; `bytes` is the size of the page
+        content stream plus the images it references.
+    """
+    costs = []
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        for index, page in enumerate(doc):
+            text = page_texts[index] if page_texts and index < len(page_texts) else page.get_text()
+            text_tokens = len(text or "") // CHARS_PER_TOKEN
+            size = len(page.read_contents())
+            for image in page.get_images(full=True):
+                length = doc.xref_get_key(image[0], "Length")
+                if length[0] == "int":
+                    size += int(length[1])
+            costs.append((PDF_PAGE_TOKENS + text_tokens, size, text_tokens))
+    finally:
+        doc.close()
+    return costs
+
+def download_pdf_from_storage(filename: str, bucket_name: str = "pdfs", cached_file=None):
+    """
+    Finds a PDF in a Supabase bucket and downloads it.
+
+    Tries an exact match of the filename (with and without a timestamp
+    prefix), then a partial match, then any PDF in the bucket.
+
+    Args:
+        filename: Name of the PDF file (a path is accepted)
+        bucket_name: Supabase bucket name
+        cached_file: Optional function that takes the storage listing entry
+            and returns the file from memory, or None to download it
+
+    Returns:
+        tuple: (pdf_bytes, storage_entry) - content and the storage listing entry of the file
+    """
+    # Extract filename (full path may be provided)
+    if "/" in filename:
+        filename = filename.split("/")[-1]
+        print(f"Filename extracted: {filename}")
+    
+    # Extract timestamp from filename if exists (e.g., 1709123456_file.pdf -> file.pdf)
+    if '_' in filename and filename.split('_')[0].isdigit():
+        parts = filename.split('_', 1)
+        if len(parts) > 1:
+            clean_filename = parts[1]
+        else:
+            clean_filename = filename
+    else:
+        clean_filename = filename
+        
+    print(f"Cleaned filename: {clean_filename}")
+    
+    # List all files in the bucket
+    try:
+        print(f"Listing files from '{bucket_name}' bucket...")
+        with metrics.span("storage_list"):
+            storage_files = supabase.storage.from_(bucket_name).list()
+        print(f"Bucket '{bucket_name}' has {len(storage_files)} files.")
+        
+        # List file names and paths
+        storage_file_names = [f["name"] for f in storage_files]
+        print(f"Files in bucket: {storage_file_names}")
+        
+        # If no files, check the bucket
+        if not storage_file_names or (len(storage_file_names) == 1 and storage_file_names[0] == '.emptyFolderPlaceholder'):
+            print(f"Bucket empty or only placeholder file. Check '{bucket_name}' bucket.")
+            
+            # Check the bucket
+            buckets = supabase.storage.list_buckets()
+            bucket_names = [bucket.name for bucket in buckets]
+            if bucket_name not in bucket_names:
+                print(f"'{bucket_name}' bucket not found!")
+                raise Exception(f"Bucket not found: {bucket_name}")
+        
+        # Directly download PDF from Supabase as byte array
+        file_found = False
+        pdf_filename = None
+        
+        # 1. First exact match search (filename and clean_filename)
+        if filename in storage_file_names:
+            print(f"Exact filename found: {filename}")
+            pdf_filename = filename
+            file_found = True
+        elif clean_filename in storage_file_names:
+            print(f"Exact filename found: {clean_filename}")
+            pdf_filename = clean_filename
+            file_found = True
+        # 2. Partial match search
+        else:
+            for storage_filename in storage_file_names:
+                if storage_filename.lower().endswith('.pdf') and (filename in storage_filename or clean_filename in storage_filename):
+                    print(f"Partial match found: {storage_filename}")
+                    pdf_filename = storage_filename
+                    file_found = True
+                    break
+            
+            # 3. Any PDF search
+            if not file_found:
+                print("Exact match not found, searching for any PDF...")
+                for storage_filename in storage_file_names:
+                    if storage_filename.lower().endswith('.pdf') and storage_filename != '.emptyFolderPlaceholder':
+                        print(f"Alternative PDF found: {storage_filename}")
+                        pdf_filename = storage_filename
+                        file_found = True
+                        break
+        
+        # File found?
+        if file_found and pdf_filename:
+            storage_entry = next((f for f in storage_files if f.get("name") == pdf_filename), {"name": pdf_filename})
+            pdf_bytes = cached_file(storage_entry) if cached_file is not None else None
+            if cached_file is not None:
+                metrics.cache("pdf_file", pdf_bytes is not None)
+            if pdf_bytes is not None:
+                print(f"'{pdf_filename}' taken from memory, size: {len(pdf_bytes)} byte.")
+            else:
+                # Download the file
+                print(f"'{pdf_filename}' downloading...")
+                with metrics.span("storage_download"):
+                    pdf_bytes = supabase.storage.from_(bucket_name).download(pdf_filename)
+                print(f"PDF content downloaded, size: {len(pdf_bytes)} byte.")
+        else:
+            print(f"File not found. Bucket: {bucket_name}, Searched: {filename} / {clean_filename}")
+            
+            # Suggest using test_bucket.py to upload PDF
+            pdf_test_path = "test_bucket.py"
+            if os.path.exists(pdf_test_path):
+                print(f"You can use '{pdf_test_path}' to upload PDF.")
+            
+            raise Exception(f"PDF file not found: {filename}")
+        
+    except Exception as e:
+        print(f"Supabase storage listing/download error: {str(e)}")
+        traceback_str = traceback.format_exc()
+        print(f"Error details: {traceback_str}")
+        raise e
+    
+    if not pdf_bytes:
+        print("PDF content is empty.")
+        raise Exception("PDF content not downloaded from Supabase.")
+
+    return pdf_bytes, storage_entry
+
+def storage_fingerprint(storage_entry: dict):
+    """Identifies one stored version of a file from its storage listing entry, without downloading it"""
+    if not storage_entry:
+        return None
+    metadata = storage_entry.get("metadata") or {}
+    marker = metadata.get("eTag") or metadata.get("size")
+    updated_at = storage_entry.get("updated_at") or metadata.get("lastModified")
+    if marker is None and updated_at is None:
+        return None
+    return f"{storage_entry.get('name')}:{updated_at}:{marker}"
+
+def extract_page_texts(pdf_bytes: bytes, only: set = None) -> list:
+    """
+    Extracts the text of every page with PyMuPDF, reading the PDF buffer in
+    place. If `only` is given, just those 0-based pages are extracted and the
+    others are None.
+    """
+    with metrics.span("extract_text"):
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            return [
+                page.get_text() if only is None or index in only else None
+                for index, page in enumerate(doc)
+            ]
+        finally:
+            doc.close()
+
+def page_content_hash(doc, page) -> str:
+    """
+    Content hash of one page: its size, content stream, the images it draws
+    and the fonts it uses. Pages with the same hash look the same, so their
+    derived artifacts can be shared between document versions.
+    """
+    digest = hashlib.sha256(f"{tuple(page.rect)}:{page.rotation}".encode())
+    digest.update(page.read_contents())
+    for image in page.get_images(full=True):
+        digest.update(doc.xref_stream_raw(image[0]) or b"")
+    for font in page.get_fonts(full=True):
+        digest.update(f"{font[2]}:{font[3]}:{font[5]}".encode())
+    return digest.hexdigest()
+
+def compute_page_hashes(pdf_bytes: bytes) -> list:
+    """Content hash of every page, see page_content_hash"""
+    with metrics.span("hash_pages"):
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            return [page_content_hash(doc, page) for page in doc]
+        finally:
+            doc.close()
+
+def parse_page_range(value) -> tuple:
+    """
+    Parses a page range argument ("40-55", "7", [40, 55]) into (first, last),
+    1-based and inclusive.
+
+    Raises:
+        ValueError: If the value is not a valid page range
+    """
+    if isinstance(value, (list, tuple)):
+        if len(value) != 2:
+            raise ValueError("Page range must have two numbers.")
+        first, last = value
+    else:
+        match = re.fullmatch(r"\s*(\d+)\s*(?:[-–—:]\s*(\d+)\s*)?", str(value))
+        if not match:
+            raise ValueError(f"Invalid page range: {value}")
+        first, last = match.group(1), match.group(2) or match.group(1)
+    try:
+        first, last = int(first), int(last)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid page range: {value}")
+    if first < 1 or last < first:
+        raise ValueError(f"Invalid page range: {value}")
+    return (first, last)
+
+class PageTextStore:
+    """
+    Read-only, list-like view of the page texts of a document version that
+    was ingested page by page. Each page is a separate artifact; only the
+    recently read pages are kept in memory.
+    """
+
+    def __init__(self, version: str, page_count: int):
+        self.version = version
+        self.page_count = page_count
+        self._cache = LRUCache(max_entries=PAGE_TEXT_CACHE_PAGES)
+
+    @staticmethod
+    def artifact_name(index: int) -> str:
+        return f"page-{index + 1}.txt"
+
+    def __len__(self):
+        return self.page_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.page_count))]
+        if index < 0:
+            index += self.page_count
+        if not 0 <= index < self.page_count:
+            raise IndexError(index)
+        text = self._cache.get(index)
+        if text is None:
+            data = artifact_store.read_bytes(self.version, self.artifact_name(index))
+            if data is None:
+                print(f"Page text missing: {self.version}/{self.artifact_name(index)}")
+            text = data.decode("utf-8") if data is not None else ""
+            self._cache.put(index, text)
+        return text
+
+    def __iter__(self):
+        for index in range(self.page_count):
+            yield self[index]
+
+class CompressedPageTexts:
+    """
+    Read-only, list-like page texts of one document kept as a single zlib
+    (raw deflate) blob. Pages are compressed in blocks of `block_pages` and
+    every block starts at a full-flush point, so it can be decompressed on
+    its own: reading a page costs one block, not the whole document. The
+    last decompressed block is kept for sequential reads.
+
+    Larger blocks compress better and read slower; see
+    `benchmark.py --page-store` for the measured tradeoff.
+    """
+
+    def __init__(self, page_texts, block_pages: int = PAGE_TEXT_BLOCK_PAGES,
+                 level: int = PAGE_TEXT_COMPRESSION_LEVEL):
+        self.block_pages = max(1, block_pages)
+        self.page_offsets = array("Q", [0])  # Sayfaların sıkıştırılmamış başlangıçları (n + 1)
+        self.block_offsets = array("Q", [0])  # Blokların blob içindeki başlangıçları
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        chunks, block = [], []
+        size = 0
+
+        def flush_block():
+            nonlocal size
+            chunk = compressor.compress(b"".join(block)) + compressor.flush(zlib.Z_FULL_FLUSH)
+            chunks.append(chunk)
+            size += len(chunk)
+            self.block_offsets.append(size)
+            block.clear()
+
+        for text in page_texts:
+            data = (text or "").encode("utf-8")
+            block.append(data)
+            self.page_offsets.append(self.page_offsets[-1] + len(data))
+            if len(block) == self.block_pages:
+                flush_block()
+        if block:
+            flush_block()
+        self.blob = b"".join(chunks)
+        self._last_block = (None, b"")
+
+    def __len__(self):
+        return len(self.page_offsets) - 1
+
+    def _block(self, block_index: int) -> bytes:
+        cached_index, data = self._last_block
+        if cached_index == block_index:
+            return data
+        view = memoryview(self.blob)[self.block_offsets[block_index]:self.block_offsets[block_index + 1]]
+        data = zlib.decompressobj(-15).decompress(view)
+        self._last_block = (block_index, data)
+        return data
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        block_index = index // self.block_pages
+        block_start = self.page_offsets[block_index * self.block_pages]
+        data = self._block(block_index)
+        return data[self.page_offsets[index] - block_start:self.page_offsets[index + 1] - block_start].decode("utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def full_text(self) -> str:
+        """All pages concatenated, decompressed in one pass"""
+        return zlib.decompressobj(-15).decompress(self.blob).decode("utf-8")
+
+    @property
+    def size_bytes(self) -> int:
+        """Memory held by the blob and offset arrays"""
+        return (len(self.blob) + self.page_offsets.itemsize * len(self.page_offsets) +
+                self.block_offsets.itemsize * len(self.block_offsets))
+
+def compact_page_texts(page_texts):
+    """Keeps a list of page texts compressed in memory; other containers are returned as they are"""
+    if isinstance(page_texts, list):
+        return CompressedPageTexts(page_texts)
+    return page_texts
+
+def load_page_texts(version: str):
+    """Page texts of an ingested version: a list, a PageTextStore, or None if not ingested"""
+    page_texts = artifact_store.read_json(version, "page_texts.json")
+    if page_texts is not None:
+        return page_texts
+    manifest = artifact_store.read_json(version, "pages.json")
+    if manifest is not None:
+        return PageTextStore(version, manifest["page_count"])
+    return None
+
+class ByteBudget:
+    """Limits the bytes in flight between a producer and a consumer; producers block at the ceiling"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int):
+        with self._condition:
+            # Tek başına sınırı aşan bir sayfa, boş bir tamponda yine de geçer
+            while self._in_flight and self._in_flight + size > self.max_bytes:
+                self._condition.wait()
+            self._in_flight += size
+
+    def release(self, size: int):
+        with self._condition:
+            self._in_flight -= size
+            self._condition.notify_all()
+
+def iter_page_texts(pdf_bytes: bytes, known: dict = None, previous_texts=None):
+    """
+    Yields (index, page hash, text, extracted) one page at a time. Text of
+    pages whose hash is in `known` (hash -> index in `previous_texts`) is
+    reused instead of extracted.
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        for index, page in enumerate(doc):
+            page_hash = page_content_hash(doc, page)
+            if known and page_hash in known:
+                yield index, page_hash, previous_texts[known[page_hash]], False
+            else:
+                yield index, page_hash, page.get_text(), True
+    finally:
+        doc.close()
+
+def stream_ingest_pages(pdf_bytes: bytes, version: str, previous_version: str = None) -> tuple:
+    """
+    Ingests a large PDF page by page: pages are extracted in a background
+    thread and written to the artifact store as they arrive, with at most
+    INGEST_MEMORY_CEILING_MB of page text waiting to be written. Returns the
+    same tuple as ingest_page_texts, with a PageTextStore as page texts.
+    """
+    known, previous_texts = {}, None
+    if previous_version and previous_version != version:
+        previous_texts = load_page_texts(previous_version)
+        previous_hashes = artifact_store.read_json(previous_version, "page_hashes.json")
+        if previous_texts is not None and previous_hashes is not None:
+            known = {page_hash: index for index, page_hash in enumerate(previous_hashes)}
+
+    budget = ByteBudget(INGEST_MEMORY_CEILING_MB * 1024 * 1024)
+    pages = queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for index, page_hash, text, extracted in iter_page_texts(pdf_bytes, known, previous_texts):
+                if stop.is_set():
+                    return
+                data = (text or "").encode("utf-8")
+                budget.acquire(len(data))
+                pages.put((index, page_hash, data, extracted))
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(None)
+
+    page_hashes, changed = [], []
+    with metrics.span("stream_ingest"):
+        producer = threading.Thread(target=produce, name="ingest-pages", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                index, page_hash, data, extracted = item
+                try:
+                    artifact_store.write_bytes(version, PageTextStore.artifact_name(index), data)
+                finally:
+                    budget.release(len(data))
+                page_hashes.append(page_hash)
+                if extracted:
+                    changed.append(index)
+        finally:
+            stop.set()
+            # Üretici bekliyorsa serbest kalsın diye kuyruğu boşalt
+            while producer.is_alive():
+                try:
+                    item = pages.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if isinstance(item, tuple):
+                    budget.release(len(item[2]))
+
+    if known:
+        print(f"Incremental ingestion: {len(changed)} of {len(page_hashes)} pages changed.")
+    artifact_store.write_json(version, "page_hashes.json", page_hashes)
+    artifact_store.write_json(version, "pages.json", {"page_count": len(page_hashes)})
+    return PageTextStore(version, len(page_hashes)), page_hashes, changed
+
+def ingest_page_texts(pdf_bytes: bytes, version: str, previous_version: str = None) -> tuple:
+    """
+    Returns the page texts and page hashes of a document version, computing
+    them only once per version. When the previous version of the same
+    document is known, text of unchanged pages is taken from it and only new
+    or changed pages are extracted. PDFs of STREAMING_INGEST_MIN_MB or more
+    are ingested page by page (see stream_ingest_pages).
+
+    Returns:
+        (page_texts, page_hashes, changed) where `changed` lists the 0-based
+        pages that were extracted
+    """
+    page_texts = load_page_texts(version)
+    page_hashes = artifact_store.read_json(version, "page_hashes.json")
+    if page_texts is not None and page_hashes is not None:
+        return page_texts, page_hashes, []
+
+    if len(pdf_bytes) >= STREAMING_INGEST_MIN_MB * 1024 * 1024:
+        return stream_ingest_pages(pdf_bytes, version, previous_version)
+
+    page_hashes = compute_page_hashes(pdf_bytes)
+    if page_texts is None or len(page_texts) != len(page_hashes):
+        known = {}
+        if previous_version and previous_version != version:
+            previous_texts = load_page_texts(previous_version)
+            previous_hashes = artifact_store.read_json(previous_version, "page_hashes.json")
+            if previous_texts is not None and previous_hashes is not None:
+                known = dict(zip(previous_hashes, previous_texts))
+
+        changed = [index for index, page_hash in enumerate(page_hashes) if page_hash not in known]
+        extracted = extract_page_texts(pdf_bytes, set(changed)) if changed else [None] * len(page_hashes)
+        page_texts = [
+            text if text is not None else known.get(page_hash, "")
+            for text, page_hash in zip(extracted, page_hashes)
+        ]
+        if known:
+            print(f"Incremental ingestion: {len(changed)} of {len(page_hashes)} pages changed.")
+        artifact_store.write_json(version, "page_texts.json", page_texts)
+    else:
+        changed = []
+
+    artifact_store.write_json(version, "page_hashes.json", page_hashes)
+    return page_texts, page_hashes, changed
+
+# Belge sürümüne göre sayfa maliyetleri ve oluşturulan alt PDF'ler
+_page_cost_cache = LRUCache(max_entries=PAGE_COST_CACHE_SIZE)
+_subdocument_cache = LRUCache(max_bytes=SUBDOCUMENT_CACHE_MB * 1024 * 1024)
+
+def get_page_costs(version: str, pdf_bytes: bytes, page_texts: list = None) -> list:
+    """Page costs of a document version from memory, disk or measured (see measure_page_costs)"""
+    costs = _page_cost_cache.get(version)
+    metrics.cache("page_costs", costs is not None)
+    if costs is None:
+        costs = artifact_store.read_json(version, "page_costs.json")
+        if costs is None:
+            with metrics.span("measure_page_costs"):
+                costs = measure_page_costs(pdf_bytes, page_texts)
+            artifact_store.write_json(version, "page_costs.json", costs)
+        costs = [tuple(cost) for cost in costs]
+        _page_cost_cache.put(version, costs)
+    return costs
+
+def blob_tokens(mime_type: str, data: bytes) -> int:
+    """Estimated tokens of inline data: PDF_PAGE_TOKENS per PDF page, or per image"""
+    if mime_type != "application/pdf":
+        return PDF_PAGE_TOKENS
+    try:
+        doc = fitz.open(stream=data, filetype="pdf")
+    except Exception:
+        return PDF_PAGE_TOKENS
+    try:
+        return doc.page_count * PDF_PAGE_TOKENS
+    finally:
+        doc.close()
+
+def list_page_images(pdf_bytes: bytes) -> list:
+    """(page index, image index, xref) of every image, grouped by page"""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return [
+            [(page_index, img_index, img_info[0]) for img_index, img_info in enumerate(page.get_images(full=True))]
+            for page_index, page in enumerate(doc)
+        ]
+    finally:
+        doc.close()
+
+def get_image_manifest(version: str, pdf_bytes: bytes) -> list:
+    """Image list of a document version, made once and kept on disk"""
+    manifest = artifact_store.read_json(version, "images.json")
+    if manifest is None:
+        manifest = list_page_images(pdf_bytes)
+        artifact_store.write_json(version, "images.json", manifest)
+    return manifest
+
+FIGURE_REFERENCE = re.compile(r"\b(fig(?:ure)?|table|şekil|tablo)\.?\s*(\d+(?:\.\d+)*)", re.IGNORECASE)
+
+def image_hash(image: Image.Image) -> str:
+    """64-bit difference hash (dHash) of an image as hex; similar images get similar hashes"""
+    pixels = list(image.convert("L").resize((9, 8)).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = bits << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def image_caption(page, rect) -> str:
+    """Text blocks just below, above or on an image that overlap it horizontally, captions first"""
+    nearby = []
+    for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks"):
+        text = " ".join(text.split())
+        if block_type != 0 or not text or x1 < rect.x0 or x0 > rect.x1:
+            continue
+        gap = y0 - rect.y1 if y0 >= rect.y1 else rect.y0 - y1 if y1 <= rect.y0 else 0
+        if gap <= IMAGE_CAPTION_DISTANCE:
+            nearby.append((FIGURE_REFERENCE.match(text) is None, gap, text))
+    return " ".join(text for _, _, text in sorted(nearby))[:IMAGE_CAPTION_CHARS]
+
+def build_image_index(pdf_bytes: bytes) -> list:
+    """
+    Describes every image of a PDF for question-time selection.
+
+    Each entry has the page (1-based), image index and xref, the pixel size,
+    the stored size in the file, the caption text near the image and a
+    perceptual hash. Tiny images and images repeated on many pages (logos,
+    backgrounds) are flagged as decorative.
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    entries, hashes = [], {}
+    try:
+        for page_index, page in enumerate(doc):
+            for img_index, img_info in enumerate(page.get_images(full=True)):
+                xref, width, height = img_info[0], img_info[2], img_info[3]
+                if xref not in hashes:
+                    try:
+                        image = Image.open(io.BytesIO(doc.extract_image(xref)["image"]))
+                        image.draft("L", (64, 64))  # JPEG decodes at a fraction of its size
+                        hashes[xref] = image_hash(image)
+                    except Exception:
+                        hashes[xref] = ""
+                length = doc.xref_get_key(xref, "Length")
+                rects = page.get_image_rects(xref)
+                entries.append({
+                    "page": page_index + 1,
+                    "index": img_index,
+                    "xref": xref,
+                    "width": width,
+                    "height": height,
+                    "bytes": int(length[1]) if length[0] == "int" else 0,
+                    "caption": image_caption(page, rects[0]) if rects else "",
+                    "hash": hashes[xref],
+                })
+    finally:
+        doc.close()
+
+    pages_by_hash = {}
+    for entry in entries:
+        pages_by_hash.setdefault(entry["hash"], set()).add(entry["page"])
+    for entry in entries:
+        entry["decorative"] = (
+            min(entry["width"], entry["height"]) < IMAGE_MIN_SIDE
+            or bool(entry["hash"]) and len(pages_by_hash[entry["hash"]]) >= IMAGE_DECORATIVE_PAGES
+        )
+    return entries
+
+def get_image_index(version: str, pdf_bytes: bytes) -> list:
+    """Image index of a document version (see build_image_index), made once and kept on disk"""
+    index = artifact_store.read_json(version, "image_index.json")
+    metrics.cache("image_index", index is not None)
+    if index is None:
+        with metrics.span("build_image_index"):
+            index = build_image_index(pdf_bytes)
+        artifact_store.write_json(version, "image_index.json", index)
+    return index
+
+def image_share(image_index: list, pdf_size: int) -> float:
+    """Part of the PDF file taken by its images"""
+    image_bytes = sum({entry["xref"]: entry["bytes"] for entry in image_index}.values())
+    return image_bytes / pdf_size if pdf_size else 0.0
+
+def strip_pdf_images(pdf_bytes: bytes) -> bytes:
+    """The PDF with every image replaced by an empty one; text and layout stay"""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        removed = set()
+        for page in doc:
+            for img_info in page.get_images(full=True):
+                if img_info[0] not in removed:
+                    page.delete_image(img_info[0])
+                    removed.add(img_info[0])
+        return doc.tobytes(garbage=3, deflate=True)
+    finally:
+        doc.close()
+
+def get_image_free_pdf(version: str, pdf_bytes: bytes) -> bytes:
+    """Image-free copy of a document version from memory, disk or built"""
+    key = (version, "no-images")
+    data = _subdocument_cache.get(key)
+    metrics.cache("image_free_pdf", data is not None)
+    if data is None:
+        data = artifact_store.read_bytes(version, "no_images.pdf")
+        if data is None:
+            with metrics.span("strip_pdf_images"):
+                data = strip_pdf_images(pdf_bytes)
+            artifact_store.write_bytes(version, "no_images.pdf", data)
+        _subdocument_cache.put(key, data)
+    return data
+
+# Okunamayan karakterler: eşlenemeyen glifler, özel kullanım alanı, kontrol karakterleri
+UNREADABLE_CHARACTERS = re.compile(r"[\ufffd\ue000-\uf8ff\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def text_quality(page_texts) -> float:
+    """Share of readable characters in the extracted text (1.0 if there is no text)"""
+    total = unreadable = 0
+    for text in page_texts:
+        total += len(text or "")
+        unreadable += len(UNREADABLE_CHARACTERS.findall(text or ""))
+    return 1.0 - unreadable / total if total else 1.0
+
+def classify_payload(page_texts, image_index: list, pdf_size: int) -> dict:
+    """
+    Classifies a document by what the model should receive.
+
+    'scanned' if most pages carry an image and (almost) no text, 'image_heavy'
+    if images make up IMAGE_CONTEXT_MIN_SHARE of the file, 'text' if they make
+    up at most PAYLOAD_TEXT_MAX_IMAGE_SHARE, else 'mixed'. Only 'text'
+    documents are sent as extracted text (see InteractivePDFAssistant._text_payload).
+    """
+    figure_pages = {entry["page"] for entry in image_index if not entry["decorative"]}
+    weak_pages = [
+        number for number, text in enumerate(page_texts, start=1)
+        if number in figure_pages and len((text or "").strip()) < PAYLOAD_WEAK_PAGE_CHARS
+    ]
+    share = image_share(image_index, pdf_size)
+    if page_texts and len(weak_pages) >= len(page_texts) * PAYLOAD_SCANNED_PAGE_SHARE:
+        kind = "scanned"
+    elif share >= IMAGE_CONTEXT_MIN_SHARE:
+        kind = "image_heavy"
+    elif share <= PAYLOAD_TEXT_MAX_IMAGE_SHARE:
+        kind = "text"
+    else:
+        kind = "mixed"
+    return {
+        "kind": kind,
+        "image_share": round(share, 4),
+        "text_quality": round(text_quality(page_texts), 4),
+        "weak_pages": weak_pages,
+    }
+
+def get_payload_class(version: str, page_texts, image_index: list, pdf_size: int) -> dict:
+    """Payload class of a document version, made once and kept on disk (see classify_payload)"""
+    payload_class = artifact_store.read_json(version, "payload_class.json")
+    if payload_class is None:
+        with metrics.span("classify_payload"):
+            payload_class = classify_payload(page_texts, image_index, pdf_size)
+        artifact_store.write_json(version, "payload_class.json", payload_class)
+    return payload_class
+
+class ArtifactStore:
+    """
+    Disk store for derived document artifacts, shared by the worker processes
+    of one machine. Files are grouped in namespaces (usually a document
+    version) and written atomically. Failures are logged and treated as
+    cache misses.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, namespace: str, name: str) -> str:
+        return os.path.join(self.root, secure_filename(str(namespace)), secure_filename(str(name)))
+
+    def write_bytes(self, namespace: str, name: str, data: bytes) -> bool:
+        path = self._path(namespace, name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            return True
+        except OSError as e:
+            print(f"Artifact write error ({namespace}/{name}): {str(e)}")
+            return False
+
+    def read_bytes(self, namespace: str, name: str):
+        try:
+            with open(self._path(namespace, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            print(f"Artifact read error ({namespace}/{name}): {str(e)}")
+            return None
+
+    def write_json(self, namespace: str, name: str, value) -> bool:
+        return self.write_bytes(namespace, name, json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+    def read_json(self, namespace: str, name: str):
+        data = self.read_bytes(namespace, name)
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    def delete(self, namespace: str, name: str):
+        try:
+            os.unlink(self._path(namespace, name))
+        except OSError:
+            pass
+
+artifact_store = ArtifactStore(ARTIFACT_DIR)
+
+def tokenize(text: str) -> list:
+    """Lowercase word tokens used for passage retrieval"""
+    return [token for token in re.findall(r"\w+", (text or "").lower()) if len(token) > 1]
+
+def split_passages(text: str, max_chars: int = PASSAGE_CHARS) -> list:
+    """Splits page text into passages of about `max_chars`, on line boundaries"""
+    passages, current = [], ""
+    for line in (text or "").splitlines():
+        if current and len(current) + len(line) > max_chars:
+            passages.append(current.strip())
+            current = ""
+        current += line + "\n"
+    if current.strip():
+        passages.append(current.strip())
+    return passages
+
+def page_passage_entries(text: str) -> list:
+    """Passages of one page with their term counts: [(passage, {term: count}, length)]"""
+    entries = []
+    for passage in split_passages(text):
+        tokens = tokenize(passage)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        entries.append((passage, counts, len(tokens)))
+    return entries
+
+# Sayfa hash'i -> sayfanın pasajları; değişmeyen sayfalar yeni sürümün indeksinde tekrar kullanılır
+_page_passage_cache = LRUCache(max_entries=PAGE_PASSAGE_CACHE_SIZE)
+
+def document_passage_entries(page_texts: list, page_hashes: list = None) -> list:
+    """Passage entries of every page; pages already indexed in another version are reused"""
+    page_entries = []
+    for page_number, text in enumerate(page_texts, start=1):
+        page_hash = page_hashes[page_number - 1] if page_hashes else None
+        entries = _page_passage_cache.get(page_hash) if page_hash else None
+        if entries is None:
+            entries = page_passage_entries(text)
+            if page_hash:
+                _page_passage_cache.put(page_hash, entries)
+        page_entries.append(entries)
+    return page_entries
+
+class PassageIndex:
+    """BM25 inverted index over the passages of one document"""
+
+    def __init__(self, page_entries: list):
+        self.passages = []  # (page number, text)
+        self.lengths = []
+        self.postings = {}  # term -> [(passage index, term frequency)]
+        for page_number, entries in enumerate(page_entries, start=1):
+            for passage, counts, length in entries:
+                index = len(self.passages)
+                self.passages.append((page_number, passage))
+                self.lengths.append(length)
+                for token, count in counts.items():
+                    self.postings.setdefault(token, []).append((index, count))
+        self.total_length = sum(self.lengths)
+
+class DocumentArtifacts:
+    """Derived state of one PDF version that is shared between requests"""
+
+    def __init__(self, pdf_id, filename: str, version: str, page_texts: list, fingerprint: str = None,
+                 page_hashes: list = None):
+        self.pdf_id = pdf_id
+        self.filename = filename
+        self.version = version
+        self.page_texts = compact_page_texts(page_texts)
+        self.page_hashes = page_hashes
+        self.fingerprint = fingerprint
+        self.checked_at = time.time()
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def title(self) -> str:
+        return self.filename.split("/")[-1].replace(".pdf", "")
+
+    @property
+    def index(self) -> PassageIndex:
+        """Passage index, built on first use"""
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    with metrics.span("build_passage_index"):
+                        # Tokenized passages are kept on disk; loading them is faster than tokenizing
+                        page_entries = artifact_store.read_json(self.version, "passages.json")
+                        if page_entries is None or len(page_entries) != len(self.page_texts):
+                            page_entries = document_passage_entries(self.page_texts, self.page_hashes)
+                            artifact_store.write_json(self.version, "passages.json", page_entries)
+                        self._index = PassageIndex(page_entries)
+        return self._index
+
+    def page_key(self, page_number: int) -> str:
+        """Identifies the content of one page; unchanged pages keep their key across versions"""
+        if self.page_hashes and page_number <= len(self.page_hashes):
+            return self.page_hashes[page_number - 1]
+        return f"{self.version}-{page_number}"
+
+# pdf_id -> DocumentArtifacts
+_document_cache = LRUCache(max_entries=DOCUMENT_CACHE_SIZE)
+
+def remember_document(pdf_id, filename: str, version: str, page_texts: list, fingerprint: str = None,
+                      page_hashes: list = None) -> DocumentArtifacts:
+    """Caches the artifacts of a loaded document in memory and on disk"""
+    artifacts = DocumentArtifacts(pdf_id, filename, version, page_texts, fingerprint, page_hashes)
+    _document_cache.put(str(pdf_id), artifacts)
+    if isinstance(page_texts, list) and artifact_store.read_bytes(version, "page_texts.json") is None:
+        artifact_store.write_json(version, "page_texts.json", page_texts)
+    artifact_store.write_json("documents", str(pdf_id), {
+        "filename": filename, "version": version, "fingerprint": fingerprint
+    })
+    return artifacts
+
+def forget_document(pdf_id):
+    """
+    Drops cached artifacts of a document whose file changed. The disk
+    pointer keeps the last version so the next load can reuse its unchanged
+    pages, but it no longer matches any storage fingerprint.
+    """
+    _document_cache.pop(str(pdf_id))
+    pointer = artifact_store.read_json("documents", str(pdf_id))
+    if pointer:
+        artifact_store.write_json("documents", str(pdf_id), {**pointer, "fingerprint": None})
+
+def previous_document_version(pdf_id) -> str:
+    """Last version of a document this machine has ingested, if any"""
+    pointer = artifact_store.read_json("documents", str(pdf_id))
+    return pointer.get("version") if pointer else None
+
+def cached_pdf_bytes(pdf_id, storage_entry: dict) -> bytes:
+    """
+    The file of a document from memory if it was loaded or warmed up at the
+    version storage holds now (see storage_fingerprint), else None.
+    """
+    fingerprint = storage_fingerprint(storage_entry)
+    if fingerprint is None:
+        return None
+    cached = _document_cache.get(str(pdf_id))
+    if cached is not None and cached.fingerprint == fingerprint:
+        return _pdf_cache.get(cached.version)
+    pointer = artifact_store.read_json("documents", str(pdf_id))
+    if pointer and pointer.get("fingerprint") == fingerprint:
+        return _pdf_cache.get(pointer["version"])
+    return None
+
+def get_document_artifacts(pdf_id, filename: str, fingerprint: str = None, bucket_name: str = "pdfs") -> DocumentArtifacts:
+    """
+    Returns the artifacts of a document from memory, disk or, as a last
+    resort, by downloading and extracting the PDF.
+
+    Args:
+        pdf_id: ID of the PDF record
+        filename: Name of the PDF file
+        fingerprint: Current storage fingerprint of the file, if known
+        bucket_name: Supabase bucket name
+    """
+    cached = _document_cache.get(str(pdf_id))
+    if cached is not None and (fingerprint is None or cached.fingerprint == fingerprint):
+        metrics.cache("document", True)
+        cached.checked_at = time.time()
+        return cached
+
+    # Disk: pointer written by another request or worker process
+    pointer = artifact_store.read_json("documents", str(pdf_id))
+    if pointer and fingerprint is not None and pointer.get("fingerprint") == fingerprint:
+        page_texts = load_page_texts(pointer["version"])
+        if page_texts is not None:
+            metrics.cache("document", True)
+            page_hashes = artifact_store.read_json(pointer["version"], "page_hashes.json")
+            artifacts = DocumentArtifacts(pdf_id, filename, pointer["version"], page_texts, fingerprint, page_hashes)
+            _document_cache.put(str(pdf_id), artifacts)
+            return artifacts
+
+    metrics.cache("document", False)
+    pdf_bytes, storage_entry = download_pdf_from_storage(filename, bucket_name)
+    version = document_version(pdf_bytes)
+    remember_pdf_bytes(version, pdf_bytes)
+    page_texts, page_hashes, _ = ingest_page_texts(pdf_bytes, version, previous_document_version(pdf_id))
+    return remember_document(pdf_id, filename, version, page_texts,
+                             storage_fingerprint(storage_entry) or fingerprint, page_hashes)
+
+def load_documents(pdf_records: list, bucket_name: str = "pdfs") -> list:
+    """
+    Returns artifacts for several PDF records. Recently validated documents
+    come straight from memory; the rest are checked against one storage
+    listing and loaded in parallel.
+    """
+    now = time.time()
+    documents = {}
+    stale = []
+    for record in pdf_records:
+        cached = _document_cache.get(str(record["id"]))
+        if cached is not None and now - cached.checked_at < DOCUMENT_REVALIDATE_SECONDS:
+            metrics.cache("document", True)
+            documents[str(record["id"])] = cached
+        else:
+            stale.append(record)
+
+    if stale:
+        with metrics.span("storage_list"):
+            entries = {entry.get("name"): entry for entry in supabase.storage.from_(bucket_name).list()}
+        with ThreadPoolExecutor(max_workers=min(4, len(stale))) as executor:
+            futures = {
+                executor.submit(
+                    get_document_artifacts,
+                    record["id"],
+                    record["file_name"],
+                    storage_fingerprint(entries.get(record["file_name"].split("/")[-1])),
+                    bucket_name
+                ): record
+                for record in stale
+            }
+            for future in as_completed(futures):
+                record = futures[future]
+                try:
+                    documents[str(record["id"])] = future.result()
+                except Exception as e:
+                    print(f"Document load error ({record['file_name']}): {str(e)}")
+
+    return [documents[str(record["id"])] for record in pdf_records if str(record["id"]) in documents]
+
+def search_passages(documents: list, question: str, token_budget: int, k1: float = 1.2, b: float = 0.75) -> list:
+    """
+    Ranks passages of several documents with BM25 and returns the best ones
+    that fit in `token_budget`.
+
+    Corpus statistics are combined over the selected documents so scores are
+    comparable between them. Only the postings of the question terms are
+    visited. If no passage matches, the first passages of every document are
+    used.
+
+    Returns:
+        List of (score, DocumentArtifacts, page number, passage text)
+    """
+    terms = set(tokenize(question))
+    indexes = [(document, document.index) for document in documents]
+    passage_count = sum(len(index.passages) for _, index in indexes)
+    if not passage_count:
+        return []
+    average_length = max(1.0, sum(index.total_length for _, index in indexes) / passage_count)
+    document_frequency = {term: sum(len(index.postings.get(term, ())) for _, index in indexes) for term in terms}
+
+    scored = []
+    for document, index in indexes:
+        scores = {}
+        for term in terms:
+            postings = index.postings.get(term)
+            if not postings:
+                continue
+            df = document_frequency[term]
+            idf = math.log(1 + (passage_count - df + 0.5) / (df + 0.5))
+            for passage_index, tf in postings:
+                norm = 1 - b + b * index.lengths[passage_index] / average_length
+                scores[passage_index] = scores.get(passage_index, 0.0) + idf * tf * (k1 + 1) / (tf + k1 * norm)
+        scored.extend((score, document, passage_index) for passage_index, score in scores.items())
+
+    if not scored:
+        # Nothing matched: take passages from the start of every document in turn
+        longest = max(len(index.passages) for _, index in indexes)
+        scored = [
+            (0.0, document, passage_index)
+            for passage_index in range(longest)
+            for document, index in indexes
+            if passage_index < len(index.passages)
+        ]
+    else:
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+    selected, used_tokens = [], 0
+    for score, document, passage_index in scored:
+        page_number, text = document.index.passages[passage_index]
+        tokens = len(text) // CHARS_PER_TOKEN + 16  # source header
+        if used_tokens + tokens > token_budget:
+            continue
+        selected.append((score, document, page_number, text))
+        used_tokens += tokens
+    return selected
+
+# Belge sürümü -> PDF dosyası ve (sürüm, sayfa, zoom, format) -> render edilmiş sayfa
+_pdf_cache = LRUCache(max_bytes=PDF_CACHE_MB * 1024 * 1024)
+_render_cache = LRUCache(max_bytes=RENDER_CACHE_MB * 1024 * 1024)
+_render_locks = [threading.Lock() for _ in range(16)]
+_render_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prerender")
+
+def remember_pdf_bytes(version: str, pdf_bytes: bytes):
+    """Keeps the PDF file of a document version in memory for rendering"""
+    _pdf_cache.put(version, pdf_bytes)
+
+def parse_render_args(zoom, image_format) -> tuple:
+    """
+    Normalizes the zoom and image format of a render request.
+
+    Raises:
+        ValueError: If zoom is not a number or the format is unsupported
+    """
+    try:
+        zoom = float(zoom if zoom not in (None, "") else 1.0)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid zoom: {zoom}")
+    if not math.isfinite(zoom):
+        raise ValueError(f"Invalid zoom: {zoom}")
+    zoom = min(RENDER_ZOOM_MAX, max(RENDER_ZOOM_MIN, round(zoom / RENDER_ZOOM_STEP) * RENDER_ZOOM_STEP))
+
+    image_format = (image_format or "png").lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in RENDER_FORMATS:
+        raise ValueError(f"Unsupported format: {image_format}")
+    return zoom, image_format
+
+def render_etag(page_key: str, zoom: float, image_format: str) -> str:
+    """Strong ETag of a rendered page; known before rendering and unchanged while the page is"""
+    return f'"{hashlib.sha1(page_key.encode("utf-8")).hexdigest()}-{zoom:g}-{image_format}"'
+
+def render_page(document: DocumentArtifacts, page_number: int, zoom: float, image_format: str,
+                bucket_name: str = "pdfs") -> bytes:
+    """
+    Returns page `page_number` (1-based) of a document as an image, from the
+    memory cache, the disk cache or by rendering it with PyMuPDF. Renders are
+    keyed by page content, so unchanged pages of a new version reuse them.
+    """
+    page_key = document.page_key(page_number)
+    key = (page_key, zoom, image_format)
+    image = _render_cache.get(key)
+    if image is not None:
+        metrics.cache("render_memory", True)
+        return image
+    metrics.cache("render_memory", False)
+
+    artifact_name = f"{page_key}-{zoom:g}.{image_format}"
+    with _render_locks[hash(key) % len(_render_locks)]:
+        # Başka bir istek aynı sayfayı render etmiş olabilir
+        image = _render_cache.get(key)
+        if image is not None:
+            return image
+
+        image = artifact_store.read_bytes("renders", artifact_name)
+        metrics.cache("render_disk", image is not None)
+        if image is None:
+            pdf_bytes = _pdf_cache.get(document.version)
+            if pdf_bytes is None:
+                pdf_bytes, _ = download_pdf_from_storage(document.filename, bucket_name)
+                if document_version(pdf_bytes) != document.version:
+                    raise ValueError("The PDF changed while it was being rendered.")
+                remember_pdf_bytes(document.version, pdf_bytes)
+
+            with metrics.span("render_page"):
+                doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+                try:
+                    pixmap = doc[page_number - 1].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                    if image_format == "jpeg":
+                        image = pixmap.tobytes("jpeg", jpg_quality=RENDER_JPEG_QUALITY)
+                    else:
+                        image = pixmap.tobytes("png")
+                finally:
+                    doc.close()
+            artifact_store.write_bytes("renders", artifact_name, image)
+
+        _render_cache.put(key, image)
+    return image
+
+def prerender_pages(document: DocumentArtifacts, pages: int = RENDER_PRERENDER_PAGES,
+                    zoom: float = RENDER_PRERENDER_ZOOM, image_format: str = "png"):
+    """Renders the first pages of a document in the background so previews are ready"""
+    def run():
+        for page_number in range(1, min(pages, len(document.page_texts)) + 1):
+            try:
+                render_page(document, page_number, zoom, image_format)
+            except Exception as e:
+                print(f"Prerender error ({document.filename}, page {page_number}): {str(e)}")
+                return
+    if pages > 0:
+        _render_executor.submit(run)
+
+# Üretilen özet/kavramlar: içerik anahtarı -> metin. Anahtar kullanılan sayfaların
+# hash'lerini içerdiği için yalnızca bu sayfalardan biri değişince geçersiz olur.
+_generation_cache = LRUCache(max_entries=GENERATION_CACHE_SIZE)
+
+def generation_key(mode: str, params: dict, page_keys: list, model_name: str) -> str:
+    """Key of a generation from its inputs: mode, parameters, model and the pages it reads"""
+    payload = json.dumps([mode, params, model_name, CONTEXT_TOKEN_BUDGETS.get(mode), page_keys], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_generation(key: str) -> str:
+    text = _generation_cache.get(key)
+    if text is None:
+        stored = artifact_store.read_json("generations", key)
+        if stored is not None:
+            text = stored.get("text")
+            _generation_cache.put(key, text)
+    metrics.cache("generation", text is not None)
+    return text
+
+def store_generation(key: str, text: str):
+    _generation_cache.put(key, text)
+    artifact_store.write_json("generations", key, {"text": text, "created_at": time.time()})
+
+def parse_quiz_questions(text: str, page_range: tuple) -> list:
+    """
+    Parses the structured questions of a question bank response. Questions
+    without a question, at least two choices or a valid answer are dropped;
+    pages outside `page_range` are moved to its first page.
+
+    Returns:
+        list: {"question", "choices", "answer" (index), "page", "topic"} dicts
+    """
+    text = (text or "").strip()
+    fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1)
+    try:
+        items = json.loads(text)
+    except ValueError:
+        return []
+    if isinstance(items, dict):
+        items = items.get("questions", [])
+
+    questions = []
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        question = str(item.get("question") or "").strip()
+        choices = [str(choice).strip() for choice in item.get("choices") or [] if str(choice).strip()]
+        answer = item.get("answer")
+        if isinstance(answer, str):
+            letter = answer.strip().rstrip(").").upper()
+            if len(letter) == 1 and "A" <= letter <= "Z":
+                answer = ord(letter) - ord("A")
+            elif answer.strip() in choices:
+                answer = choices.index(answer.strip())
+        if not question or len(choices) < 2 or not isinstance(answer, int) or not 0 <= answer < len(choices):
+            continue
+        try:
+            page = int(item.get("page"))
+        except (TypeError, ValueError):
+            page = page_range[0]
+        if not page_range[0] <= page <= page_range[1]:
+            page = page_range[0]
+        questions.append({
+            "question": question, "choices": choices, "answer": answer,
+            "page": page, "topic": str(item.get("topic") or "").strip(),
+        })
+    return questions
+
+class QuizBank:
+    """Structured quiz questions of one document version, indexed by page and term"""
+
+    def __init__(self, questions: list):
+        self.questions = sorted(questions, key=lambda question: question["page"])
+        self._pages = [question["page"] for question in self.questions]
+        self._terms = {}  # term -> [question index]
+        for index, question in enumerate(self.questions):
+            text = " ".join([question["question"], question["topic"]] + question["choices"])
+            for token in set(tokenize(text)):
+                self._terms.setdefault(token, []).append(index)
 
-# .env dosyasını yükle
-load_dotenv()
+    def __len__(self):
+        return len(self.questions)
 
-# Supabase istemcisini başlat
-supabase_url = os.environ.get("SUPABASE_URL")
-supabase_key = os.environ.get("SUPABASE_SERVICE_KEY", os.environ.get("SUPABASE_KEY"))
-supabase: Client = create_client(supabase_url, supabase_key)
+    def select(self, page_range: tuple = None, topic: str = None) -> list:
+        """
+        Indexes of the questions on the given pages. With a topic, only the
+        questions that share the most terms with it are kept.
+        """
+        first, last = 0, len(self.questions)
+        if page_range is not None:
+            first = bisect.bisect_left(self._pages, page_range[0])
+            last = bisect.bisect_right(self._pages, page_range[1])
+        if not topic:
+            return list(range(first, last))
+        matches = {}
+        for token in set(tokenize(topic)):
+            for index in self._terms.get(token, ()):
+                if first <= index < last:
+                    matches[index] = matches.get(index, 0) + 1
+        best = max(matches.values(), default=0)
+        return sorted(index for index, count in matches.items() if count == best)
 
-# Konfigürasyon
-ALLOWED_EXTENSIONS = {'pdf'}
-ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-UPLOAD_FOLDER = 'uploads'  # Geçici yükleme işlemleri için
+    def sample(self, count: int, page_range: tuple = None, topic: str = None) -> list:
+        """`count` random questions in page order, or None if fewer match"""
+        candidates = self.select(page_range, topic)
+        if len(candidates) < count:
+            return None
+        return [self.questions[index] for index in sorted(random.sample(candidates, count))]
 
-app = Flask(__name__)
-CORS(app)  # CORS desteği ekle
-app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'gizli-anahtar-burada')
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024  # 64 MB max upload olarak artırıldı
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # Session ömrü (saniye)
-app.config['JSON_AS_ASCII'] = False  # UTF-8 karakter desteği
+def format_quiz(questions: list) -> str:
+    """Renders bank questions as a numbered quiz followed by the answer key"""
+    lines = []
+    for number, question in enumerate(questions, start=1):
+        lines.append(f"**{number}. {question['question']}** (page {question['page']})")
+        lines.extend(f"   {chr(ord('A') + index)}) {choice}" for index, choice in enumerate(question["choices"]))
+        lines.append("")
+    lines.append("**Answers**")
+    for number, question in enumerate(questions, start=1):
+        answer = question["answer"]
+        lines.append(f"{number}. {chr(ord('A') + answer)}) {question['choices'][answer]}")
+    return "\n".join(lines)
+
+# Belge sürümünün bölüm anahtarları -> QuizBank; havuzlar arka planda, her biri tek kez oluşturulur
+_quiz_bank_cache = LRUCache(max_entries=QUIZ_BANK_CACHE_SIZE)
+_quiz_bank_builds = {}  # havuz anahtarı -> çalışan oluşturma (Future)
+_quiz_bank_builds_lock = threading.Lock()
+_quiz_bank_executor = ThreadPoolExecutor(max_workers=QUIZ_BANK_BUILDERS, thread_name_prefix="quiz_bank")
+
+# Aktif isteğin model çağrıları için son zamanı (time.monotonic)
+_model_deadline = contextvars.ContextVar("model_deadline", default=None)
+
+@contextlib.contextmanager
+def model_deadline(seconds: float):
+    """
+    Sets a deadline for every model call made inside the block.
+
+    Nested blocks can only shorten the active deadline, never extend it.
+    """
+    deadline = time.monotonic() + seconds
+    current = _model_deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+
+    token = _model_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _model_deadline.reset(token)
+
+# Aktif işin iptal bayrağı (threading.Event); iptal edilince sonraki model çağrıları başlamaz
+_model_cancel = contextvars.ContextVar("model_cancel", default=None)
+
+class Cancelled(Exception):
+    """The work a model call belonged to was cancelled"""
+
+def with_model_deadline(seconds: float = None):
+    """Route decorator that runs the view inside `model_deadline`"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with model_deadline(seconds if seconds is not None else REQUEST_DEADLINE_SECONDS):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """Submits a task so that it runs with the caller's context variables (deadline etc.)"""
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
+
+_bookkeeping_executor = ThreadPoolExecutor(max_workers=BOOKKEEPING_WORKERS, thread_name_prefix="bookkeeping")
+
+def run_bookkeeping(task: str, fn, *args, **kwargs):
+    """
+    Runs a write the response does not depend on (records, uploads) off the
+    request thread. Failures are logged and counted, never raised.
+    """
+    def run():
+        with metrics.span(f"bookkeeping_{task}"):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Bookkeeping error ({task}): {str(e)}")
+                metrics.inc("pdf_assistant_bookkeeping_errors_total", task=task)
+    return submit_with_context(_bookkeeping_executor, run)
+
+@contextlib.contextmanager
+def request_stage(timings: dict, stage: str):
+    """Times a stage of the current request into `timings` (seconds) and pdf_assistant_stage_seconds"""
+    started = time.perf_counter()
+    try:
+        with metrics.span(stage):
+            yield
+    finally:
+        timings[stage] = round(time.perf_counter() - started, 4)
+
+# Aktif isteğin model çağrılarının şeridi ve istemcisi (adil sıralama için)
+_model_lane = contextvars.ContextVar("model_lane", default="interactive")
+_model_client_key = contextvars.ContextVar("model_client_key", default=None)
+
+@contextlib.contextmanager
+def model_lane(lane: str):
+    """Runs the model calls made inside the block in the given admission lane"""
+    token = _model_lane.set(lane)
+    try:
+        yield lane
+    finally:
+        _model_lane.reset(token)
+
+class Overloaded(Exception):
+    """Model work could not be admitted in time; the client should retry later"""
+
+    def __init__(self, lane: str, retry_after: int):
+        super().__init__(f"The server is busy ({lane}), please retry in {retry_after} seconds.")
+        self.lane = lane
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Admits model calls through priority lanes.
+
+    Every lane has its own concurrency limit and all lanes share a total
+    limit. Slots a lane reserves (its "reserved" setting) and does not use
+    stay free for it, so background lanes cannot fill the total. A free slot goes to the highest priority lane with waiters, and
+    within a lane to the client with the fewest running calls, then the one
+    waiting longest. A call that would wait longer than its lane allows (or
+    past the request deadline) is rejected with `Overloaded` right away
+    instead of holding a thread.
+    """
+
+    def __init__(self, total: int, lanes: dict):
+        self.total = total
+        self.lanes = lanes
+        self._condition = threading.Condition()
+        self._running = {lane: 0 for lane in lanes}
+        self._running_by_client = {}
+        self._waiting = []  # [(lane, client, sequence)]
+        self._sequence = 0
+        self._durations = {lane: deque(maxlen=100) for lane in lanes}
+        self.rejected = {lane: 0 for lane in lanes}
+
+    def _average_duration(self, lane: str) -> float:
+        durations = self._durations[lane]
+        return sum(durations) / len(durations) if durations else 1.0
+
+    def _expected_wait(self, lane: str) -> float:
+        """Rough wait for a new caller: callers ahead in the lane times the average call time per slot"""
+        ahead = sum(1 for waiter in self._waiting if self.lanes[waiter[0]]["priority"] <= self.lanes[lane]["priority"])
+        if self._has_capacity(lane) and not ahead:
+            return 0.0
+        return (ahead + 1) * self._average_duration(lane) / max(1, self.lanes[lane]["limit"])
+
+    def _has_capacity(self, lane: str) -> bool:
+        if self._running[lane] >= self.lanes[lane]["limit"]:
+            return False
+        # Reserved slots of other lanes that they do not use are not free for this one
+        held = sum(
+            max(0, settings.get("reserved", 0) - self._running[other])
+            for other, settings in self.lanes.items() if other != lane
+        )
+        return sum(self._running.values()) + held < self.total
+
+    def _is_next(self, waiter: tuple) -> bool:
+        eligible = [w for w in self._waiting if self._has_capacity(w[0])]
+        if not eligible:
+            return False
+        best = min(eligible, key=lambda w: (
+            self.lanes[w[0]]["priority"], self._running_by_client.get(w[1], 0), w[2]
+        ))
+        return best is waiter
+
+    def _reject(self, lane: str, expected_wait: float):
+        self.rejected[lane] += 1
+        metrics.inc("pdf_assistant_admission_rejected_total", lane=lane)
+        raise Overloaded(lane, max(1, math.ceil(expected_wait)))
+
+    def acquire(self, lane: str, client=None):
+        if lane not in self.lanes:
+            lane = "interactive"
+        max_wait = self.lanes[lane]["max_wait"]
+        deadline = _model_deadline.get()
+        if deadline is not None:
+            max_wait = min(max_wait, deadline - time.monotonic())
+
+        with self._condition:
+            expected_wait = self._expected_wait(lane)
+            if expected_wait > max_wait:
+                self._reject(lane, expected_wait)
+
+            self._sequence += 1
+            waiter = (lane, client, self._sequence)
+            self._waiting.append(waiter)
+            give_up_at = time.monotonic() + max(0.0, max_wait)
+            try:
+                while not self._is_next(waiter):
+                    remaining = give_up_at - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(lane, self._expected_wait(lane))
+                    self._condition.wait(remaining)
+                self._running[lane] += 1
+                self._running_by_client[client] = self._running_by_client.get(client, 0) + 1
+            finally:
+                self._waiting.remove(waiter)
+                self._condition.notify_all()
+        return lane
+
+    def release(self, lane: str, client=None, duration: float = None):
+        with self._condition:
+            self._running[lane] -= 1
+            self._running_by_client[client] -= 1
+            if not self._running_by_client[client]:
+                del self._running_by_client[client]
+            if duration is not None:
+                self._durations[lane].append(duration)
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, lane: str = None, client=None):
+        """Holds one slot of `lane` (the context lane by default) for the block"""
+        client = client if client is not None else _model_client_key.get()
+        lane = self.acquire(lane or _model_lane.get(), client)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(lane, client, time.monotonic() - started)
+
+    def snapshot(self) -> dict:
+        with self._condition:
+            return {
+                lane: {
+                    "running": self._running[lane],
+                    "waiting": sum(1 for waiter in self._waiting if waiter[0] == lane),
+                    "rejected": self.rejected[lane],
+                }
+                for lane in self.lanes
+            }
+
+admission = AdmissionController(ADMISSION_MAX_CONCURRENCY, ADMISSION_LANES)
+
+# Kullanıcıya 429 olarak dönen hatalar: kabul kontrolü reddi ve model kotası
+RATE_LIMIT_ERRORS = (Overloaded, google_exceptions.TooManyRequests)  # ResourceExhausted dahil
+
+def _collect_admission():
+    """Exposes running and waiting model calls per lane as gauges"""
+    lines = []
+    snapshot = admission.snapshot()
+    for field in ("running", "waiting"):
+        name = f"pdf_assistant_admission_{field}"
+        lines.append(f"# HELP {name} Model calls {field} per admission lane.")
+        lines.append(f"# TYPE {name} gauge")
+        for lane, values in snapshot.items():
+            lines.append(f'{name}{{lane="{lane}"}} {values[field]}')
+    return lines
+
+metrics.add_collector(_collect_admission)
+metrics.describe("pdf_assistant_admission_rejected_total", "counter", "Model calls rejected by admission control.")
+
+def session_client_id() -> str:
+    """Random id of the browser session, created on first use"""
+    if 'client_id' not in session:
+        session['client_id'] = uuid.uuid4().hex
+    return session['client_id']
+
+def with_model_lane(lane: str = None):
+    """
+    Route decorator that sets the admission lane and the client key of the
+    view's model calls. Without a lane, it follows the request mode:
+    generations run in the generation lane, everything else is interactive.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            request_lane = lane or ("generation" if _request_mode() in GENERATION_MODES else "interactive")
+            client_token = _model_client_key.set(session_client_id())
+            try:
+                with model_lane(request_lane):
+                    return view(*args, **kwargs)
+            finally:
+                _model_client_key.reset(client_token)
+        return wrapper
+    return decorator
+
+def overloaded_response(error: Exception):
+    """429 response for admission rejections and upstream rate limits"""
+    retry_after = getattr(error, "retry_after", None) or math.ceil(MODEL_BACKOFF_MAX)
+    response = jsonify({"success": False, "error": "The server is busy, please retry shortly.", "retry_after": retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+class ModelCallStats:
+    """
+    Thread-safe latency and token accounting for model calls, grouped by
+    (model name, call kind).
+    """
+
+    def __init__(self, window: int = 500):
+        """
+        Args:
+            window: Number of recent latencies kept per group for percentiles
+        """
+        self._lock = threading.Lock()
+        self._window = window
+        self._latencies = {}
+        self._totals = {}
+
+    def _group(self, model_name: str, kind: str) -> dict:
+        key = (model_name, kind)
+        if key not in self._totals:
+            self._latencies[key] = deque(maxlen=self._window)
+            self._totals[key] = {
+                "calls": 0, "errors": 0, "retries": 0, "hedges": 0,
+                "seconds": 0.0, "prompt_tokens": 0, "output_tokens": 0
+            }
+        return self._totals[key]
+
+    def record(self, model_name: str, kind: str, latency: float, response=None, error: Exception = None):
+        """Records one finished attempt, successful or not"""
+        usage = getattr(response, "usage_metadata", None) if response is not None else None
+        with self._lock:
+            totals = self._group(model_name, kind)
+            totals["calls"] += 1
+            totals["seconds"] += latency
+            if error is not None:
+                totals["errors"] += 1
+                return
+            self._latencies[(model_name, kind)].append(latency)
+            if usage is not None:
+                totals["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+                totals["output_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+
+    def record_retry(self, model_name: str, kind: str):
+        with self._lock:
+            self._group(model_name, kind)["retries"] += 1
+
+    def record_hedge(self, model_name: str, kind: str):
+        with self._lock:
+            self._group(model_name, kind)["hedges"] += 1
+
+    def percentile(self, model_name: str, kind: str, percent: float, min_samples: int = 1):
+        """Returns the given latency percentile in seconds, or None without enough samples"""
+        with self._lock:
+            samples = sorted(self._latencies.get((model_name, kind), ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        index = min(len(samples) - 1, int(round(percent / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self) -> dict:
+        """Returns totals and p50/p95/p99 latencies for every group"""
+        with self._lock:
+            groups = {key: (dict(totals), sorted(self._latencies[key])) for key, totals in self._totals.items()}
+
+        result = {}
+        for (model_name, kind), (totals, samples) in groups.items():
+            for percent in (50, 95, 99):
+                totals[f"p{percent}"] = (
+                    samples[min(len(samples) - 1, int(round(percent / 100.0 * (len(samples) - 1))))]
+                    if samples else None
+                )
+            result[f"{model_name}:{kind}"] = totals
+        return result
+
+# Tüm model çağrıları için ortak istatistikler ve hedge iş parçacıkları
+model_call_stats = ModelCallStats()
+
+def _collect_model_call_stats():
+    """Exposes model_call_stats totals as Prometheus counters"""
+    counters = {
+        "calls": ("pdf_assistant_model_calls_total", "Model call attempts."),
+        "errors": ("pdf_assistant_model_call_errors_total", "Failed model call attempts."),
+        "retries": ("pdf_assistant_model_call_retries_total", "Model call retries after a retryable error."),
+        "hedges": ("pdf_assistant_model_call_hedges_total", "Hedged second requests sent."),
+        "prompt_tokens": ("pdf_assistant_model_prompt_tokens_total", "Prompt tokens reported by the model."),
+        "output_tokens": ("pdf_assistant_model_output_tokens_total", "Output tokens reported by the model."),
+    }
+    snapshot = model_call_stats.snapshot()
+    lines = []
+    for field, (name, help_text) in counters.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for group, totals in snapshot.items():
+            model_name, kind = group.rsplit(":", 1)
+            lines.append(f'{name}{{kind="{kind}",model="{model_name}"}} {totals[field]}')
+    return lines
+
+metrics.add_collector(_collect_model_call_stats)
+_hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="model-hedge")
+
+class ModelClient:
+    """
+    Single entry point for model calls.
+
+    Every attempt gets a timeout bounded by the active `model_deadline`,
+    retryable errors are retried with exponential backoff and full jitter,
+    stateless calls can be hedged with a second request once they run longer
+    than the configured latency percentile, and latency and token usage are
+    recorded in `model_call_stats`.
+    """
+
+    RETRYABLE_ERRORS = (
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.BadGateway,
+        google_exceptions.GatewayTimeout,
+        google_exceptions.DeadlineExceeded,
+        ConnectionError,
+        TimeoutError,
+    )
+
+    def __init__(self, model, model_name: str, stats: ModelCallStats = None):
+        """
+        Args:
+            model: genai.GenerativeModel instance
+            model_name: Model name used for accounting
+            stats: Statistics collector, the shared one by default
+        """
+        self.model = model
+        self.model_name = model_name
+        self.stats = stats or model_call_stats
+
+    @classmethod
+    def is_retryable(cls, error: Exception) -> bool:
+        return isinstance(error, cls.RETRYABLE_ERRORS)
+
+    def generate(self, contents, generation_config: dict = None, hedge: bool = True, max_retries: int = None):
+        """Stateless generate_content call"""
+        def invoke(timeout):
+            return self.model.generate_content(
+                contents=contents,
+                generation_config=generation_config,
+                request_options={"timeout": timeout}
+            )
+        return self._call("generate", invoke, hedge=hedge, max_retries=max_retries)
+
+    def send_message(self, chat_session, contents, generation_config: dict = None, max_retries: int = None):
+        """
+        Sends a message in a chat session. Never hedged, because two parallel
+        messages would both be appended to the session history.
+        """
+        def invoke(timeout):
+            return chat_session.send_message(
+                contents,
+                generation_config=generation_config,
+                request_options={"timeout": timeout}
+            )
+        return self._call("chat", invoke, hedge=False, max_retries=max_retries)
+
+    def _attempt_timeout(self) -> float:
+        """Timeout of the next attempt; raises TimeoutError if the deadline has passed, Cancelled if the work was cancelled"""
+        cancel = _model_cancel.get()
+        if cancel is not None and cancel.is_set():
+            raise Cancelled("Model call cancelled.")
+        deadline = _model_deadline.get()
+        if deadline is None:
+            return MODEL_CALL_TIMEOUT
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Model call deadline exceeded.")
+        return min(MODEL_CALL_TIMEOUT, remaining)
+
+    def _call(self, kind: str, invoke, hedge: bool, max_retries: int = None):
+        max_retries = MODEL_MAX_RETRIES if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            self._attempt_timeout()
+            queued = time.monotonic()
+            started = None
+            try:
+                with admission.slot():
+                    # Latency stats (hedging, routing) cover the model call only, not the admission queue
+                    metrics.observe("pdf_assistant_admission_wait_seconds", time.monotonic() - queued,
+                                    lane=_model_lane.get())
+                    timeout = self._attempt_timeout()  # the deadline came closer while queued
+                    started = time.monotonic()
+                    if hedge and MODEL_HEDGE_PERCENTILE > 0:
+                        response = self._hedged(kind, invoke, timeout)
+                    else:
+                        response = invoke(timeout)
+            except Overloaded:
+                raise
+            except Exception as e:
+                if started is None:
+                    raise  # cancelled or out of time before reaching the model
+                latency = time.monotonic() - started
+                self.stats.record(self.model_name, kind, latency, error=e)
+                metrics.observe("pdf_assistant_model_call_seconds", latency,
+                                model=self.model_name, kind=kind, outcome="error")
+                if not self.is_retryable(e) or attempt >= max_retries:
+                    raise
+
+                # Exponential backoff with full jitter, never past the deadline
+                delay = random.uniform(0, min(MODEL_BACKOFF_MAX, MODEL_BACKOFF_BASE * (2 ** attempt)))
+                deadline = _model_deadline.get()
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    raise
+
+                attempt += 1
+                self.stats.record_retry(self.model_name, kind)
+                print(f"Model call error ({type(e).__name__}), retrying in {delay:.2f}s ({attempt}/{max_retries})...")
+                time.sleep(delay)
+                continue
+
+            latency = time.monotonic() - started
+            self.stats.record(self.model_name, kind, latency, response=response)
+            metrics.observe("pdf_assistant_model_call_seconds", latency,
+                            model=self.model_name, kind=kind, outcome="ok")
+            return response
+
+    def _hedged(self, kind: str, invoke, timeout: float):
+        """Starts a backup request if the primary one is slower than the hedge percentile"""
+        hedge_after = self.stats.percentile(self.model_name, kind, MODEL_HEDGE_PERCENTILE, MODEL_HEDGE_MIN_SAMPLES)
+        if hedge_after is None or hedge_after >= timeout:
+            return invoke(timeout)
+
+        primary = submit_with_context(_hedge_executor, invoke, timeout)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        self.stats.record_hedge(self.model_name, kind)
+        print(f"Model call slower than p{MODEL_HEDGE_PERCENTILE:g} ({hedge_after:.2f}s), sending hedged request...")
+        backup = submit_with_context(_hedge_executor, invoke, timeout - hedge_after)
+
+        # The first successful response wins; the other request is left to finish in the background
+        pending = {primary, backup}
+        ends_at = time.monotonic() + timeout
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0, ends_at - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError("Hedged model call timed out.")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+class ModelRouter:
+    """
+    Picks the model tier and output-token cap of every call and runs the
+    fallback cascade. Has the `generate` / `send_message` interface of
+    ModelClient plus the mode of the call.
+
+    A mode's route comes from MODEL_ROUTES; short chat questions over a
+    small context take the 'chat_short' route. Tiers whose context window is
+    too small are skipped. When the active deadline is nearer than a tier's
+    observed latency percentile, the next faster tier is chosen. If the
+    chosen tier fails with a transient error after ROUTE_PRIMARY_RETRIES,
+    the call moves on to the faster tiers in turn.
+    """
+
+    def __init__(self, profiles: dict = None, routes: dict = None, default_tier: str = None,
+                 stats: ModelCallStats = None):
+        """
+        Args:
+            profiles: Tier name -> {"model", "max_context_tokens", "temperature"}, fastest first
+            routes: Mode -> (tier, max output tokens)
+            default_tier: Tier of chat sessions, cache keys and unknown modes
+            stats: Statistics collector, the shared one by default
+        """
+        self.profiles = profiles or MODEL_PROFILES
+        self.routes = routes or MODEL_ROUTES
+        self.tiers = list(self.profiles)
+        self.default_tier = default_tier or MODEL_DEFAULT_TIER
+        if self.default_tier not in self.profiles:
+            self.default_tier = self.tiers[-1]
+        self.stats = stats or model_call_stats
+        self.clients = {}
+        for tier, profile in self.profiles.items():
+            model = genai.GenerativeModel(
+                profile["model"],
+                generation_config={
+                    "max_output_tokens": 8192,
+                    "temperature": profile.get("temperature", 0.4),
+                },
+                safety_settings=SAFETY_SETTINGS
+            )
+            self.clients[tier] = ModelClient(model, profile["model"], self.stats)
+        self.last_route = None
+
+    @property
+    def model(self):
+        """Model of the default tier"""
+        return self.clients[self.default_tier].model
+
+    @property
+    def model_name(self) -> str:
+        return self.clients[self.default_tier].model_name
+
+    def plan(self, mode: str, kind: str = "generate", prompt_chars: int = None, context_tokens: int = 0) -> tuple:
+        """
+        Routes one call.
+
+        Returns:
+            (tiers to try in order, max output tokens, reason of the first choice)
+        """
+        tier, max_output_tokens = self.routes.get(mode, (self.default_tier, 8192))
+        reason = "mode"
+        if (mode == "chat" and "chat_short" in self.routes and prompt_chars is not None
+                and prompt_chars <= ROUTE_SHORT_QUESTION_CHARS and context_tokens <= ROUTE_SHORT_CONTEXT_TOKENS):
+            tier, max_output_tokens = self.routes["chat_short"]
+            reason = "short"
+        if tier not in self.profiles:
+            tier = self.default_tier
+
+        def fits(name):
+            return context_tokens <= self.profiles[name].get("max_context_tokens", math.inf)
+
+        index = self.tiers.index(tier)
+        while index < len(self.tiers) - 1 and not fits(self.tiers[index]):
+            index += 1
+            reason = "context"
+
+        # Near the deadline, take the fastest tier expected to answer in time
+        deadline = _model_deadline.get()
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            while index > 0 and fits(self.tiers[index - 1]):
+                expected = self.stats.percentile(self.profiles[self.tiers[index]]["model"], kind,
+                                                 ROUTE_LATENCY_PERCENTILE, ROUTE_LATENCY_MIN_SAMPLES)
+                if expected is None or expected <= remaining:
+                    break
+                index -= 1
+                reason = "deadline"
+
+        cascade = [name for name in reversed(self.tiers[:index + 1]) if fits(name)]
+        if not cascade:
+            # No window takes the whole context: try the largest, the model reports if it is too long
+            cascade = [max(self.tiers, key=lambda name: self.profiles[name].get("max_context_tokens", math.inf))]
+            reason = "context"
+        return cascade, max_output_tokens, reason
+
+    def _run(self, mode: str, kind: str, prompt_chars: int, context_tokens: int, generation_config: dict, call):
+        cascade, max_output_tokens, reason = self.plan(mode, kind, prompt_chars, context_tokens)
+        config = {"max_output_tokens": max_output_tokens, **(generation_config or {})}
+        metrics.inc("pdf_assistant_model_routes_total", mode=mode, tier=cascade[0], reason=reason)
+        for position, tier in enumerate(cascade):
+            last = position == len(cascade) - 1
+            try:
+                response = call(self.clients[tier], config, None if last else ROUTE_PRIMARY_RETRIES)
+            except Overloaded:
+                raise
+            except Exception as e:
+                if last or not ModelClient.is_retryable(e):
+                    raise
+                metrics.inc("pdf_assistant_model_fallbacks_total", mode=mode, tier=tier,
+                            to_tier=cascade[position + 1], error=type(e).__name__)
+                print(f"Model tier {tier} failed ({type(e).__name__}), falling back to {cascade[position + 1]}...")
+                continue
+            self.last_route = {
+                "mode": mode,
+                "tier": tier,
+                "model": self.clients[tier].model_name,
+                "reason": reason if position == 0 else "fallback",
+                "max_output_tokens": max_output_tokens,
+            }
+            return response
+
+    def generate(self, contents, generation_config: dict = None, hedge: bool = True, mode: str = "chat",
+                 prompt_chars: int = None, context_tokens: int = 0):
+        """Stateless call on the routed tier"""
+        return self._run(
+            mode, "generate", prompt_chars, context_tokens, generation_config,
+            lambda client, config, retries: client.generate(contents, config, hedge=hedge, max_retries=retries)
+        )
+
+    def send_message(self, chat_session, contents, generation_config: dict = None, mode: str = "chat",
+                     prompt_chars: int = None, context_tokens: int = 0):
+        """
+        Chat message on the routed tier. Another tier's model continues the
+        conversation from the session's history, and the session gets the
+        new turn.
+        """
+        def call(client, config, retries):
+            if getattr(chat_session, "model", None) is client.model:
+                return client.send_message(chat_session, contents, config, max_retries=retries)
+            tier_session = client.model.start_chat(history=chat_session.history)
+            response = client.send_message(tier_session, contents, config, max_retries=retries)
+            chat_session.history = tier_session.history
+            return response
+        return self._run(mode, "chat", prompt_chars, context_tokens, generation_config, call)
+
+metrics.describe("pdf_assistant_model_routes_total", "counter", "Model calls by mode, chosen tier and routing reason.")
+metrics.describe("pdf_assistant_model_fallbacks_total", "counter", "Model calls that fell back from a failing tier to a faster one.")
 
 class InteractivePDFAssistant:
     """
@@ -60,40 +2633,24 @@ class InteractivePDFAssistant:
         # Configure API
         genai.configure(api_key=api_key)
         
-        # Model selection - use the latest and fastest model
-        self.model_name = "gemini-1.5-flash"
-        self.model = genai.GenerativeModel(
-            self.model_name,
-            generation_config={
-                "max_output_tokens": 8192,
-                "temperature": 0.4,
-            },
-            safety_settings=[
-                {
-                    "category": "HARM_CATEGORY_HARASSMENT",
-                    "threshold": "BLOCK_NONE"
-                },
-                {
-                    "category": "HARM_CATEGORY_HATE_SPEECH",
-                    "threshold": "BLOCK_NONE"
-                },
-                {
-                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                    "threshold": "BLOCK_NONE"
-                },
-                {
-                    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                    "threshold": "BLOCK_NONE"
-                }
-            ]
-        )
+        # Model tiers; every call is routed by mode (see MODEL_ROUTES)
+        self.model_client = ModelRouter()
+        self.model = self.model_client.model
+        self.model_name = self.model_client.model_name
         
         # Current PDF and content
         self.current_pdf_id = None
         self.current_pdf_filename = None
-        self.pdf_text = ""
+        self.page_texts = []
         self.pdf_raw_bytes = None
+        self.pdf_version = None
+        self.page_hashes = []
+        self.document = None
+        self.image_index = []
+        self.payload_class = None
         self.pdf_title = ""
+        self.last_context_report = None
+        self.last_quiz_questions = None
         
         # Chat history and context
         self.chat_session = None
@@ -108,269 +2665,476 @@ class InteractivePDFAssistant:
         )
         print("New chat session started.")
     
-    def _truncate_pdf_for_api(self, pdf_bytes, max_size_mb=10):
-        """Truncates PDF to appropriate size for API"""
-        max_size_bytes = max_size_mb * 1024 * 1024  # MB to bytes
-        
-        if len(pdf_bytes) <= max_size_bytes:
-            return pdf_bytes
-        
-        print(f"PDF size ({len(pdf_bytes)/1024/1024:.2f} MB) is too large, truncating...")
-        
+    @property
+    def pdf_text(self) -> str:
+        """Full text of the PDF with page markers, built on demand"""
+        return "".join(f"\n--- Page {i+1} ---\n{page_text}\n" for i, page_text in enumerate(self.page_texts))
+
+    def _document_version(self) -> str:
+        """Version hash of the loaded PDF"""
+        if not getattr(self, "pdf_version", None):
+            self.pdf_version = document_version(self.pdf_raw_bytes)
+        return self.pdf_version
+
+    def _page_costs(self) -> list:
+        """Per-page (tokens, bytes, text_tokens), cached per document version"""
+        return get_page_costs(self._document_version(), self.pdf_raw_bytes, getattr(self, "page_texts", None))
+
+    def detached(self) -> "InteractivePDFAssistant":
+        """
+        A copy for background work outside the conversation lock. It shares
+        the loaded document and the models, but its context reports and
+        routes are its own, so it never changes what a running turn reports.
+        """
+        twin = copy.copy(self)
+        twin.model_client = copy.copy(self.model_client)
+        return twin
+
+    def _history_tokens(self) -> int:
+        """Estimated tokens of the chat history sent with every message, inline documents and images included"""
+        history = self.chat_session.history if self.chat_session is not None else self.chat_history
+        chars = tokens = 0
+        for message in history or []:
+            parts = message.get("parts", []) if isinstance(message, dict) else getattr(message, "parts", [])
+            for part in parts:
+                if isinstance(part, str):
+                    chars += len(part)
+                elif isinstance(part, dict):
+                    chars += len(part.get("text") or "")
+                    if part.get("data"):
+                        tokens += blob_tokens(part.get("mime_type"), part["data"])
+                else:
+                    chars += len(getattr(part, "text", "") or "")
+                    blob = getattr(part, "inline_data", None)
+                    if blob is not None and blob.data:
+                        tokens += blob_tokens(blob.mime_type, blob.data)
+        return tokens + chars // CHARS_PER_TOKEN
+
+    def _drop_document_parts(self, turn: int, prompt: str):
+        """
+        Keeps only the prompt of the user message at `turn` in the chat
+        history. The document context is fitted again for every question,
+        so the copy sent with a turn would otherwise travel with every later
+        message of the conversation.
+        """
+        history = list(self.chat_session.history)
+        for index in range(turn, len(history)):
+            message = history[index]
+            role = message.get("role") if isinstance(message, dict) else getattr(message, "role", None)
+            if role == "user":
+                history[index] = {"role": "user", "parts": [prompt]}
+                self.chat_session.history = history
+                return
+
+    def _figure_heavy(self) -> bool:
+        """True if images make up most of the PDF; such documents are sent without them"""
+        return bool(self.image_index) and image_share(self.image_index, len(self.pdf_raw_bytes)) >= IMAGE_CONTEXT_MIN_SHARE
+
+    def _text_payload(self, first: int, last: int) -> tuple:
+        """
+        Whether pages first..last (0-based, inclusive) go to the model as
+        extracted text instead of PDF, and why.
+
+        Returns:
+            (True or False, reason)
+        """
+        if not PAYLOAD_TEXT_FIRST:
+            return False, "disabled"
+        if not self.payload_class:
+            return False, "unclassified"
+        if self.payload_class["kind"] != "text":
+            return False, self.payload_class["kind"]
+        # Poor extraction (unmapped fonts, scanned pages) would lose content the PDF still has
+        if self.payload_class["text_quality"] < PAYLOAD_TEXT_MIN_QUALITY:
+            return False, "low_text_quality"
+        if any(first + 1 <= page <= last + 1 for page in self.payload_class["weak_pages"]):
+            return False, "weak_pages"
+        return True, "text"
+
+    def _payload_costs(self, page_range: tuple = None) -> list:
+        """Per-page costs of the payload _fit_context sends for `page_range` (1-based), text or PDF"""
+        costs = self._page_costs()
+        first, last = page_range or (1, len(costs))
+        if self._text_payload(first - 1, last - 1)[0]:
+            return [
+                (text_tokens + PAYLOAD_PAGE_MARKER_TOKENS, text_tokens * CHARS_PER_TOKEN, text_tokens)
+                for _, _, text_tokens in costs
+            ]
+        return costs
+
+    def _source_pdf(self, strip_images: bool = False) -> bytes:
+        """The loaded PDF, or its image-free copy"""
+        if strip_images:
+            return get_image_free_pdf(self._document_version(), self.pdf_raw_bytes)
+        return self.pdf_raw_bytes
+
+    def _build_subdocument(self, first_page: int, last_page: int, strip_images: bool = False) -> bytes:
+        """Builds (or returns the cached) PDF made of pages first_page..last_page (0-based, inclusive)"""
+        key = (self._document_version(), first_page, last_page) + (("no-images",) if strip_images else ())
+        data = _subdocument_cache.get(key)
+        metrics.cache("subdocument", data is not None)
+        if data is None:
+            with metrics.span("build_subdocument"):
+                doc = fitz.open(stream=self._source_pdf(strip_images), filetype="pdf")
+                sub_doc = fitz.open()
+                try:
+                    sub_doc.insert_pdf(doc, from_page=first_page, to_page=last_page)
+                    data = sub_doc.tobytes(garbage=3, deflate=True)
+                finally:
+                    sub_doc.close()
+                    doc.close()
+            _subdocument_cache.put(key, data)
+        return data
+
+    @metrics.timed("fit_context")
+    def _fit_context(self, mode: str, extra_tokens: int = 0, page_range: tuple = None,
+                     strip_images: bool = False) -> list:
+        """
+        Selects the part of the document sent to the model for `mode`.
+
+        Text documents are sent as their extracted page texts (see
+        _text_payload). Otherwise pages are taken in order and sent as PDF
+        while they fit in the token budget of the mode (minus output, history
+        and `extra_tokens`) and in API_PAYLOAD_MAX_MB. Any budget left is
+        filled with the extracted text of the following pages. A coverage
+        report is kept in `self.last_context_report`.
+
+        Args:
+            mode: Key of CONTEXT_TOKEN_BUDGETS
+            extra_tokens: Tokens already used by the rest of the request
+            page_range: Optional (first, last) page numbers, 1-based and inclusive
+            strip_images: Send the pages without their images (see select_image_parts)
+
+        Returns:
+            Content parts describing the document
+        """
+        budget = CONTEXT_TOKEN_BUDGETS.get(mode, CONTEXT_TOKEN_BUDGETS["chat"]) - OUTPUT_TOKEN_RESERVE - extra_tokens
+        if mode == "chat":
+            budget -= max(CONTEXT_HISTORY_RESERVE, self._history_tokens())
+        max_bytes = int(API_PAYLOAD_MAX_MB * 1024 * 1024)
+
+        all_costs = self._page_costs()
+        if strip_images:
+            # Images no longer travel with the pages: only their bytes are saved, the
+            # fixed per-page token cost stays
+            image_bytes = {}
+            for entry in self.image_index:
+                image_bytes[entry["page"]] = image_bytes.get(entry["page"], 0) + entry["bytes"]
+            all_costs = [
+                (tokens, max(0, size - image_bytes.get(index + 1, 0)), text_tokens)
+                for index, (tokens, size, text_tokens) in enumerate(all_costs)
+            ]
+        first = 0
+        last = len(all_costs) - 1
+        if page_range is not None:
+            first = max(0, page_range[0] - 1)
+            last = min(last, page_range[1] - 1)
+        whole_document = first == 0 and last == len(all_costs) - 1
+        text_payload, payload_reason = self._text_payload(first, last)
+        if text_payload:
+            return self._fit_text_context(mode, budget, all_costs, first, last)
+        metrics.inc("pdf_assistant_payloads_total", payload="pdf", reason=payload_reason)
+        costs = all_costs[first:last + 1]
+        total_tokens = sum(cost[0] for cost in costs)
+
+        # The requested pages fit: send them unchanged
+        if total_tokens <= budget:
+            pdf_bytes = self._source_pdf(strip_images) if whole_document else self._build_subdocument(first, last, strip_images)
+            if len(pdf_bytes) <= max_bytes:
+                self.last_context_report = self._context_report(
+                    mode, budget, all_costs, first, last, len(costs), 0, total_tokens,
+                    payload="pdf", payload_reason=payload_reason
+                )
+                return self._document_parts(pdf_bytes, first, len(costs), whole_document, [])
+
+        # Pages as PDF while both the token and the byte budget allow (at least one page)
+        pdf_pages = used_tokens = used_bytes = 0
+        for tokens, size, _ in costs:
+            if pdf_pages and (used_tokens + tokens > budget or used_bytes + size > max_bytes):
+                break
+            pdf_pages += 1
+            used_tokens += tokens
+            used_bytes += size
+
+        pdf_bytes = self._build_subdocument(first, first + pdf_pages - 1, strip_images)
+        # Size estimate was too low (shared resources, fonts): shrink until it fits
+        while len(pdf_bytes) > max_bytes and pdf_pages > 1:
+            pdf_pages = max(1, min(pdf_pages - 1, int(pdf_pages * max_bytes / len(pdf_bytes))))
+            pdf_bytes = self._build_subdocument(first, first + pdf_pages - 1, strip_images)
+        used_tokens = sum(cost[0] for cost in costs[:pdf_pages])
+
+        # Fill the rest of the budget with the text of the following pages
+        page_texts = getattr(self, "page_texts", [])
+        text_blocks = []
+        for index in range(first + pdf_pages, min(last + 1, len(page_texts))):
+            text_tokens = all_costs[index][2] + PAYLOAD_PAGE_MARKER_TOKENS
+            if used_tokens + text_tokens > budget:
+                break
+            text_blocks.append(f"\n--- Page {index + 1} ---\n{page_texts[index]}\n")
+            used_tokens += text_tokens
+
+        self.last_context_report = self._context_report(
+            mode, budget, all_costs, first, last, pdf_pages, len(text_blocks), used_tokens,
+            payload="pdf", payload_reason=payload_reason
+        )
+        print(f"Context ({mode}): {pdf_pages} pages as PDF, {len(text_blocks)} as text, "
+              f"of pages {first + 1}-{last + 1} ({used_tokens}/{budget} tokens).")
+
+        return self._document_parts(pdf_bytes, first, pdf_pages, False, text_blocks)
+
+    def _fit_text_context(self, mode: str, budget: int, costs: list, first: int, last: int) -> list:
+        """
+        Text-first payload: the extracted texts of pages first..last with page
+        markers, as many as fit in `budget`, instead of the PDF. The bytes
+        and tokens saved against sending the same pages as PDF are recorded.
+        """
+        text_blocks = []
+        used_tokens = 0
+        for index in range(first, last + 1):
+            text_tokens = costs[index][2] + PAYLOAD_PAGE_MARKER_TOKENS
+            if text_blocks and used_tokens + text_tokens > budget:
+                break
+            text_blocks.append(f"\n--- Page {index + 1} ---\n{self.page_texts[index]}\n")
+            used_tokens += text_tokens
+        text = "".join(text_blocks)
+        sent = costs[first:first + len(text_blocks)]
+
+        # The file size, shared out by the page sizes for a part of the document
+        page_bytes = sum(cost[1] for cost in costs)
+        pdf_bytes = len(self.pdf_raw_bytes) * sum(cost[1] for cost in sent) // page_bytes if page_bytes else 0
+        saved_bytes = max(0, pdf_bytes - len(text.encode("utf-8")))
+        saved_tokens = max(0, sum(cost[0] for cost in sent) - used_tokens)
+        metrics.inc("pdf_assistant_payloads_total", payload="text", reason="text")
+        metrics.inc("pdf_assistant_payload_saved_bytes_total", saved_bytes)
+        metrics.inc("pdf_assistant_payload_saved_tokens_total", saved_tokens)
+        self.last_context_report = self._context_report(
+            mode, budget, costs, first, last, 0, len(text_blocks), used_tokens,
+            payload="text", payload_reason="text", saved_bytes=saved_bytes, saved_tokens=saved_tokens
+        )
+        print(f"Context ({mode}): {len(text_blocks)} pages as text of pages {first + 1}-{last + 1} "
+              f"({used_tokens}/{budget} tokens, {saved_bytes} bytes saved).")
+
+        return [
+            f"The document is given as the extracted text of pages {first + 1}-{first + len(text_blocks)} "
+            f"of {len(costs)}; the page markers show the original page numbers, use them when referring to pages."
+            f"\n{text}"
+        ]
+
+    @staticmethod
+    def _document_parts(pdf_bytes: bytes, first: int, pdf_pages: int, whole_document: bool, text_blocks: list) -> list:
+        """Content parts for a PDF excerpt plus optional text of later pages"""
+        parts = [{"mime_type": "application/pdf", "data": pdf_bytes}]
+        if whole_document:
+            return parts
+
+        note = (
+            f"The PDF above contains pages {first + 1}-{first + pdf_pages} of the original document; "
+            f"use the original page numbers when referring to pages."
+        )
+        if text_blocks:
+            note += "\nExtracted text of the following pages:\n" + "".join(text_blocks)
+        parts.append(note)
+        return parts
+
+    @staticmethod
+    def _context_report(mode, budget, costs, first, last, pdf_pages, text_pages, used_tokens, **payload) -> dict:
+        """How much of the document (or of the requested pages) a request includes, and in which payload"""
+        range_pages = last - first + 1
+        return {
+            "mode": mode,
+            "total_pages": len(costs),
+            "page_range": [first + 1, last + 1],
+            "pdf_pages": pdf_pages,
+            "text_pages": text_pages,
+            "page_coverage": round((pdf_pages + text_pages) / range_pages, 4) if range_pages > 0 else 1.0,
+            "tokens": used_tokens,
+            "token_budget": budget,
+            "document_tokens": sum(cost[0] for cost in costs[first:last + 1]),
+            **payload,
+        }
+
+    def resolve_page_range(self, pages=None, chapter=None):
+        """
+        Turns the 'pages' or 'chapter' argument of a request into a page range.
+
+        Args:
+            pages: "40-55", "7", or a [first, last] list
+            chapter: Chapter number or part of a chapter title from the PDF outline
+
+        Returns:
+            (first, last) 1-based and inclusive, or None for the whole document
+
+        Raises:
+            ValueError: If the argument is invalid or outside the document
+        """
+        if chapter not in (None, ""):
+            page_range = self._chapter_page_range(str(chapter).strip())
+        elif pages not in (None, ""):
+            page_range = parse_page_range(pages)
+        else:
+            return None
+
+        total_pages = len(self.page_texts)
+        if page_range[0] > total_pages:
+            raise ValueError(f"The PDF has {total_pages} pages.")
+        return (page_range[0], min(page_range[1], total_pages))
+
+    def _chapter_page_range(self, chapter: str) -> tuple:
+        """Finds the pages of a chapter in the PDF outline (table of contents)"""
+        doc = fitz.open(stream=self.pdf_raw_bytes, filetype="pdf")
         try:
-            # Write PDF to temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                temp_file.write(pdf_bytes)
-                temp_path = temp_file.name
-            
-            # Open PDF with PyMuPDF
-            doc = fitz.open(temp_path)
-            
-            # Create a new PDF with first pages
-            new_doc = fitz.open()
-            
-            # Add pages one by one checking the size
-            for i in range(min(10, len(doc))):  # Maximum 10 pages
-                new_doc.insert_pdf(doc, from_page=i, to_page=i)
-                
-                # Check the size of the new PDF
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as check_file:
-                    new_doc.save(check_file.name)
-                    check_file.flush()
-                    current_size = os.path.getsize(check_file.name)
-                
-                # If size limit exceeded, remove the last page and exit loop
-                if current_size > max_size_bytes:
-                    if i > 0:  # At least keep one page
-                        new_doc.delete_page(i)
-                    break
+            toc = doc.get_toc(simple=True)
+            total_pages = len(doc)
+        finally:
+            doc.close()
+
+        if not toc:
+            raise ValueError("The PDF has no table of contents, use a page range instead.")
+
+        top_level = min(level for level, _, _ in toc)
+        chapters = [entry for entry in toc if entry[0] == top_level]
+        match = None
+        if chapter.isdigit():
+            pattern = re.compile(rf"^\W*(chapter|bölüm|unit|ünite|part|kısım)?\s*{int(chapter)}\b", re.IGNORECASE)
+            match = next((entry for entry in toc if pattern.match(entry[1])), None)
+            if match is None and 0 < int(chapter) <= len(chapters):
+                match = chapters[int(chapter) - 1]
+        else:
+            match = next((entry for entry in toc if chapter.lower() in entry[1].lower()), None)
+
+        if match is None or match[2] < 1:
+            raise ValueError(f"Chapter not found: {chapter}")
+
+        # The chapter ends where the next entry of the same or a higher level starts
+        position = toc.index(match)
+        last_page = total_pages
+        for level, _, page in toc[position + 1:]:
+            if level <= match[0] and page >= match[2]:
+                last_page = max(match[2], page - 1)
+                break
+        return (match[2], last_page)
+
+    def _generation_key(self, mode: str, params: dict, page_range: tuple = None) -> str:
+        """Cache key of a generation over the given pages (all pages if no range)"""
+        if self.page_hashes and len(self.page_hashes) == len(self.page_texts):
+            first, last = page_range or (1, len(self.page_hashes))
+            page_keys = self.page_hashes[first - 1:last]
+        else:
+            page_keys = [self._document_version(), page_range]
+        return generation_key(mode, params, page_keys, self.model_client.model_name)
+
+    @staticmethod
+    def _scope_text(page_range) -> str:
+        """Describes the requested part of the document in prompts"""
+        if page_range is None:
+            return "this PDF document"
+        return f"pages {page_range[0]}-{page_range[1]} of this PDF document"
+
+    def load_pdf_from_supabase(self, pdf_id: str, filename: str, bucket_name: str = "pdfs") -> bool:
+        """
+        Loads a PDF file from Supabase and extracts its content.
+        
+        Args:
+            pdf_id: ID of the PDF file
+            filename: Name of the PDF file
+            bucket_name: Supabase bucket name
             
-            # Save the new PDF as byte array
-            output_stream = io.BytesIO()
-            new_doc.save(output_stream)
-            truncated_pdf = output_stream.getvalue()
+        Returns:
+            True if loading successful, False otherwise
+        """
+        try:
+            print(f"PDF loading: {filename} (ID: {pdf_id})")
             
-            # Close files and clean up
-            new_doc.close()
-            doc.close()
-            os.unlink(temp_path)
+            # PDF information to save
+            self.current_pdf_id = pdf_id
+            self.current_pdf_filename = filename
+            self.pdf_title = filename
             
-            print(f"PDF truncated to {len(truncated_pdf)/1024/1024:.2f} MB.")
-            return truncated_pdf
+            # Download PDF from Supabase as byte array, unless a load or the warm-up kept this version
+            pdf_bytes, storage_entry = download_pdf_from_storage(
+                filename, bucket_name, cached_file=lambda entry: cached_pdf_bytes(pdf_id, entry)
+            )
+            print(f"PDF content ready, {len(pdf_bytes)} byte.")
+            return self.load_pdf_bytes(pdf_id, filename, pdf_bytes, storage_fingerprint(storage_entry))
             
         except Exception as e:
-            print(f"PDF truncation error: {str(e)}")
-            # Return original PDF in case of error, API may still reject it
-            return pdf_bytes
+            error_msg = f"PDF loading error: {str(e)}"
+            print(error_msg)
+            return False
     
-    def load_pdf_from_supabase(self, pdf_id: str, filename: str, bucket_name: str = "pdfs") -> bool:
+    def load_pdf_bytes(self, pdf_id: str, filename: str, pdf_bytes: bytes, fingerprint: str = None) -> bool:
         """
-        Loads a PDF file from Supabase and extracts its content.
+        Loads an already downloaded PDF: extracts its content (reusing the
+        artifacts of earlier loads) and starts a new chat about it.
         
         Args:
             pdf_id: ID of the PDF file
             filename: Name of the PDF file
-            bucket_name: Supabase bucket name
+            pdf_bytes: Content of the PDF file
+            fingerprint: Storage fingerprint of the file, if known
             
         Returns:
             True if loading successful, False otherwise
         """
         try:
-            print(f"PDF loading: {filename} (ID: {pdf_id})")
-            
-            # PDF information to save
             self.current_pdf_id = pdf_id
             self.current_pdf_filename = filename
             self.pdf_title = filename
+            self.pdf_version = document_version(pdf_bytes)
+            # Conversations about the same version share one copy of the file
+            self.pdf_raw_bytes = _pdf_cache.get(self.pdf_version) or pdf_bytes
+            self.storage_fingerprint = fingerprint
             
-            # Extract filename (full path may be provided)
-            if "/" in filename:
-                filename = filename.split("/")[-1]
-                print(f"Filename extracted: {filename}")
+            # The downloaded bytes are the only copy of the file; every step below
+            # opens them in place (fitz stream) instead of writing temporary files.
             
-            # Extract timestamp from filename if exists (e.g., 1709123456_file.pdf -> file.pdf)
-            if '_' in filename and filename.split('_')[0].isdigit():
-                parts = filename.split('_', 1)
-                if len(parts) > 1:
-                    clean_filename = parts[1]
-                else:
-                    clean_filename = filename
-            else:
-                clean_filename = filename
-                
-            print(f"Cleaned filename: {clean_filename}")
+            # Extract PDF text, page texts are saved separately. Pages that did not
+            # change since the last ingested version of this document are reused.
+            self.page_texts, self.page_hashes, _ = ingest_page_texts(
+                self.pdf_raw_bytes, self.pdf_version, previous_document_version(pdf_id)
+            )
+            # Share the extracted text with multi-document questions
+            document = remember_document(pdf_id, self.current_pdf_filename, self.pdf_version,
+                                         self.page_texts, self.storage_fingerprint, self.page_hashes)
+            self.page_texts = document.page_texts  # compressed, shared with the document cache
+            self.document = document
             
-            # List all files in the bucket
-            try:
-                print(f"Listing files from '{bucket_name}' bucket...")
-                storage_files = supabase.storage.from_(bucket_name).list()
-                print(f"Bucket '{bucket_name}' has {len(storage_files)} files.")
-                
-                # List file names and paths
-                storage_file_names = [f["name"] for f in storage_files]
-                print(f"Files in bucket: {storage_file_names}")
-                
-                # If no files, check the bucket
-                if not storage_file_names or (len(storage_file_names) == 1 and storage_file_names[0] == '.emptyFolderPlaceholder'):
-                    print(f"Bucket empty or only placeholder file. Check '{bucket_name}' bucket.")
-                    
-                    # Check the bucket
-                    buckets = supabase.storage.list_buckets()
-                    bucket_names = [bucket.name for bucket in buckets]
-                    if bucket_name not in bucket_names:
-                        print(f"'{bucket_name}' bucket not found!")
-                        return False
-                
-                # Directly download PDF from Supabase as byte array
-                file_found = False
-                pdf_filename = None
-                
-                # 1. First exact match search (filename and clean_filename)
-                if filename in storage_file_names:
-                    print(f"Exact filename found: {filename}")
-                    pdf_filename = filename
-                    file_found = True
-                elif clean_filename in storage_file_names:
-                    print(f"Exact filename found: {clean_filename}")
-                    pdf_filename = clean_filename
-                    file_found = True
-                # 2. Partial match search
-                else:
-                    for storage_filename in storage_file_names:
-                        if storage_filename.lower().endswith('.pdf') and (filename in storage_filename or clean_filename in storage_filename):
-                            print(f"Partial match found: {storage_filename}")
-                            pdf_filename = storage_filename
-                            file_found = True
-                            break
-                    
-                    # 3. Any PDF search
-                    if not file_found:
-                        print("Exact match not found, searching for any PDF...")
-                        for storage_filename in storage_file_names:
-                            if storage_filename.lower().endswith('.pdf') and storage_filename != '.emptyFolderPlaceholder':
-                                print(f"Alternative PDF found: {storage_filename}")
-                                pdf_filename = storage_filename
-                                file_found = True
-                                break
-                
-                # File found?
-                if file_found and pdf_filename:
-                    # Download the file
-                    print(f"'{pdf_filename}' downloading...")
-                    self.pdf_raw_bytes = supabase.storage.from_(bucket_name).download(pdf_filename)
-                    print(f"PDF content downloaded, size: {len(self.pdf_raw_bytes)} byte.")
-                else:
-                    print(f"File not found. Bucket: {bucket_name}, Searched: {filename} / {clean_filename}")
-                    
-                    # Suggest using test_bucket.py to upload PDF
-                    pdf_test_path = "test_bucket.py"
-                    if os.path.exists(pdf_test_path):
-                        print(f"You can use '{pdf_test_path}' to upload PDF.")
-                    
-                    raise Exception(f"PDF file not found: {filename}")
-                
-            except Exception as e:
-                print(f"Supabase storage listing/download error: {str(e)}")
-                traceback_str = traceback.format_exc()
-                print(f"Error details: {traceback_str}")
-                raise e
+            # Keep the file for page previews and render the first pages
+            remember_pdf_bytes(self.pdf_version, self.pdf_raw_bytes)
+            prerender_pages(document)
             
-            if not self.pdf_raw_bytes:
-                print("PDF content is empty.")
-                raise Exception("PDF content not downloaded from Supabase.")
+            # List images and index them for question-time selection
+            self.extract_images_from_bytes(self.pdf_raw_bytes)
+            self.image_index = get_image_index(self.pdf_version, self.pdf_raw_bytes)
+            self.payload_class = get_payload_class(self.pdf_version, self.page_texts, self.image_index,
+                                                   len(self.pdf_raw_bytes))
             
-            print(f"PDF content downloaded successfully, {len(self.pdf_raw_bytes)} byte.")
+            # Reset chat history for new PDF
+            self.chat_history = []
+            self.create_chat_session()
             
-            # Write PDF content to temporary file
-            temp_path = None
-            try:
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    temp_file.write(self.pdf_raw_bytes)
-                    temp_path = temp_file.name
-                
-                # Extract PDF text
-                # Extract PDF content as text
-                reader = PdfReader(io.BytesIO(self.pdf_raw_bytes))
-                
-                # Save page count and text
-                self.pdf_text = ""
-                self.page_texts = []  # Save page texts separately
-                
-                for i, page in enumerate(reader.pages):
-                    page_text = page.extract_text()
-                    self.pdf_text += f"\n--- Page {i+1} ---\n{page_text}\n"
-                    self.page_texts.append(page_text)
-                
-                # Extract images
-                self.extract_images_from_bytes(temp_path)
-                
-                # Reset chat history for new PDF
-                self.chat_history = []
-                self.create_chat_session()
-                
-                # Truncate PDF for API
-                api_pdf_bytes = self._truncate_pdf_for_api(self.pdf_raw_bytes)
-                
-                # Get general information about the PDF for model
-                self._analyze_pdf_content(api_pdf_bytes)
-                
-                return True
-                
-            except Exception as e:
-                raise e
-                
-            finally:
-                # Clean up temporary file
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.unlink(temp_path)
-                    except Exception as cleanup_error:
-                        print(f"Error cleaning up temporary file: {str(cleanup_error)}")
+            # Get general information about the PDF for model
+            self._analyze_pdf_content()
+            
+            return True
             
         except Exception as e:
             error_msg = f"PDF loading error: {str(e)}"
             print(error_msg)
             return False
     
-    def extract_images_from_bytes(self, temp_pdf_path: str):
-        """Extracts images from PDF"""
+    @metrics.timed("extract_images")
+    def extract_images_from_bytes(self, pdf_bytes: bytes):
+        """
+        Lists the images of every page. Image data stays in the PDF buffer
+        and is only decoded when `get_page_image` asks for it.
+        """
         try:
-            # Open PDF with PyMuPDF
-            self.pdf_doc = fitz.open(temp_pdf_path)
-            
-            # Create list of images for each page
-            self.page_images = []
-            
-            for page_index in range(len(self.pdf_doc)):
-                page = self.pdf_doc[page_index]
-                
-                # Extract images from the page
-                page_images = []
-                
-                # Find all image references in the page
-                image_list = page.get_images(full=True)
-                
-                # For each image
-                for img_index, img_info in enumerate(image_list):
-                    # Extract image from PDF
-                    xref = img_info[0]
-                    base_image = self.pdf_doc.extract_image(xref)
-                    image_bytes = base_image["image"]
-                    
-                    # Load image as PIL Image
-                    image = Image.open(io.BytesIO(image_bytes))
-                    
-                    # Add image to list (page number, image index, PIL Image)
-                    page_images.append((page_index, img_index, image))
-                
-                # Add page images to main list
-                if page_images:
-                    self.page_images.append(page_images)
-                else:
-                    self.page_images.append([])
-                
-            # Close the file
-            self.pdf_doc.close()
+            # (page number, image index, xref) for each page
+            if self.pdf_version:
+                self.page_images = get_image_manifest(self.pdf_version, pdf_bytes)
+            else:
+                self.page_images = list_page_images(pdf_bytes)
             
             print(f"Extracted {sum(len(images) for images in self.page_images)} images from PDF.")
             return True
@@ -380,7 +3144,118 @@ class InteractivePDFAssistant:
             print(error_msg)
             return False
     
-    def _analyze_pdf_content(self, pdf_bytes=None):
+    def _image_part(self, xref: int) -> dict:
+        """One PDF image as a downscaled JPEG content part, cached with the page renders"""
+        key = (self._document_version(), "image", xref, IMAGE_CONTEXT_MAX_SIDE)
+        data = _render_cache.get(key)
+        metrics.cache("image_part", data is not None)
+        if data is None:
+            doc = fitz.open(stream=self.pdf_raw_bytes, filetype="pdf")
+            try:
+                image = Image.open(io.BytesIO(doc.extract_image(xref)["image"]))
+            finally:
+                doc.close()
+            image.draft("RGB", (IMAGE_CONTEXT_MAX_SIDE, IMAGE_CONTEXT_MAX_SIDE))
+            image = image.convert("RGB")
+            image.thumbnail((IMAGE_CONTEXT_MAX_SIDE, IMAGE_CONTEXT_MAX_SIDE))
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=RENDER_JPEG_QUALITY)
+            data = buffer.getvalue()
+            _render_cache.put(key, data)
+        return {"mime_type": "image/jpeg", "data": data}
+
+    def select_image_parts(self, question: str, page_range: tuple = None) -> tuple:
+        """
+        Picks the PDF images that matter for a question.
+
+        Images are scored by the question words found in their caption
+        (words common to most captions do not count), a matching figure or
+        table number, a page named in the question and the share of the
+        passage search score that falls on their page. Decorative images and pages
+        outside `page_range` are skipped. The best IMAGE_CONTEXT_MAX_IMAGES
+        images above IMAGE_CONTEXT_MIN_SCORE are returned downscaled, with a
+        note that tells the model where each one comes from.
+
+        Returns:
+            (content parts, report dict)
+        """
+        candidates = [
+            entry for entry in self.image_index
+            if not entry["decorative"]
+            and (page_range is None or page_range[0] <= entry["page"] <= page_range[1])
+        ]
+        caption_terms = [set(tokenize(entry["caption"])) for entry in candidates]
+        common_terms = {
+            term for term in set().union(*caption_terms)
+            if sum(term in terms for terms in caption_terms) * 2 > len(caption_terms)
+        }
+        question_terms = set(tokenize(question)) - common_terms
+        figure_numbers = {match.group(2) for match in FIGURE_REFERENCE.finditer(question)}
+        pages_named = {int(number) for number in re.findall(r"\b(?:page|sayfa|p\.)\s*(\d+)", question, re.IGNORECASE)}
+        page_scores = {}
+        if self.document is not None and candidates:
+            for score, _, page_number, _ in search_passages([self.document], question, IMAGE_CONTEXT_SEARCH_TOKENS):
+                page_scores[page_number] = max(score, page_scores.get(page_number, 0.0))
+        total_page_score = sum(page_scores.values())
+
+        scored = []
+        for entry, terms in zip(candidates, caption_terms):
+            score = len(question_terms & terms) / max(1, len(question_terms))
+            if figure_numbers & {match.group(2) for match in FIGURE_REFERENCE.finditer(entry["caption"])}:
+                score += 2.0
+            if entry["page"] in pages_named:
+                score += 1.0
+            if total_page_score:
+                score += page_scores.get(entry["page"], 0.0) / total_page_score
+            scored.append((score, entry))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        selected, seen = [], set()
+        for score, entry in scored:
+            if len(selected) >= IMAGE_CONTEXT_MAX_IMAGES or score < IMAGE_CONTEXT_MIN_SCORE:
+                break
+            if entry["xref"] in seen or (entry["hash"] and entry["hash"] in seen):
+                continue
+            seen.update((entry["xref"], entry["hash"]))
+            selected.append(entry)
+
+        parts = [self._image_part(entry["xref"]) for entry in selected]
+        sent_bytes = sum(len(part["data"]) for part in parts)
+        skipped_bytes = sum({
+            entry["xref"]: entry["bytes"] for entry in self.image_index
+            if page_range is None or page_range[0] <= entry["page"] <= page_range[1]
+        }.values())
+        report = {
+            "candidates": len(candidates),
+            "attached": [{"page": entry["page"], "caption": entry["caption"][:80]} for entry in selected],
+            "bytes_sent": sent_bytes,
+            "pdf_image_bytes_skipped": skipped_bytes,
+        }
+        metrics.inc("pdf_assistant_context_images_total", len(selected))
+        metrics.inc("pdf_assistant_context_image_bytes_total", sent_bytes, result="sent")
+        metrics.inc("pdf_assistant_context_image_bytes_total", skipped_bytes, result="skipped")
+        if parts:
+            listing = "\n".join(
+                f"Image {number}: page {entry['page']}" + (f", near the text: {entry['caption']}" if entry["caption"] else "")
+                for number, entry in enumerate(selected, start=1)
+            )
+            parts.append(
+                "The document above was sent without its images. These images from it "
+                f"may be relevant to the question:\n{listing}"
+            )
+        return parts, report
+
+    def get_page_image(self, page_index: int, img_index: int) -> Image.Image:
+        """Decodes one image listed by extract_images_from_bytes as a PIL Image"""
+        _, _, xref = self.page_images[page_index][img_index]
+        doc = fitz.open(stream=self.pdf_raw_bytes, filetype="pdf")
+        try:
+            return Image.open(io.BytesIO(doc.extract_image(xref)["image"]))
+        finally:
+            doc.close()
+    
+    @metrics.timed("analyze_pdf")
+    def _analyze_pdf_content(self):
         """Analyzes PDF content and gets general information"""
         prompt = """
         Create a brief summary of this PDF document.
@@ -389,57 +3264,28 @@ class InteractivePDFAssistant:
         """
         
         try:
-            # If pdf_bytes is not specified, use self.pdf_raw_bytes
-            if pdf_bytes is None:
-                pdf_bytes = self.pdf_raw_bytes
-                
-            # Check PDF size
-            if len(pdf_bytes) > 10 * 1024 * 1024:  # If larger than 10MB
-                pdf_bytes = self._truncate_pdf_for_api(pdf_bytes)
-            
-            # Send PDF content and prompt to model
-            try:
-                response = self.model.generate_content(
-                    contents=[
-                        {"mime_type": "application/pdf", "data": pdf_bytes},
-                        prompt
-                    ],
-                    stream=False,
-                    safety_settings=[
-                        {
-                            "category": "HARM_CATEGORY_HARASSMENT",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_HATE_SPEECH",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                            "threshold": "BLOCK_NONE"
-                        }
-                    ]
-                )
-            except Exception as safety_error:
-                print(f"Safety settings error: {str(safety_error)}, trying without safety settings...")
-                # Try again without safety settings
-                response = self.model.generate_content(
-                    contents=[
-                        {"mime_type": "application/pdf", "data": pdf_bytes},
-                        prompt
-                    ],
-                    stream=False
-                )
+            # The overview only depends on the pages, it is made once per document version
+            cache_key = self._generation_key("overview", {})
+            overview = get_cached_generation(cache_key)
+            if overview is None:
+                # The overview is optional: it runs in the ingestion lane, or in the caller's
+                # lane if that is lower (a speculative prefetch must not be promoted)
+                lane = max((_model_lane.get(), "ingestion"),
+                           key=lambda name: ADMISSION_LANES.get(name, {}).get("priority", 0))
+                with model_lane(lane):
+                    if self._exceeds_budget("overview"):
+                        # Too long for one call: combine summaries of its sections
+                        overview = self._map_reduce_summary("overview", prompt)
+                    else:
+                        # Send the PDF and the prompt to model
+                        overview = self.model_client.generate(self._fit_context("overview") + [prompt], mode="overview").text
+                store_generation(cache_key, overview)
             
             # PDF summary created, add to chat history
-            self.chat_history.append({"role": "model", "parts": [response.text]})
+            self.chat_history.append({"role": "model", "parts": [overview]})
             
             print("PDF content analyzed.")
-            return response.text
+            return overview
             
         except Exception as e:
             error_msg = f"PDF analysis error: {str(e)}"
@@ -447,7 +3293,9 @@ class InteractivePDFAssistant:
             print(f"Error details: {traceback.format_exc()}")
             return f"PDF content analysis failed: {error_msg}"
     
-    def ask_question(self, question: str, image_bytes: bytes = None, image_mime: str = None) -> str:
+    @metrics.timed("answer_question")
+    def ask_question(self, question: str, image_bytes: bytes = None, image_mime: str = None,
+                     page_range: tuple = None) -> str:
         """
         Asks a question about the PDF and returns the answer.
         
@@ -455,6 +3303,7 @@ class InteractivePDFAssistant:
             question: The question asked
             image_bytes: Binary content of the uploaded image (if any)
             image_mime: MIME type of the image
+            page_range: Optional (first, last) pages the question is about
             
         Returns:
             Answer to the question
@@ -463,11 +3312,15 @@ class InteractivePDFAssistant:
             return "Please upload a PDF file first."
         
         try:
-            # Check PDF size and truncate if necessary
-            api_pdf_bytes = self._truncate_pdf_for_api(self.pdf_raw_bytes)
-            
-            # Create content list
-            contents = [{"mime_type": "application/pdf", "data": api_pdf_bytes}]
+            # Create content list with the part of the PDF that fits the chat budget. Figure-heavy
+            # documents go without their images, text documents as page texts; only the images
+            # relevant to the question follow.
+            strip_images = self._figure_heavy()
+            contents = self._fit_context("chat", page_range=page_range, strip_images=strip_images)
+            if strip_images or self.last_context_report.get("payload") == "text":
+                image_parts, image_report = self.select_image_parts(question, page_range)
+                contents.extend(image_parts)
+                self.last_context_report = {**self.last_context_report, "images": image_report}
             
             # If there's an image, add it to the content
             if image_bytes and image_mime:
@@ -486,56 +3339,279 @@ class InteractivePDFAssistant:
             else:
                 prompt = f"{question}\n\nBase your answer on the PDF content and images in the PDF."
             
+            if page_range is not None:
+                prompt += f"\nThe question is about {self._scope_text(page_range)}."
+            
             # Add prompt to content
             contents.append(prompt)
             
-            # Send content to model
-            try:
-                response = self.chat_session.send_message(
-                    contents,
-                    safety_settings=[
-                        {
-                            "category": "HARM_CATEGORY_HARASSMENT",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_HATE_SPEECH",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                            "threshold": "BLOCK_NONE"
-                        }
-                    ]
-                )
+            # Send content to model, routed by question length and context size
+            route = {
+                "mode": "chat_image" if image_bytes and image_mime else "chat",
+                "prompt_chars": len(question),
+                "context_tokens": (self.last_context_report or {}).get("tokens", 0),
+            }
+            def send():
+                turn = len(self.chat_session.history)
+                response = self.model_client.send_message(self.chat_session, contents, **route)
+                self._drop_document_parts(turn, prompt)
+                self.last_context_report = {**(self.last_context_report or {}), "route": self.model_client.last_route}
                 return response.text
+
+            try:
+                return send()
             except Exception as chat_error:
+                # Transient errors were already retried by the model client
+                if ModelClient.is_retryable(chat_error) or isinstance(chat_error, RATE_LIMIT_ERRORS):
+                    raise
                 print(f"Chat session error: {str(chat_error)}")
                 print(f"Creating new chat session and retrying...")
                 
-                # Reset chat session
+                # Reset chat session, its state may be broken
                 self.create_chat_session()
                 
                 # Try again
-                response = self.chat_session.send_message(contents)
-                return response.text
+                return send()
             
+        except RATE_LIMIT_ERRORS:
+            raise
         except Exception as e:
             error_msg = f"Question asking error: {str(e)}"
             print(error_msg)
             print(f"Error details: {traceback.format_exc()}")
             return f"Question answer failed: {error_msg}"
-    
-    def generate_quiz(self, num_questions: int = 5) -> str:
+
+    @metrics.timed("answer_batch")
+    def ask_questions_batch(self, questions: list, pack_size: int = BATCH_PACK_SIZE,
+                            max_workers: int = BATCH_MAX_PARALLEL_PACKS, page_range: tuple = None) -> list:
+        """
+        Answers many questions about the PDF with a small number of model calls.
+
+        Questions are packed into groups of `pack_size` and each pack is sent
+        as a single request that returns a JSON array of answers. Packs run in
+        parallel, at most `max_workers` at a time.
+
+        Args:
+            questions: List of questions
+            pack_size: Number of questions per model call
+            max_workers: Maximum number of packs processed at the same time
+            page_range: Optional (first, last) pages the questions are about
+
+        Returns:
+            List of answers in the same order as `questions`
+        """
+        if not self.pdf_raw_bytes:
+            return ["Please upload a PDF file first."] * len(questions)
+
+        pack_size = max(1, pack_size)
+        answers = [None] * len(questions)
+
+        # The document payload is prepared once and shared by every pack
+        document_parts = self._fit_context("batch", page_range=page_range)
+
+        packs = [(start, questions[start:start + pack_size]) for start in range(0, len(questions), pack_size)]
+        print(f"Batch: {len(questions)} questions in {len(packs)} packs.")
+
+        rate_limited = []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(packs)))) as executor:
+            futures = {
+                submit_with_context(executor, self._answer_question_pack, document_parts, pack): (start, pack)
+                for start, pack in packs
+            }
+            for future in as_completed(futures):
+                start, pack = futures[future]
+                try:
+                    pack_answers = future.result()
+                except RATE_LIMIT_ERRORS as e:
+                    rate_limited.append(e)
+                    pack_answers = [f"Question answer failed: {str(e)}"] * len(pack)
+                except Exception as e:
+                    error_msg = f"Question asking error: {str(e)}"
+                    print(error_msg)
+                    pack_answers = [f"Question answer failed: {error_msg}"] * len(pack)
+                answers[start:start + len(pack)] = pack_answers
+
+        # Nothing was answered: let the client retry the whole batch later
+        if len(rate_limited) == len(packs):
+            raise rate_limited[0]
+        return answers
+
+    def _answer_question_pack(self, document_parts: list, questions: list) -> list:
+        """Answers one pack of questions; retries unparsed answers once in a smaller pack"""
+        answers = self._parse_batch_answers(self._send_question_pack(document_parts, questions), len(questions))
+
+        missing = [i for i, answer in enumerate(answers) if answer is None]
+        if missing:
+            print(f"Batch: {len(missing)} answers could not be parsed, retrying...")
+            retry_answers = self._parse_batch_answers(
+                self._send_question_pack(document_parts, [questions[i] for i in missing]),
+                len(missing)
+            )
+            for i, answer in zip(missing, retry_answers):
+                answers[i] = answer
+
+        return [answer if answer is not None else "Answer could not be parsed." for answer in answers]
+
+    def _send_question_pack(self, document_parts: list, questions: list) -> str:
+        """Sends a pack of questions in a single request and returns the raw response text"""
+        numbered = "\n".join(f"{i}. {question}" for i, question in enumerate(questions, start=1))
+        prompt = f"""
+        Answer each of the following questions based on the PDF content and images in the PDF.
+        Return only a JSON array with one object per question, in the same order:
+        [{{"id": 1, "answer": "..."}}, {{"id": 2, "answer": "..."}}]
+        Markdown may be used inside the answer strings.
+
+        Questions:
+        {numbered}
+        """
+
+        response = self.model_client.generate(
+            document_parts + [prompt],
+            generation_config={"response_mime_type": "application/json"},
+            mode="batch"
+        )
+
+        return response.text
+
+    @metrics.timed("answer_multi_document")
+    def ask_multi_document(self, question: str, documents: list) -> dict:
+        """
+        Answers a question over several documents with a single model call.
+
+        The most relevant passages of all documents are selected under the
+        "multi" token budget and sent as numbered sources.
+
+        Args:
+            question: The question asked
+            documents: List of DocumentArtifacts
+
+        Returns:
+            dict: answer, sources (document, page, whether cited) and context report
+        """
+        budget = CONTEXT_TOKEN_BUDGETS["multi"] - OUTPUT_TOKEN_RESERVE - len(question) // CHARS_PER_TOKEN
+        with metrics.span("search_passages"):
+            passages = search_passages(documents, question, budget)
+
+        if not passages:
+            return {"answer": "No text could be found in the selected PDFs.", "sources": [], "context": None}
+
+        # Keep the passages of a document together and in page order
+        order = {str(document.pdf_id): position for position, document in enumerate(documents)}
+        passages.sort(key=lambda item: (order[str(item[1].pdf_id)], item[2]))
+
+        sources = []
+        blocks = []
+        for number, (score, document, page_number, text) in enumerate(passages, start=1):
+            sources.append({
+                "id": f"S{number}",
+                "pdf_id": document.pdf_id,
+                "title": document.title,
+                "page": page_number,
+                "score": round(score, 4)
+            })
+            blocks.append(f'[S{number}] "{document.title}", page {page_number}:\n{text}')
+
+        prompt = f"""
+        Answer the question using the numbered sources below. They are passages from several PDF documents.
+        Cite the sources you use in square brackets, for example [S2].
+        Point out where the documents agree or differ. If the sources do not contain the answer, say so.
+
+        Sources:
+        {chr(10).join(blocks)}
+
+        Question: {question}
+        """
+
+        try:
+            answer = self.model_client.generate([prompt], mode="multi").text
+        except RATE_LIMIT_ERRORS:
+            raise
+        except Exception as e:
+            error_msg = f"Question asking error: {str(e)}"
+            print(error_msg)
+            print(f"Error details: {traceback.format_exc()}")
+            answer = f"Question answer failed: {error_msg}"
+
+        cited = set(re.findall(r"\[S(\d+)\]", answer))
+        for source in sources:
+            source["cited"] = source["id"][1:] in cited
+
+        return {
+            "answer": answer,
+            "sources": sources,
+            "context": {
+                "mode": "multi",
+                "documents": len(documents),
+                "passages": len(passages),
+                "tokens": sum(len(block) for block in blocks) // CHARS_PER_TOKEN,
+                "token_budget": budget
+            }
+        }
+
+    @staticmethod
+    def _parse_batch_answers(text: str, count: int) -> list:
+        """
+        Parses the answers of a question pack.
+
+        Accepts a JSON array of {"id", "answer"} objects or of plain strings,
+        optionally wrapped in a markdown code block. Falls back to numbered
+        sections ("1. ...") when the response is not valid JSON.
+
+        Returns:
+            List of length `count`; answers that could not be found are None
+        """
+        answers = [None] * count
+        text = (text or "").strip()
+
+        # Remove markdown code block if present
+        fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+        if fenced:
+            text = fenced.group(1)
+
+        try:
+            items = json.loads(text)
+            if isinstance(items, dict):
+                items = items.get("answers", [])
+            for position, item in enumerate(items if isinstance(items, list) else []):
+                if isinstance(item, dict):
+                    index = item.get("id", position + 1)
+                    answer = item.get("answer")
+                else:
+                    index, answer = position + 1, item
+                try:
+                    index = int(index) - 1
+                except (TypeError, ValueError):
+                    index = position
+                if 0 <= index < count and answer is not None and answers[index] is None:
+                    answers[index] = str(answer).strip()
+            return answers
+        except ValueError:
+            pass
+
+        # Numbered sections: "1. answer", "2) answer" ...
+        sections = re.split(r"(?m)^\s*(\d+)[.)]\s+", text)
+        for i in range(1, len(sections) - 1, 2):
+            index = int(sections[i]) - 1
+            if 0 <= index < count and answers[index] is None:
+                answers[index] = sections[i + 1].strip()
+
+        return answers
+
+    @metrics.timed("generate_quiz")
+    def generate_quiz(self, num_questions: int = 5, page_range: tuple = None, topic: str = None) -> str:
         """
         Generates a quiz based on the PDF content.
         
+        Questions are sampled from the question bank of the document when it
+        has enough of them on the requested pages and topic (the structured
+        questions are kept in `self.last_quiz_questions`). Otherwise, also
+        while the bank is still being built, a quiz is generated for this
+        request.
+        
         Args:
             num_questions: Number of questions to generate
+            page_range: Optional (first, last) pages the quiz covers
+            topic: Optional topic the questions should be about
             
         Returns:
             Generated quiz (questions and answers)
@@ -543,55 +3619,163 @@ class InteractivePDFAssistant:
         if not self.pdf_raw_bytes:
             return "Please upload a PDF file first."
         
+        self.last_quiz_questions = None
+        if QUIZ_BANK_ENABLED:
+            try:
+                bank = self._quiz_bank()
+                questions = bank.sample(num_questions, page_range, topic)
+                if questions is not None:
+                    self.last_quiz_questions = questions
+                    self.last_context_report = {"mode": "quiz", "bank": len(bank), "page_range": page_range}
+                    return format_quiz(questions)
+                print(f"Question bank: fewer than {num_questions} questions match, generating a quiz.")
+            except RATE_LIMIT_ERRORS:
+                raise
+            except Exception as e:
+                print(f"Question bank error: {str(e)}")
+        
+        about = f" Focus on the topic: {topic}." if topic else ""
         prompt = f"""
-        Create a quiz with {num_questions} questions based on the content of this PDF document.
+        Create a quiz with {num_questions} questions based on the content of {self._scope_text(page_range)}.{about}
         Specify the correct answer for each question.
         Number the questions and answers.
         """
         
         try:
-            # Check PDF size and truncate if necessary
-            api_pdf_bytes = self._truncate_pdf_for_api(self.pdf_raw_bytes)
-            
-            response = self.model.generate_content(
-                contents=[
-                    {"mime_type": "application/pdf", "data": api_pdf_bytes},
-                    prompt
-                ],
-                safety_settings=[
-                    {
-                        "category": "HARM_CATEGORY_HARASSMENT",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                        "threshold": "BLOCK_NONE"
-                    }
-                ]
-            )
+            # Send the part of the PDF that fits the quiz budget
+            response = self.model_client.generate(self._fit_context("quiz", page_range=page_range) + [prompt], mode="quiz")
             
             return response.text
             
+        except RATE_LIMIT_ERRORS:
+            raise
         except Exception as e:
             error_msg = f"Quiz generation error: {str(e)}"
             print(error_msg)
             print(f"Error details: {traceback.format_exc()}")
             return f"Quiz generation failed: {error_msg}"
     
-    def generate_summary(self, detail_level: str = "medium") -> str:
+    def _quiz_bank(self, wait: bool = False) -> QuizBank:
+        """
+        Question bank of the loaded document. The document is split into
+        sections of QUIZ_BANK_CHUNK_PAGES pages; the questions of each
+        section are generated once and cached under the hashes of its pages,
+        so a new version only regenerates the sections that changed.
+
+        A missing bank is built in the background (see _build_quiz_bank), so
+        no request waits for every section of a long document. Until the
+        build is done, the bank holds the sections already cached.
+
+        Args:
+            wait: Return the finished build instead
+
+        Raises:
+            Exception: With `wait`, the first section error if no section has questions
+        """
+        page_count = len(self.page_texts)
+        chunks = [
+            (first, min(first + QUIZ_BANK_CHUNK_PAGES - 1, page_count))
+            for first in range(1, page_count + 1, QUIZ_BANK_CHUNK_PAGES)
+        ]
+        params = {"questions": QUIZ_BANK_QUESTIONS_PER_CHUNK}
+        keys = [self._generation_key("quiz_bank", params, chunk) for chunk in chunks]
+        bank_key = hashlib.sha256("".join(keys).encode("utf-8")).hexdigest()
+        bank = _quiz_bank_cache.get(bank_key)
+        metrics.cache("quiz_bank", bank is not None)
+        if bank is not None:
+            return bank
+
+        with _quiz_bank_builds_lock:
+            build = _quiz_bank_builds.get(bank_key)
+            if build is None:
+                # A copy, so the context reports of the build never replace those of a turn
+                build = _quiz_bank_executor.submit(self.detached()._build_quiz_bank, chunks, keys, bank_key)
+                _quiz_bank_builds[bank_key] = build
+                build.add_done_callback(lambda _: _quiz_bank_builds.pop(bank_key, None))
+        if wait:
+            return build.result()
+        cached = [get_cached_generation(key) for key in keys]
+        return QuizBank([question for section in cached if section is not None for question in json.loads(section)])
+
+    def _build_quiz_bank(self, chunks: list, keys: list, bank_key: str) -> QuizBank:
+        """
+        Generates the uncached sections of a question bank in the ingestion
+        lane. A section that fails or yields no questions is not cached; the
+        bank is built from the other sections and not kept, so the next
+        request starts a build that retries the missing ones.
+
+        Raises:
+            Exception: The first section error, if no section has questions
+        """
+        with model_lane("ingestion"):
+            questions = []
+            missing = []
+            for chunk, key in zip(chunks, keys):
+                cached = get_cached_generation(key)
+                if cached is None:
+                    missing.append((chunk, key))
+                else:
+                    questions.extend(json.loads(cached))
+
+            errors = []
+            incomplete = 0
+            if missing:
+                with metrics.span("build_quiz_bank"):
+                    with ThreadPoolExecutor(max_workers=min(QUIZ_BANK_PARALLEL, len(missing))) as executor:
+                        futures = {
+                            submit_with_context(executor, self._generate_quiz_chunk, chunk): key
+                            for chunk, key in missing
+                        }
+                        for future in as_completed(futures):
+                            try:
+                                chunk_questions = future.result()
+                            except Exception as e:
+                                errors.append(e)
+                                incomplete += 1
+                                continue
+                            if not chunk_questions:
+                                # Failed or unparseable answer: leave the section uncached to retry it
+                                incomplete += 1
+                                continue
+                            store_generation(futures[future], json.dumps(chunk_questions))
+                            questions.extend(chunk_questions)
+                print(f"Question bank: {len(questions)} questions, {len(missing) - incomplete} of {len(chunks)} "
+                      f"sections generated, {incomplete} failed.")
+                for error in errors:
+                    print(f"Question bank section error: {str(error)}")
+            if errors and not questions:
+                raise errors[0]
+
+            bank = QuizBank(questions)
+            if not incomplete:
+                _quiz_bank_cache.put(bank_key, bank)
+            return bank
+
+    def _generate_quiz_chunk(self, page_range: tuple) -> list:
+        """Generates the structured bank questions of one section"""
+        prompt = f"""
+        Create a question bank of {QUIZ_BANK_QUESTIONS_PER_CHUNK} multiple-choice questions based on {self._scope_text(page_range)}.
+        Cover the different topics of these pages.
+        Return only a JSON array with one object per question:
+        [{{"question": "...", "choices": ["...", "...", "...", "..."], "answer": 0, "page": {page_range[0]}, "topic": "..."}}]
+        "answer" is the index of the correct choice, "page" the page number the question is based on
+        and "topic" a few words naming what the question is about.
+        """
+        response = self.model_client.generate(
+            self._fit_context("quiz", page_range=page_range) + [prompt],
+            generation_config={"response_mime_type": "application/json"},
+            mode="quiz_bank"
+        )
+        return parse_quiz_questions(response.text, page_range)
+
+    @metrics.timed("generate_summary")
+    def generate_summary(self, detail_level: str = "medium", page_range: tuple = None) -> str:
         """
         Generates a summary of the PDF content.
         
         Args:
             detail_level: Summary detail level (low, medium, high)
+            page_range: Optional (first, last) pages to summarize
             
         Returns:
             Generated summary
@@ -609,88 +3793,168 @@ class InteractivePDFAssistant:
         length = length_map.get(detail_level.lower(), "medium length (3-4 paragraphs)")
         
         prompt = f"""
-        Create a {length} summary of this PDF document.
+        Create a {length} summary of {self._scope_text(page_range)}.
         Highlight the main headings and important points.
         """
         
+        # The same pages were summarized before
+        cache_key = self._generation_key("summary", {"detail_level": length}, page_range)
+        cached = get_cached_generation(cache_key)
+        if cached is not None:
+            self.last_context_report = {"mode": "summary", "cached": True, "page_range": page_range}
+            return cached
+        
         try:
-            # Check PDF size and truncate if necessary
-            api_pdf_bytes = self._truncate_pdf_for_api(self.pdf_raw_bytes)
-            
-            response = self.model.generate_content(
-                contents=[
-                    {"mime_type": "application/pdf", "data": api_pdf_bytes},
-                    prompt
-                ],
-                safety_settings=[
-                    {
-                        "category": "HARM_CATEGORY_HARASSMENT",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                        "threshold": "BLOCK_NONE"
-                    }
-                ]
-            )
+            if self._exceeds_budget("summary", page_range):
+                # Too long for one call: combine summaries of its sections
+                summary = self._map_reduce_summary("summary", prompt, page_range)
+            else:
+                # Send the requested pages
+                summary = self.model_client.generate(self._fit_context("summary", page_range=page_range) + [prompt],
+                                                     mode="summary").text
             
-            return response.text
+            store_generation(cache_key, summary)
+            return summary
             
+        except RATE_LIMIT_ERRORS:
+            raise
         except Exception as e:
             error_msg = f"Summary generation error: {str(e)}"
             print(error_msg)
             print(f"Error details: {traceback.format_exc()}")
             return f"Summary generation failed: {error_msg}"
     
-    def extract_key_concepts(self) -> str:
-        """Extracts key concepts from the PDF"""
+    def _exceeds_budget(self, mode: str, page_range: tuple = None) -> bool:
+        """True if the requested pages do not fit in one call of `mode` (see _fit_context)"""
+        costs = self._payload_costs(page_range)
+        first, last = page_range or (1, len(costs))
+        costs = costs[first - 1:last]
+        budget = CONTEXT_TOKEN_BUDGETS[mode] - OUTPUT_TOKEN_RESERVE
+        return sum(cost[0] for cost in costs) > budget or \
+            sum(cost[1] for cost in costs) > API_PAYLOAD_MAX_MB * 1024 * 1024
+
+    def _summary_sections(self, page_range: tuple = None) -> list:
+        """Splits the pages into consecutive sections that each fit one "summary_chunk" call"""
+        costs = self._payload_costs(page_range)
+        first, last = page_range or (1, len(costs))
+        budget = CONTEXT_TOKEN_BUDGETS["summary_chunk"] - OUTPUT_TOKEN_RESERVE
+        max_bytes = API_PAYLOAD_MAX_MB * 1024 * 1024
+        sections = []
+        start = first
+        tokens = size = 0
+        for page in range(first, last + 1):
+            page_tokens, page_size, _ = costs[page - 1]
+            if page > start and (tokens + page_tokens > budget or size + page_size > max_bytes):
+                sections.append((start, page - 1))
+                start, tokens, size = page, 0, 0
+            tokens += page_tokens
+            size += page_size
+        sections.append((start, last))
+        return sections
+
+    def _summarize_section(self, section: tuple) -> tuple:
+        """Map step: summary of one section, cached under the hashes of its pages"""
+        key = self._generation_key("summary_chunk", {}, section)
+        summary = get_cached_generation(key)
+        if summary is None:
+            prompt = f"""
+            Summarize {self._scope_text(section)}.
+            Keep the headings, definitions, main arguments and results, in order.
+            Use at most 300 words.
+            """
+            summary = self.model_client.generate(self._fit_context("summary_chunk", page_range=section) + [prompt],
+                                                 mode="summary_section").text
+            store_generation(key, summary)
+        return section, key, summary
+
+    def _combine_summaries(self, parts: list) -> tuple:
+        """Reduce step: one summary of consecutive section summaries"""
+        section = (parts[0][0][0], parts[-1][0][1])
+        key = hashlib.sha256(json.dumps(["summary_reduce", [part[1] for part in parts]]).encode("utf-8")).hexdigest()
+        summary = get_cached_generation(key)
+        if summary is None:
+            prompt = f"""
+            Below are summaries of consecutive parts of pages {section[0]}-{section[1]} of a PDF document.
+            Combine them into one summary of these pages.
+            Keep the headings, definitions, main arguments and results, in order.
+            Use at most 400 words.
+
+            {self._summary_blocks(parts)}
+            """
+            summary = self.model_client.generate([prompt], mode="summary_combine").text
+            store_generation(key, summary)
+        return section, key, summary
+
+    @staticmethod
+    def _summary_blocks(parts: list) -> str:
+        return "\n".join(f"--- Pages {first}-{last} ---\n{summary}\n" for (first, last), _, summary in parts)
+
+    @metrics.timed("map_reduce_summary")
+    def _map_reduce_summary(self, mode: str, prompt: str, page_range: tuple = None) -> str:
+        """
+        Summarizes pages that do not fit in one call.
+
+        The pages are split into sections that fit a "summary_chunk" call and
+        summarized concurrently (at most SUMMARY_MAX_PARALLEL at a time). The
+        section summaries are combined SUMMARY_REDUCE_FANIN at a time, level
+        by level, until one call can take all of them with `prompt`. Section
+        and intermediate summaries do not depend on `prompt`, so summaries at
+        other detail levels reuse them.
+        """
+        sections = self._summary_sections(page_range)
+        levels = 1
+        with ThreadPoolExecutor(max_workers=max(1, min(SUMMARY_MAX_PARALLEL, len(sections)))) as executor:
+            parts = [
+                future.result() for future in
+                [submit_with_context(executor, self._summarize_section, section) for section in sections]
+            ]
+            while len(parts) > SUMMARY_REDUCE_FANIN:
+                groups = [parts[i:i + SUMMARY_REDUCE_FANIN] for i in range(0, len(parts), SUMMARY_REDUCE_FANIN)]
+                parts = [
+                    future.result() for future in
+                    [submit_with_context(executor, self._combine_summaries, group) for group in groups]
+                ]
+                levels += 1
+
+        response = self.model_client.generate([
+            f"Below are summaries of consecutive parts of {self._scope_text(page_range)}, in page order.\n\n"
+            f"{self._summary_blocks(parts)}\n{prompt}"
+        ], mode="summary_combine")
+        self.last_context_report = {
+            "mode": mode, "map_reduce": True, "sections": len(sections), "levels": levels,
+            "page_range": page_range,
+        }
+        print(f"Map-reduce summary ({mode}): {len(sections)} sections, {levels} levels.")
+        return response.text
+
+    @metrics.timed("extract_key_concepts")
+    def extract_key_concepts(self, page_range: tuple = None) -> str:
+        """Extracts key concepts from the PDF, optionally only from the given (first, last) pages"""
         if not self.pdf_raw_bytes:
             return "Please upload a PDF file first."
         
-        prompt = """
-        List the key concepts and terms in this PDF document.
+        prompt = f"""
+        List the key concepts and terms in {self._scope_text(page_range)}.
         Provide a brief explanation for each concept.
         """
         
+        # The same pages were analyzed before
+        cache_key = self._generation_key("concepts", {}, page_range)
+        cached = get_cached_generation(cache_key)
+        if cached is not None:
+            self.last_context_report = {"mode": "concepts", "cached": True, "page_range": page_range}
+            return cached
+        
         try:
-            # Check PDF size and truncate if necessary
-            api_pdf_bytes = self._truncate_pdf_for_api(self.pdf_raw_bytes)
-            
-            response = self.model.generate_content(
-                contents=[
-                    {"mime_type": "application/pdf", "data": api_pdf_bytes},
-                    prompt
-                ],
-                safety_settings=[
-                    {
-                        "category": "HARM_CATEGORY_HARASSMENT",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                        "threshold": "BLOCK_NONE"
-                    }
-                ]
-            )
+            # Send the part of the PDF that fits the concepts budget
+            response = self.model_client.generate(self._fit_context("concepts", page_range=page_range) + [prompt],
+                                                  mode="concepts")
             
+            store_generation(cache_key, response.text)
             return response.text
             
+        except RATE_LIMIT_ERRORS:
+            raise
         except Exception as e:
             error_msg = f"Concept extraction error: {str(e)}"
             print(error_msg)
@@ -703,8 +3967,109 @@ if not api_key:
     api_key = "YOUR_API_KEY"  # !!! DO NOT USE THIS CODE IN PRODUCTION !!!
     # raise ValueError("GEMINI_API_KEY environment variable not set. Please set the API key.")
 
-# Global assistant instance (created when application starts)
-assistant = InteractivePDFAssistant(api_key)
+class AssistantPool:
+    """
+    Loaded assistants (PDF content plus chat session) keyed by browser
+    session and document, so a conversation stays warm between turns and
+    never reaches another user.
+
+    The turns of one conversation run one at a time; other conversations
+    run in parallel. Conversations idle for `idle_seconds` are dropped, and
+    the least recently used idle ones go when more than `max_sessions` are
+    live. A conversation is in use from checkout until its turn ends, queued
+    turns included, and is never evicted meanwhile. A conversation is
+    reloaded when its document got a new version.
+
+    The chat history lives only here; the session cookie is too small to
+    carry it. A conversation that is dropped, or whose next turn reaches
+    another process, starts again from the document overview.
+    """
+
+    def __init__(self, max_sessions: int, idle_seconds: float):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._entries = {}  # (session id, pdf id) -> entry; insertion order is least recently used first
+
+    def _evict(self, now: float, keep=None):
+        """Drops idle conversations except `keep` and those in use; the caller holds the pool lock"""
+        for key, entry in list(self._entries.items()):
+            over_cap = len(self._entries) > self.max_sessions
+            if key == keep or entry["users"] or not (over_cap or now - entry["last_used"] > self.idle_seconds):
+                continue
+            del self._entries[key]
+            metrics.inc("pdf_assistant_assistant_evictions_total", reason="cap" if over_cap else "idle")
+
+    @contextlib.contextmanager
+    def checkout(self, session_id: str, pdf_id, filename: str, api_key: str):
+        """
+        Yields the loaded assistant of a conversation, loading the PDF on
+        first use, or None if it could not be loaded.
+
+        Raises:
+            Overloaded: If an earlier turn of the conversation did not finish
+                within ASSISTANT_WAIT_SECONDS
+        """
+        key = (session_id, str(pdf_id))
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.pop(key, None) or {
+                "assistant": None, "lock": threading.Lock(), "last_used": now, "users": 0,
+            }
+            entry["last_used"] = now
+            # In use from here on: the entry cannot be evicted before this turn gets its lock
+            entry["users"] += 1
+            self._entries[key] = entry
+            self._evict(now, keep=key)
+
+        try:
+            if not entry["lock"].acquire(timeout=ASSISTANT_WAIT_SECONDS):
+                raise Overloaded("session", 1)
+            try:
+                assistant = entry["assistant"]
+                if assistant is not None and previous_document_version(pdf_id) not in (None, assistant.pdf_version):
+                    assistant = None  # the document changed since this conversation loaded it
+                metrics.cache("assistant_pool", assistant is not None)
+                if assistant is None:
+                    assistant = InteractivePDFAssistant(api_key)
+                    entry["assistant"] = assistant if assistant.load_pdf_from_supabase(pdf_id, filename) else None
+                if entry["assistant"] is None:
+                    self._discard(key, entry)
+                yield entry["assistant"]
+            finally:
+                entry["last_used"] = time.monotonic()
+                entry["lock"].release()
+        finally:
+            with self._lock:
+                entry["users"] -= 1
+
+    def _discard(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+
+    def release_session(self, session_id: str):
+        """Ends every conversation of a browser session"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == session_id]:
+                del self._entries[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+# Sohbetlerin asistanları (tarayıcı oturumu ve belge başına)
+assistant_pool = AssistantPool(ASSISTANT_POOL_MAX, ASSISTANT_IDLE_SECONDS)
+
+def _collect_assistant_pool():
+    return [
+        "# HELP pdf_assistant_live_conversations Conversations with a loaded assistant.",
+        "# TYPE pdf_assistant_live_conversations gauge",
+        f"pdf_assistant_live_conversations {len(assistant_pool)}",
+    ]
+
+metrics.add_collector(_collect_assistant_pool)
+metrics.describe("pdf_assistant_assistant_evictions_total", "counter", "Conversations dropped from the assistant pool, by reason.")
 
 def allowed_file(filename, allowed_extensions):
     """Checks if the file extension is one of the allowed extensions"""
@@ -724,7 +4089,47 @@ def get_image_mime_type(filename):
     else:  # jpg, jpeg ve diğerleri
         return "image/jpeg"
 
-# Resmi Supabase üzerinden yükleyen ve işleyen fonksiyon
+# Resmi Supabase üzerinden yükleyen ve işleyen fonksiyon
+def store_image(file_content: bytes, filename: str, bucket_name="images", raise_errors: bool = False):
+    """
+    Uploads image bytes to Supabase Storage and adds their 'images' record.
+    
+    Args:
+        file_content: Binary content of the image
+        filename: Original file name
+        bucket_name: Supabase bucket name
+        raise_errors: Raise failures instead of returning None, so that
+            run_bookkeeping logs and counts them
+    
+    Returns:
+        dict: The created image record, or None on error
+    """
+    try:
+        # Create secure and unique filename
+        filename = secure_filename(filename)
+        unique_filename = f"{int(time.time())}_{filename}"
+        
+        # Upload file to Supabase Storage
+        supabase.storage.from_(bucket_name).upload(
+            file=file_content,
+            path=unique_filename,
+            file_options={"content-type": get_image_mime_type(filename)}
+        )
+        
+        # Add record to DB
+        response = supabase.table("images").insert({
+            "file_name": filename,
+            "file_path": f"{bucket_name}/{unique_filename}"
+        }).execute()
+        
+        return response.data[0] if response.data else None
+        
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"Image upload error: {str(e)}")
+        return None
+
 def upload_and_process_image(file, bucket_name="images"):
     """
     Uploads and processes an image file to Supabase.
@@ -737,37 +4142,10 @@ def upload_and_process_image(file, bucket_name="images"):
         tuple: (image_bytes, mime_type) - Binary content and MIME type of the image
     """
     if file and allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS):
-        try:
-            # Create secure filename
-            filename = secure_filename(file.filename)
-            
-            # Create unique filename
-            unique_filename = f"{int(time.time())}_{filename}"
-            
-            # Read the file
-            file_content = file.read()
-            
-            # Upload file to Supabase Storage
-            supabase.storage.from_(bucket_name).upload(
-                file=file_content,
-                path=unique_filename,
-                file_options={"content-type": get_image_mime_type(filename)}
-            )
-            
-            # Add record to DB
-            response = supabase.table("images").insert({
-                "file_name": filename,
-                "file_path": f"{bucket_name}/{unique_filename}"
-            }).execute()
-            
-            # Determine MIME type of the image
-            mime_type = get_image_mime_type(filename)
-            
-            return file_content, mime_type
-            
-        except Exception as e:
-            print(f"Image upload error: {str(e)}")
+        file_content = file.read()
+        if store_image(file_content, file.filename, bucket_name) is None:
             return None, None
+        return file_content, get_image_mime_type(secure_filename(file.filename))
     
     return None, None
 
@@ -810,6 +4188,10 @@ def select_pdf():
         if 'pdf_assistant' not in session:
             session['pdf_assistant'] = {}
         
+        # A new selection starts a new conversation
+        cancel_prefetch(session_client_id())
+        assistant_pool.release_session(session_client_id())
+        
         print(f"Request form: {list(request.form.keys())}")
         print(f"Request files: {list(request.files.keys()) if request.files else 'Dosya yok'}")
         
@@ -835,10 +4217,12 @@ def select_pdf():
                 session['current_pdf_id'] = pdf_data['id']
                 session['pdf_assistant'] = {
                     'pdf_id': pdf_data['id'],
-                    'title': filename,
-                    'chat_history': []
+                    'title': filename
                 }
                 
+                # Kullanıcı okurken belgeyi ve en çok istenen üretimi arka planda hazırla
+                start_prefetch(session_client_id(), pdf_data['id'], filename, api_key)
+                
                 return jsonify({
                     "success": True,
                     "message": f"PDF uploaded: {filename}",
@@ -881,11 +4265,13 @@ def select_pdf():
                 # Session'da asistan bilgilerini sakla - asenkron işleme için hemen yanıt ver
                 session['pdf_assistant'] = {
                     'pdf_id': pdf_id,
-                    'title': filename,
-                    'chat_history': []
+                    'title': filename
                 }
                 session['current_pdf_id'] = pdf_id
                 
+                # Kullanıcı okurken belgeyi ve en çok istenen üretimi arka planda hazırla
+                start_prefetch(session_client_id(), pdf_id, filename, api_key)
+                
                 # Başarılı yanıt döndür - asistanı arka planda yükle, ön yüzde gösterilebilir
                 return jsonify({
                     "success": True,
@@ -914,12 +4300,21 @@ def select_pdf():
     return jsonify({"error": "Invalid request content."}), 400
 
 @app.route('/chat', methods=['POST'])
+@with_model_deadline()
+@with_model_lane()
 def chat():
     """
     Interactive chat API with the PDF.
     
     Takes 'question' and optional 'image' parameter as JSON or form data.
+    Optional 'pages' (e.g. "12-30") or 'chapter' limit the answer to part of the PDF.
     Returns error if no PDF is loaded.
+    
+    Only loading the PDF and the model call are on the critical path. The
+    uploaded image is stored and the answer is saved in the background;
+    'timings' in the response lists the seconds spent per stage. Earlier
+    turns are kept by the pooled assistant (see AssistantPool), not in the
+    session.
     """
     if request.method == 'POST':
         try:
@@ -938,97 +4333,140 @@ def chat():
                 data = request.get_json()
                 question = data.get('question', '')
                 conversation_mode = data.get('mode', 'chat')
+                pages = data.get('pages')
+                chapter = data.get('chapter')
+                options = data
             else:
                 question = request.form.get('question', '')
                 conversation_mode = request.form.get('mode', 'chat')
+                pages = request.form.get('pages')
+                chapter = request.form.get('chapter')
+                options = request.form
             
             if not question and conversation_mode == 'chat':
                 return jsonify({"error": "Question cannot be empty."}), 400
             
-            # Yüklenen resim varsa işle
+            started = time.perf_counter()
+            timings = {}
+            
+            # Yüklenen resim varsa oku; Supabase'e yükleme ve kaydı cevabı beklemeden arka planda yapılır
             image_bytes = None
             image_mime = None
             if 'image' in request.files:
                 image_file = request.files['image']
                 if image_file and image_file.filename and allowed_file(image_file.filename, ALLOWED_IMAGE_EXTENSIONS):
-                    # Resmi Supabase'e yükle ve binary verisini al
-                    image_bytes, image_mime = upload_and_process_image(image_file)
+                    with request_stage(timings, "chat_image_read"):
+                        image_bytes = image_file.read()
+                        image_mime = get_image_mime_type(secure_filename(image_file.filename))
+                    run_bookkeeping("image_upload", store_image, image_bytes, image_file.filename,
+                                    raise_errors=True)
             
-            # Asistanı oluştur ve PDF'i yükle
-            assistant = InteractivePDFAssistant(api_key)
+            # Bu sohbetin asistanını al (ilk turda PDF yüklenir, sonraki turlarda hazır bekler)
             current_pdf_id = session.get('current_pdf_id')
-            assistant.load_pdf_from_supabase(current_pdf_id, pdf_info['title'])
-            
-            # Chat history ayarla
-            if 'chat_history' in pdf_info:
-                assistant.chat_history = pdf_info['chat_history']
-            
-            # İstenen işlemi gerçekleştir
-            if conversation_mode == 'chat':
-                # Soru-cevap modu
-                answer = assistant.ask_question(question, image_bytes, image_mime)
-                
-                # Soru ve cevabı Supabase'e kaydet
-                if current_pdf_id:
-                    save_qa_session(current_pdf_id, question, answer)
-                
-                # Session'da chat history'ni güncelle
-                pdf_info['chat_history'] = assistant.chat_history
-                session['pdf_assistant'] = pdf_info
-                
-                return jsonify({
-                    "success": True, 
-                    "answer": answer,
-                    "mode": "chat"
-                })
-                
-            elif conversation_mode == 'generate_quiz':
-                # Quiz oluşturma
-                num_questions = int(request.form.get('num_questions', 5))
-                quiz_content = assistant.generate_quiz(num_questions)
-                
-                # Quiz içeriğini Supabase'e kaydet
-                if current_pdf_id:
-                    save_generated_content(current_pdf_id, "quiz", quiz_content)
-                
-                return jsonify({
-                    "success": True, 
-                    "answer": quiz_content,
-                    "mode": "generate_quiz"
-                })
-                
-            elif conversation_mode == 'generate_summary':
-                # Özet oluşturma
-                detail_level = request.form.get('detail_level', 'medium')
-                summary_content = assistant.generate_summary(detail_level)
-                
-                # Özet içeriğini Supabase'e kaydet
-                if current_pdf_id:
-                    save_generated_content(current_pdf_id, "summary", summary_content)
-                
-                return jsonify({
-                    "success": True, 
-                    "answer": summary_content,
-                    "mode": "generate_summary"
-                })
+            with contextlib.ExitStack() as conversation:
+                with request_stage(timings, "chat_pdf_load"):
+                    assistant = conversation.enter_context(
+                        assistant_pool.checkout(session_client_id(), current_pdf_id, pdf_info['title'], api_key)
+                    )
+                if assistant is None:
+                    return jsonify({"error": "PDF loading failed."}), 500
                 
-            elif conversation_mode == 'extract_key_concepts':
-                # Anahtar kavramları çıkarma
-                concepts_content = assistant.extract_key_concepts()
+                # Sayfa aralığını çöz
+                try:
+                    page_range = assistant.resolve_page_range(pages, chapter)
+                except ValueError as e:
+                    return jsonify({"error": str(e)}), 400
                 
-                # Kavramları Supabase'e kaydet
-                if current_pdf_id:
-                    save_generated_content(current_pdf_id, "key_concepts", concepts_content)
+                # İstenen işlemi gerçekleştir
+                if conversation_mode == 'chat':
+                    # Soru-cevap modu
+                    with request_stage(timings, "chat_model"):
+                        answer = assistant.ask_question(question, image_bytes, image_mime, page_range=page_range)
+                    
+                    # Soru ve cevabı Supabase'e arka planda kaydet
+                    if current_pdf_id:
+                        run_bookkeeping("save_qa", save_qa_session, current_pdf_id, question, answer,
+                                        raise_errors=True)
+                    
+                    timings["total"] = round(time.perf_counter() - started, 4)
+                    return jsonify({
+                        "success": True, 
+                        "answer": answer,
+                        "mode": "chat",
+                        "context": assistant.last_context_report,
+                        "timings": timings
+                    })
+                    
+                elif conversation_mode == 'generate_quiz':
+                    # Quiz oluşturma
+                    num_questions = int(options.get('num_questions', 5))
+                    with request_stage(timings, "chat_model"):
+                        quiz_content = assistant.generate_quiz(num_questions, page_range=page_range,
+                                                               topic=options.get('topic'))
+                    
+                    # Quiz içeriğini Supabase'e arka planda kaydet
+                    if current_pdf_id:
+                        run_bookkeeping("save_content", save_generated_content, current_pdf_id, "quiz", quiz_content,
+                                        raise_errors=True)
+                    
+                    timings["total"] = round(time.perf_counter() - started, 4)
+                    return jsonify({
+                        "success": True, 
+                        "answer": quiz_content,
+                        "questions": assistant.last_quiz_questions,
+                        "mode": "generate_quiz",
+                        "context": assistant.last_context_report,
+                        "timings": timings
+                    })
+                    
+                elif conversation_mode == 'generate_summary':
+                    # Özet oluşturma
+                    detail_level = options.get('detail_level', 'medium')
+                    with request_stage(timings, "chat_model"):
+                        if detail_level == PREFETCH_SUMMARY_DETAIL and page_range is None:
+                            join_prefetch(session_client_id(), current_pdf_id, "summary")
+                        summary_content = assistant.generate_summary(detail_level, page_range=page_range)
+                    
+                    # Özet içeriğini Supabase'e arka planda kaydet
+                    if current_pdf_id:
+                        run_bookkeeping("save_content", save_generated_content, current_pdf_id, "summary", summary_content,
+                                        raise_errors=True)
+                    
+                    timings["total"] = round(time.perf_counter() - started, 4)
+                    return jsonify({
+                        "success": True, 
+                        "answer": summary_content,
+                        "mode": "generate_summary",
+                        "context": assistant.last_context_report,
+                        "timings": timings
+                    })
+                    
+                elif conversation_mode == 'extract_key_concepts':
+                    # Anahtar kavramları çıkarma
+                    with request_stage(timings, "chat_model"):
+                        if page_range is None:
+                            join_prefetch(session_client_id(), current_pdf_id, "key_concepts")
+                        concepts_content = assistant.extract_key_concepts(page_range=page_range)
+                    
+                    # Kavramları Supabase'e arka planda kaydet
+                    if current_pdf_id:
+                        run_bookkeeping("save_content", save_generated_content, current_pdf_id, "key_concepts", concepts_content,
+                                        raise_errors=True)
+                    
+                    timings["total"] = round(time.perf_counter() - started, 4)
+                    return jsonify({
+                        "success": True, 
+                        "answer": concepts_content,
+                        "mode": "extract_key_concepts",
+                        "context": assistant.last_context_report,
+                        "timings": timings
+                    })
                 
-                return jsonify({
-                    "success": True, 
-                    "answer": concepts_content,
-                    "mode": "extract_key_concepts"
-                })
-            
-            else:
-                return jsonify({"error": "Invalid mode."}), 400
+                else:
+                    return jsonify({"error": "Invalid mode."}), 400
                 
+        except RATE_LIMIT_ERRORS as e:
+            return overloaded_response(e)
         except Exception as e:
             import traceback
             error_details = traceback.format_exc()
@@ -1040,12 +4478,203 @@ def chat():
     
     return jsonify({"error": "Unsupported method."}), 405
 
+@app.route('/batch_chat', methods=['POST'])
+@with_model_deadline()
+@with_model_lane()
+def batch_chat():
+    """
+    Answers a list of questions about the selected PDF in one request.
+
+    Takes 'questions' as a JSON list, or as newline separated form data.
+    Optional 'pages' or 'chapter' limit the answers to part of the PDF.
+    The PDF is loaded once and questions are answered in packs.
+    """
+    try:
+        api_key = os.environ.get("GOOGLE_API_KEY")
+        if not api_key:
+            return jsonify({"error": "API key not found. Check your .env file."}), 500
+
+        pdf_info = session.get('pdf_assistant')
+        if not pdf_info:
+            return jsonify({"error": "You need to select a PDF first."}), 400
+
+        # Soruları JSON ya da form verisinden al
+        if request.is_json:
+            data = request.get_json()
+            questions = data.get('questions', [])
+            pages = data.get('pages')
+            chapter = data.get('chapter')
+        else:
+            questions = request.form.get('questions', '').splitlines()
+            pages = request.form.get('pages')
+            chapter = request.form.get('chapter')
+
+        if not isinstance(questions, list):
+            return jsonify({"error": "Questions must be a list."}), 400
+
+        questions = [str(q).strip() for q in questions if str(q).strip()]
+        if not questions:
+            return jsonify({"error": "Questions cannot be empty."}), 400
+        if len(questions) > BATCH_MAX_QUESTIONS:
+            return jsonify({"error": f"At most {BATCH_MAX_QUESTIONS} questions can be sent at once."}), 400
+
+        # Bu sohbetin asistanını al (PDF bir kez yüklenir)
+        current_pdf_id = session.get('current_pdf_id')
+        with assistant_pool.checkout(session_client_id(), current_pdf_id, pdf_info['title'], api_key) as assistant:
+            if assistant is None:
+                return jsonify({"error": "PDF loading failed."}), 500
+
+            try:
+                page_range = assistant.resolve_page_range(pages, chapter)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+            answers = assistant.ask_questions_batch(questions, page_range=page_range)
+            context_report = assistant.last_context_report
+
+        # Tüm soru-cevapları tek seferde kaydet
+        if current_pdf_id:
+            save_qa_sessions_bulk([(current_pdf_id, question, answer) for question, answer in zip(questions, answers)])
+
+        return jsonify({
+            "success": True,
+            "answers": [
+                {"question": question, "answer": answer}
+                for question, answer in zip(questions, answers)
+            ],
+            "mode": "batch",
+            "context": context_report
+        })
+
+    except RATE_LIMIT_ERRORS as e:
+        return overloaded_response(e)
+    except Exception as e:
+        error_details = traceback.format_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "details": error_details
+        }), 500
+
+@app.route('/multi_chat', methods=['POST'])
+@with_model_deadline()
+@with_model_lane()
+def multi_chat():
+    """
+    Answers one question across several PDFs.
+
+    Takes 'question' and 'pdf_ids' (a list) as JSON. Returns the answer with
+    the source passages it was based on.
+    """
+    try:
+        api_key = os.environ.get("GOOGLE_API_KEY")
+        if not api_key:
+            return jsonify({"error": "API key not found. Check your .env file."}), 500
+
+        data = request.get_json(silent=True) or {}
+        question = str(data.get('question', '')).strip()
+        pdf_ids = data.get('pdf_ids', [])
+
+        if not question:
+            return jsonify({"error": "Question cannot be empty."}), 400
+        if not isinstance(pdf_ids, list) or not pdf_ids:
+            return jsonify({"error": "Select at least one PDF."}), 400
+        if len(pdf_ids) > MULTI_MAX_DOCUMENTS:
+            return jsonify({"error": f"At most {MULTI_MAX_DOCUMENTS} PDFs can be selected."}), 400
+
+        # PDF kayıtlarını tek sorguda al
+        response = supabase.table("pdfs").select("*").in_("id", pdf_ids).execute()
+        records = {str(record["id"]): record for record in response.data or []}
+        missing = [pdf_id for pdf_id in pdf_ids if str(pdf_id) not in records]
+        if missing:
+            return jsonify({"error": f"PDF not found: {', '.join(map(str, missing))}"}), 404
+
+        documents = load_documents([records[str(pdf_id)] for pdf_id in pdf_ids])
+        if not documents:
+            return jsonify({"error": "PDF loading failed."}), 500
+
+        assistant = InteractivePDFAssistant(api_key)
+        result = assistant.ask_multi_document(question, documents)
+
+        # Soru ve cevabı ilgili her PDF için tek seferde kaydet
+        save_qa_sessions_bulk([(document.pdf_id, question, result["answer"]) for document in documents])
+
+        return jsonify({
+            "success": True,
+            "answer": result["answer"],
+            "sources": result["sources"],
+            "mode": "multi",
+            "context": result["context"]
+        })
+
+    except RATE_LIMIT_ERRORS as e:
+        return overloaded_response(e)
+    except Exception as e:
+        error_details = traceback.format_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "details": error_details
+        }), 500
+
 @app.route('/uploads/<path:filename>')
 def serve_image(filename):
     """Güvenli bir şekilde yüklenen resmi sunar"""
     filename = secure_filename(filename)
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+@app.route('/pdf/<int:pdf_id>/page/<int:page_number>')
+def page_image(pdf_id, page_number):
+    """
+    Renders one page of a PDF as an image.
+
+    Query parameters: 'zoom' (default 1.0) and 'format' (png or jpeg). When
+    'v' matches the current document version the response is cached as
+    immutable; otherwise clients revalidate with If-None-Match.
+    """
+    try:
+        zoom, image_format = parse_render_args(request.args.get('zoom'), request.args.get('format'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        document = _document_cache.get(str(pdf_id))
+        if document is None or time.time() - document.checked_at >= DOCUMENT_REVALIDATE_SECONDS:
+            response = supabase.table("pdfs").select("id, file_name").eq("id", pdf_id).execute()
+            if not response.data:
+                return jsonify({"error": "PDF not found."}), 404
+            documents = load_documents(response.data)
+            if not documents:
+                return jsonify({"error": "PDF could not be loaded."}), 500
+            document = documents[0]
+
+        if not 1 <= page_number <= len(document.page_texts):
+            return jsonify({"error": f"The PDF has {len(document.page_texts)} pages."}), 404
+
+        etag = render_etag(document.page_key(page_number), zoom, image_format)
+        if request.args.get('v') == document.version:
+            cache_control = "public, max-age=31536000, immutable"
+        else:
+            cache_control = "no-cache"
+
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            response = Response(status=304)
+        else:
+            image = render_page(document, page_number, zoom, image_format)
+            response = Response(image, mimetype=RENDER_FORMATS[image_format])
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = cache_control
+        response.headers['X-Document-Version'] = document.version
+        return response
+
+    except Exception as e:
+        error_details = traceback.format_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "details": error_details
+        }), 500
+
 # PDF'i Supabase'e yükleyen ve kaydeden fonksiyon
 def upload_pdf_to_supabase(file, filename):
     """
@@ -1125,6 +4754,9 @@ def upload_pdf_to_supabase(file, filename):
                 # Fallback to a random ID
                 pdf_id = str(uuid.uuid4())
         
+        # Cached artifacts belong to the previous file
+        forget_document(pdf_id)
+        
         return {"id": pdf_id, "file_path": f"pdfs/{filename}"}
         
     except Exception as e:
@@ -1132,7 +4764,7 @@ def upload_pdf_to_supabase(file, filename):
         return None
 
 # Soru-cevap oturumunu Supabase'e kaydeden fonksiyon
-def save_qa_session(pdf_id, question, answer):
+def save_qa_session(pdf_id, question, answer, raise_errors: bool = False):
     """
     Saves a question-answer session to Supabase.
     
@@ -1140,6 +4772,7 @@ def save_qa_session(pdf_id, question, answer):
         pdf_id: ID of the PDF record
         question: Question asked
         answer: Answer given
+        raise_errors: Raise failures instead of returning None
     
     Returns:
         dict: The created QA record
@@ -1156,11 +4789,43 @@ def save_qa_session(pdf_id, question, answer):
         return response.data[0] if response.data else None
         
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"QA saving error: {str(e)}")
         return None
 
+# Birden fazla soru-cevabı tek seferde Supabase'e kaydeden fonksiyon
+def save_qa_sessions_bulk(qa_records):
+    """
+    Saves many question-answer sessions to Supabase with a single insert.
+
+    Args:
+        qa_records: List of (pdf_id, question, answer) tuples
+
+    Returns:
+        list: The created QA records
+    """
+    if not qa_records:
+        return []
+
+    try:
+        response = supabase.table("qa_sessions").insert([
+            {
+                "pdf_id": pdf_id,
+                "question": question,
+                "answer": answer
+            }
+            for pdf_id, question, answer in qa_records
+        ]).execute()
+
+        return response.data or []
+
+    except Exception as e:
+        print(f"Bulk QA saving error: {str(e)}")
+        return []
+
 # Üretilen içeriği Supabase'e kaydeden fonksiyon
-def save_generated_content(pdf_id, content_type, content):
+def save_generated_content(pdf_id, content_type, content, raise_errors: bool = False):
     """
     Saves generated content to Supabase.
     
@@ -1168,6 +4833,7 @@ def save_generated_content(pdf_id, content_type, content):
         pdf_id: ID of the PDF record
         content_type: Content type ('summary', 'quiz', 'key_concepts')
         content: Generated content
+        raise_errors: Raise failures instead of returning None
     
     Returns:
         dict: The created content record
@@ -1184,9 +4850,43 @@ def save_generated_content(pdf_id, content_type, content):
         return response.data[0] if response.data else None
         
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Content saving error: {str(e)}")
         return None
 
+# Dosyalar için eksik pdfs kayıtlarını toplu ekleyen fonksiyon
+def upsert_pdf_records(filenames: list, chunk_size: int = PDF_RECORD_CHUNK) -> dict:
+    """
+    Makes sure every file has a row in the pdfs table. Each chunk of names
+    costs one select and at most one insert, instead of a query per file.
+
+    Args:
+        filenames: Names of the files in the pdfs bucket
+
+    Returns:
+        dict: File name -> PDF record
+    """
+    records = {}
+    filenames = list(dict.fromkeys(filenames))
+    for start in range(0, len(filenames), chunk_size):
+        chunk = filenames[start:start + chunk_size]
+        existing = supabase.table("pdfs").select("*").in_("file_name", chunk).execute().data or []
+        records.update((record["file_name"], record) for record in existing)
+        missing = [filename for filename in chunk if filename not in records]
+        if missing:
+            inserted = supabase.table("pdfs").insert([
+                {
+                    "file_name": filename,
+                    "file_path": f"pdfs/{filename}",
+                    "title": filename.replace(".pdf", ""),
+                    "description": "PDF file"
+                }
+                for filename in missing
+            ]).execute().data or []
+            records.update((record["file_name"], record) for record in inserted)
+    return records
+
 # Pdfs tablosunu kontrol eden ve oluşturan fonksiyon
 def ensure_pdfs_table_exists():
     """Pdfs tablosunu oluştur ve gerekli sütunların var olduğundan emin ol"""
@@ -1285,28 +4985,13 @@ def get_all_pdfs():
                 
                 print(f"Storage has {len(pdf_files)} PDF files.")
                 
-                # Storage'da dosya varsa veritabanına ekle
+                # Storage'da dosya varsa veritabanına toplu ekle
                 if pdf_files:
-                    added_count = 0
-                    for file in pdf_files:
-                        filename = file.get("name")
-                        if filename:
-                            print(f"PDF file found: {filename}, adding to database...")
-                            # Veritabanına kayıt ekle
-                            try:
-                                insert_response = supabase.table("pdfs").insert({
-                                    "file_name": filename,
-                                    "file_path": f"pdfs/{filename}",
-                                    "title": filename.replace(".pdf", ""),
-                                    "description": "PDF file"
-                                    # created_at column error, removed
-                                }).execute()
-                                print(f"{filename} added to database.")
-                                added_count += 1
-                            except Exception as e:
-                                print(f"PDF record insertion error: {str(e)}")
-                    
-                    print(f"Total {added_count} PDF files added to database.")
+                    try:
+                        added = upsert_pdf_records([file.get("name") for file in pdf_files])
+                        print(f"Total {len(added)} PDF files added to database.")
+                    except Exception as e:
+                        print(f"PDF record insertion error: {str(e)}")
                     
                     # Tekrar PDF tablosunu sorgula
                     response = supabase.table("pdfs").select("*").execute()
@@ -1323,6 +5008,486 @@ def get_all_pdfs():
         print(f"Error details: {traceback_str}")
         return []
 
+def _activity_age_hours(created_at, now: datetime) -> float:
+    """Age of an activity row in hours; rows without a readable timestamp count as new"""
+    try:
+        moment = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+    except (TypeError, ValueError):
+        return 0.0
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max(0.0, (now - moment).total_seconds() / 3600)
+
+def rank_popular_documents(limit: int = WARMUP_TOP_DOCUMENTS, lookback_days: int = WARMUP_LOOKBACK_DAYS) -> list:
+    """
+    Ranks PDFs by their recent activity in qa_sessions and generated_content.
+    Every row adds its table's weight, halved for each WARMUP_HALF_LIFE_HOURS
+    of age, so a burst of questions today outranks last week's.
+
+    Returns:
+        list: (pdf_id, score) tuples, most popular first
+    """
+    now = datetime.now(timezone.utc)
+    since = (now - timedelta(days=lookback_days)).isoformat()
+    scores = {}
+    for table, weight in WARMUP_ACTIVITY_WEIGHTS.items():
+        try:
+            rows = supabase.table(table).select("pdf_id, created_at").gte("created_at", since) \
+                .order("created_at", desc=True).limit(WARMUP_ACTIVITY_ROWS).execute().data or []
+        except Exception as e:
+            print(f"Activity query error ({table}): {str(e)}")
+            continue
+        for row in rows:
+            if row.get("pdf_id") is None:
+                continue
+            decay = 0.5 ** (_activity_age_hours(row.get("created_at"), now) / WARMUP_HALF_LIFE_HOURS)
+            scores[str(row["pdf_id"])] = scores.get(str(row["pdf_id"]), 0.0) + weight * decay
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+def warm_document(record: dict, storage_entries: dict, bucket_name: str = "pdfs") -> tuple:
+    """
+    Runs the load of a document the first question would otherwise wait
+    for: page texts and hashes, page costs, image index, payload class and
+    the overview (a model call the first time), and keeps the PDF file in
+    memory so later loads of this version skip the download.
+
+    Returns:
+        (DocumentArtifacts, bytes the document holds in memory)
+    """
+    entry = storage_entries.get(record["file_name"].split("/")[-1])
+    pdf_bytes = cached_pdf_bytes(record["id"], entry)
+    if pdf_bytes is None:
+        pdf_bytes, entry = download_pdf_from_storage(record["file_name"], bucket_name)
+    assistant = InteractivePDFAssistant(api_key)
+    if not assistant.load_pdf_bytes(record["id"], record["file_name"], pdf_bytes, storage_fingerprint(entry)):
+        raise RuntimeError("PDF loading failed.")
+    document = assistant.document
+    get_page_costs(document.version, assistant.pdf_raw_bytes, document.page_texts)
+    return document, len(assistant.pdf_raw_bytes) + getattr(document.page_texts, "size_bytes", 0)
+
+# Aynı anda tek ısıtma çalışır; son raporu admin ucu gösterir
+_warmup_lock = threading.Lock()
+_last_warmup_report = {"status": "never run"}
+
+def warm_popular_documents(limit: int = WARMUP_TOP_DOCUMENTS, time_budget: float = WARMUP_TIME_BUDGET_SECONDS,
+                           memory_budget_mb: int = WARMUP_MEMORY_BUDGET_MB, bucket_name: str = "pdfs") -> dict:
+    """
+    Pre-ingests the most popular documents so their first users do not pay
+    the ingestion cost after a deploy or cold start.
+
+    The first pass prepares what a first question needs (see warm_document),
+    most popular document first. With the budget left, a second pass builds
+    the passage indexes and page thumbnails. Documents that do not fit the
+    time or memory budget are skipped.
+
+    Returns:
+        dict: Report of the run, or {"status": "running"} if one is already running
+    """
+    global _last_warmup_report
+    if not _warmup_lock.acquire(blocking=False):
+        return {"status": "running"}
+    try:
+        started = time.monotonic()
+        deadline = started + time_budget
+        memory_budget = memory_budget_mb * 1024 * 1024
+        used = 0
+        report = {"status": "running", "started_at": time.time(), "warmed": [], "skipped": [], "errors": []}
+        _last_warmup_report = report
+
+        ranked = rank_popular_documents(limit)
+        report["ranked"] = [{"pdf_id": pdf_id, "score": round(score, 3)} for pdf_id, score in ranked]
+        records, entries = {}, {}
+        if ranked:
+            response = supabase.table("pdfs").select("id, file_name").in_("id", [pdf_id for pdf_id, _ in ranked]).execute()
+            records = {str(record["id"]): record for record in response.data or []}
+            with metrics.span("storage_list"):
+                entries = {entry.get("name"): entry for entry in supabase.storage.from_(bucket_name).list()}
+
+        documents = []
+        for pdf_id, _ in ranked:
+            if pdf_id not in records:
+                report["skipped"].append({"pdf_id": pdf_id, "reason": "no pdf record"})
+            elif time.monotonic() >= deadline:
+                report["skipped"].append({"pdf_id": pdf_id, "reason": "time budget"})
+            elif used >= memory_budget:
+                report["skipped"].append({"pdf_id": pdf_id, "reason": "memory budget"})
+            else:
+                try:
+                    with metrics.span("warmup_document"):
+                        document, added = warm_document(records[pdf_id], entries, bucket_name)
+                    used += added
+                    documents.append(document)
+                    report["warmed"].append({"pdf_id": pdf_id, "pages": len(document.page_texts), "bytes": added})
+                except Exception as e:
+                    print(f"Warm-up error ({records[pdf_id]['file_name']}): {str(e)}")
+                    report["errors"].append({"pdf_id": pdf_id, "error": str(e)})
+
+        indexed = 0
+        for document in documents:
+            if time.monotonic() >= deadline:
+                break
+            document.index
+            prerender_pages(document)
+            indexed += 1
+
+        report.update({
+            "status": "done",
+            "indexed": indexed,
+            "memory_bytes": used,
+            "seconds": round(time.monotonic() - started, 3),
+        })
+        print(f"Warm-up: {len(documents)} documents warmed, {len(report['skipped'])} skipped in {report['seconds']} s.")
+        return report
+    except Exception as e:
+        print(f"Warm-up error: {str(e)}")
+        _last_warmup_report = {"status": "error", "error": str(e)}
+        return _last_warmup_report
+    finally:
+        _warmup_lock.release()
+
+def start_warmup(interval: int = 0, run_now: bool = True):
+    """Runs the warm-up in a background thread now and/or every `interval` seconds"""
+    def run():
+        if run_now:
+            warm_popular_documents()
+        while interval > 0:
+            time.sleep(interval)
+            warm_popular_documents()
+    if run_now or interval > 0:
+        threading.Thread(target=run, name="warmup", daemon=True).start()
+
+_app_initialized = False
+_app_init_lock = threading.Lock()
+
+def init_app():
+    """
+    Starts the background work of a serving process (the warm-up of popular
+    documents), once per process. It runs on the first request under any
+    WSGI server; call it from a server hook (e.g. gunicorn's
+    post_worker_init) to warm up before the first request.
+    """
+    global _app_initialized
+    with _app_init_lock:
+        if _app_initialized:
+            return
+        _app_initialized = True
+    start_warmup(WARMUP_INTERVAL_SECONDS, run_now=WARMUP_ON_STARTUP)
+
+@app.before_request
+def init_on_first_request():
+    if not _app_initialized:
+        init_app()
+
+def most_requested_generation(pdf_id) -> str:
+    """The PREFETCH_GENERATIONS type users generated most for this document, or over all documents"""
+    counts = {}
+    for scope in (pdf_id, None):
+        try:
+            query = supabase.table("generated_content").select("content_type")
+            if scope is not None:
+                query = query.eq("pdf_id", scope)
+            rows = query.order("created_at", desc=True).limit(PREFETCH_HISTORY_ROWS).execute().data or []
+        except Exception as e:
+            print(f"Generation history query error: {str(e)}")
+            rows = []
+        counts = {kind: sum(1 for row in rows if row.get("content_type") == kind) for kind in PREFETCH_GENERATIONS}
+        if any(counts.values()):
+            break
+    return max(PREFETCH_GENERATIONS, key=lambda kind: counts.get(kind, 0))
+
+# Tarayıcı oturumu -> süren ön hazırlık; oturum yeni bir PDF seçince eskisi iptal edilir
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+_prefetches = {}
+_prefetches_lock = threading.Lock()
+
+def prefetch_document(state: dict, session_id: str, pdf_id, filename: str, api_key: str):
+    """
+    Speculative work for a just selected document, in the lowest priority
+    admission lane and within PREFETCH_TIME_BUDGET_SECONDS:
+
+    1. Loads the conversation's assistant into the pool (ingestion and the
+       overview), so the first question starts warm.
+    2. Generates the most requested content type of the document on a
+       detached copy of that assistant (no second load), outside the
+       conversation lock, into the generation cache.
+
+    Setting state["cancel"] stops the work before its next step or model call.
+    """
+    cancel = state["cancel"]
+    token = _model_cancel.set(cancel)
+    result = "done"
+    try:
+        with model_lane("speculative"), model_deadline(PREFETCH_TIME_BUDGET_SECONDS):
+            if cancel.is_set():
+                raise Cancelled()
+            # Known before the load, so a request for it joins this work from the start
+            state["planned"] = most_requested_generation(pdf_id)
+            state["task"] = "load"
+            with metrics.span("prefetch_load"):
+                with assistant_pool.checkout(session_id, pdf_id, filename, api_key) as assistant:
+                    if assistant is None:
+                        raise ValueError("PDF loading failed.")
+                    speculative = assistant.detached()
+
+            state["task"] = state["planned"]
+            if cancel.is_set():
+                raise Cancelled()
+            with metrics.span(f"prefetch_{state['task']}"):
+                if state["task"] == "summary":
+                    speculative.generate_summary(PREFETCH_SUMMARY_DETAIL)
+                else:
+                    speculative.extract_key_concepts()
+            if cancel.is_set():
+                result = "cancelled"
+    except (Cancelled, Overloaded):
+        result = "cancelled" if cancel.is_set() else "shed"
+    except Exception as e:
+        print(f"Prefetch error ({filename}): {str(e)}")
+        result = "error"
+    finally:
+        _model_cancel.reset(token)
+        state["done"].set()
+        with _prefetches_lock:
+            if _prefetches.get(session_id) is state:
+                del _prefetches[session_id]
+        metrics.inc("pdf_assistant_prefetch_total", task=state["task"], result=result)
+
+def start_prefetch(session_id: str, pdf_id, filename: str, api_key: str):
+    """Starts speculative work for a selected document, cancelling the session's previous one"""
+    if not PREFETCH_ENABLED:
+        return
+    cancel_prefetch(session_id)
+    state = {"cancel": threading.Event(), "done": threading.Event(), "task": "queued", "planned": None,
+             "pdf_id": str(pdf_id)}
+    with _prefetches_lock:
+        _prefetches[session_id] = state
+    _prefetch_executor.submit(prefetch_document, state, session_id, pdf_id, filename, api_key)
+
+def cancel_prefetch(session_id: str):
+    with _prefetches_lock:
+        state = _prefetches.pop(session_id, None)
+    if state is not None:
+        state["cancel"].set()
+
+def join_prefetch(session_id: str, pdf_id, task: str, timeout: float = PREFETCH_JOIN_SECONDS):
+    """
+    Waits for the session's speculative `task` if it is planned or running,
+    so the request reads its result from the cache. While the prefetch still
+    loads the conversation the request would wait for its lock anyway.
+    """
+    with _prefetches_lock:
+        state = _prefetches.get(session_id)
+    if state is not None and state["pdf_id"] == str(pdf_id) and state["planned"] == task \
+            and state["task"] in ("load", task):
+        with metrics.span("prefetch_join"):
+            state["done"].wait(timeout)
+
+metrics.describe("pdf_assistant_prefetch_total", "counter", "Speculative prefetches by task and result (done, cancelled, shed, error).")
+
+# İstek metrikleri
+CHAT_MODES = {'chat', 'generate_quiz', 'generate_summary', 'extract_key_concepts'}
+GENERATION_MODES = {'generate_quiz', 'generate_summary', 'extract_key_concepts'}
+
+def _request_mode():
+    """Returns the conversation mode label of the current request"""
+    if request.endpoint == 'batch_chat':
+        return 'batch'
+    if request.endpoint != 'chat':
+        return ''
+    if request.is_json:
+        mode = (request.get_json(silent=True) or {}).get('mode', 'chat')
+    else:
+        mode = request.form.get('mode', 'chat')
+    return mode if mode in CHAT_MODES else 'invalid'
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc("pdf_assistant_requests_in_flight", 1, route=g.metrics_route)
+    if memory_profiler.enabled:
+        g.memory_tracking = contextlib.ExitStack()
+        g.memory_tracking.enter_context(memory_profiler.track("route", g.metrics_route))
+
+@app.after_request
+def record_request_metrics(response):
+    if 'metrics_started' in g:
+        metrics.observe(
+            "pdf_assistant_request_seconds",
+            time.perf_counter() - g.metrics_started,
+            route=g.metrics_route,
+            mode=_request_mode(),
+            status=response.status_code
+        )
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if 'metrics_route' in g:
+        metrics.inc("pdf_assistant_requests_in_flight", -1, route=g.metrics_route)
+    if 'memory_tracking' in g:
+        g.memory_tracking.close()
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def require_admin():
+    """Allows admin endpoints with the ADMIN_TOKEN bearer token, or from localhost when no token is set"""
+    if ADMIN_TOKEN:
+        if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+            abort(401)
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+
+@app.route('/admin/warmup', methods=['GET', 'POST'])
+def admin_warmup():
+    """
+    GET returns the report of the last warm-up. POST starts one in the
+    background; with 'wait' set it runs in the request and returns the report.
+    Optional 'limit' overrides the number of documents.
+    """
+    require_admin()
+    if request.method == 'GET':
+        return jsonify(_last_warmup_report)
+
+    params = request.get_json(silent=True) or request.form
+    try:
+        limit = int(params.get('limit', WARMUP_TOP_DOCUMENTS))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "'limit' must be a number."}), 400
+
+    if str(params.get('wait', '')).lower() in ('1', 'true', 'yes'):
+        return jsonify(warm_popular_documents(limit))
+    if _warmup_lock.locked():
+        return jsonify({"status": "running"}), 409
+    threading.Thread(target=warm_popular_documents, args=(limit,), name="warmup", daemon=True).start()
+    return jsonify({"status": "started"}), 202
+
+@app.route('/admin/memory', methods=['GET', 'POST'])
+def admin_memory():
+    """
+    GET returns the memory profile: tracing status, kept snapshots and the
+    traced peak, retained memory and top allocation sites per stage and
+    route. POST runs an 'action':
+        start / stop / reset  switch profiling on or off, or drop the statistics
+        snapshot              keep a snapshot ('label'; 'dump' also writes it to disk)
+        diff                  top growing sites from snapshot 'base' to 'target'
+                              (a fresh snapshot if omitted); 'key' is lineno,
+                              filename or traceback, 'limit' the number of sites
+    """
+    require_admin()
+    if request.method == 'GET':
+        return jsonify({**memory_profiler.status(), "profile": memory_profiler.report()})
+
+    params = request.get_json(silent=True) or request.form
+    action = params.get('action')
+    try:
+        if action == 'start':
+            memory_profiler.start()
+        elif action == 'stop':
+            memory_profiler.stop()
+        elif action == 'reset':
+            memory_profiler.reset()
+        elif action == 'snapshot':
+            dump = str(params.get('dump', '')).lower() in ('1', 'true', 'yes')
+            return jsonify({"id": memory_profiler.snapshot(params.get('label', ''), dump=dump)})
+        elif action == 'diff':
+            limit = int(params.get('limit', MEMORY_PROFILING_TOP))
+            return jsonify({"sites": memory_profiler.diff(
+                params.get('base'), params.get('target'), params.get('key', 'lineno'), limit
+            )})
+        else:
+            return jsonify({"success": False, "error": "Unknown action."}), 400
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify(memory_profiler.status())
+
+# Statik dosyaların sıkıştırılmış halleri: (ETag, encoding) -> bytes
+_static_compression_cache = LRUCache(max_entries=STATIC_COMPRESSION_CACHE_SIZE)
+
+def _preferred_encoding() -> str:
+    """Picks the best content encoding the client accepts"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESSION_GZIP_LEVEL)
+
+@app.after_request
+def compress_response(response):
+    """
+    Adds ETags to static and content-addressed GET responses
+    (CONDITIONAL_GET_ENDPOINTS), answers If-None-Match for them with 304 and
+    compresses text responses. Live endpoints such as /metrics,
+    /pdf_load_status and /admin/* never get a 304. Streamed responses pass
+    through unchanged, except static files, which are small and read into
+    memory.
+    """
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    is_static = request.endpoint == 'static'
+    if response.is_streamed and not is_static:
+        return response
+
+    # Doğrulayıcı (ETag) ve koşullu istek
+    etag, weak = response.get_etag()
+    if request.method in ('GET', 'HEAD') and request.endpoint in CONDITIONAL_GET_ENDPOINTS:
+        if etag is None and 'no-store' not in response.headers.get('Cache-Control', ''):
+            response.add_etag()
+            etag, weak = response.get_etag()
+        if etag and any(
+            request.if_none_match.contains_weak(tag)
+            for tag in (etag, f"{etag}-gzip", f"{etag}-br")
+        ):
+            not_modified = Response(status=304)
+            for header in ('ETag', 'Cache-Control', 'Vary', 'Expires', 'Last-Modified'):
+                if header in response.headers:
+                    not_modified.headers[header] = response.headers[header]
+            not_modified.vary.add('Accept-Encoding')
+            encoding = _preferred_encoding()
+            if encoding and response.mimetype in COMPRESSIBLE_MIMETYPES:
+                not_modified.set_etag(f"{etag}-{encoding}", weak)
+            return not_modified
+
+    # Sıkıştırma
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _preferred_encoding()
+    if encoding is None:
+        return response
+    if response.content_length is not None and response.content_length < COMPRESSION_MIN_BYTES:
+        return response
+
+    cache_key = (etag, encoding) if is_static and etag else None
+    body = _static_compression_cache.get(cache_key) if cache_key else None
+    if body is not None and hasattr(response.response, 'close'):
+        response.response.close()  # Dosya okunmadı, yalnızca kapat
+    if body is None:
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_BYTES:
+            return response
+        body = _compress(data, encoding)
+        if cache_key:
+            _static_compression_cache.put(cache_key, body)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
 # CORS başlıkları
 @app.after_request
 def add_cors_headers(response):
@@ -1395,10 +5560,17 @@ if __name__ == '__main__':
     except Exception as e:
         print(f"Supabase connection error: {str(e)}")
     
+    # Popüler PDF'leri hemen ısıt; debug modunda yalnızca uygulamayı çalıştıran alt süreçte
+    # (diğer sunucularda init_app ilk istekte çalışır)
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        init_app()
+    
     app.run(debug=True, threaded=True, host='0.0.0.0') 
 
 # PDF yükleme durumunu kontrol eden yeni endpoint
 @app.route('/pdf_load_status', methods=['GET'])
+@with_model_deadline()
+@with_model_lane("ingestion")
 def pdf_load_status():
     """PDF yükleme durumunu kontrol eder"""
     pdf_id = request.args.get('pdf_id')
@@ -1434,15 +5606,19 @@ def pdf_load_status():
             return jsonify({"success": False, "status": "error", "message": "API key not found"})
         
         try:
-            # Asistanı oluştur ve PDF'i yüklemeye çalış
-            assistant = InteractivePDFAssistant(api_key)
-            load_success = assistant.load_pdf_from_supabase(pdf_id, filename)
+            # Bu sohbetin asistanını yükle; havuzda kalır, ilk soru hazır PDF'le başlar
+            with assistant_pool.checkout(session_client_id(), pdf_id, filename, api_key) as assistant:
+                loaded = assistant is not None
+                version = assistant.pdf_version if loaded else None
+                page_count = len(assistant.page_texts) if loaded else 0
             
-            if load_success:
+            if loaded:
                 return jsonify({
                     "success": True,
                     "status": "ready",
-                    "message": f"PDF loaded: {filename}"
+                    "message": f"PDF loaded: {filename}",
+                    "version": version,
+                    "page_count": page_count
                 })
             else:
                 return jsonify({
@@ -0,0 +1,808 @@
+"""
+Offline end-to-end benchmark for app.py.
+
+Replaces Supabase with an in-memory storage/table fake and Gemini with a
+deterministic fake model, generates synthetic PDFs and drives /select_pdf,
+/pdf_load_status, every /chat mode, /batch_chat and /multi_chat concurrently through the
+Flask test client. Reports p50/p95/p99 latency, throughput and peak RSS per
+scenario and can save or compare against baselines.
+
+Usage:
+    python benchmark.py                         # default suite
+    python benchmark.py --suite full            # up to 64 MB PDFs
+    python benchmark.py --save-baseline main    # benchmarks/baselines/main.json
+    python benchmark.py --compare main
+    python benchmark.py --load-size-mb 64      # memory of one PDF load against its budget
+    python benchmark.py --page-store           # memory vs. access time of compressed page texts
+"""
+import os
+import io
+import sys
+import json
+import re
+import time
+import random
+import zlib
+import argparse
+import threading
+import contextlib
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+# app.py creates a Supabase client at import time; the fake replaces it before use
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "benchmark.fake.key")
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark-fake-key")
+os.environ.setdefault("WARMUP_ON_STARTUP", "0")  # scenarios measure their own cold and warm requests
+
+import fitz
+from PIL import Image
+
+import app as pdf_app
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "baselines")
+
+CHAT_REQUESTS = [
+    ("chat", {"mode": "chat", "question": "What is the main topic of this document?"}),
+    ("chat_pages", {"mode": "chat", "question": "What do these pages explain?", "pages": "1-2"}),
+    ("generate_quiz", {"mode": "generate_quiz", "num_questions": "5"}),
+    ("generate_summary", {"mode": "generate_summary", "detail_level": "medium"}),
+    ("extract_key_concepts", {"mode": "extract_key_concepts"}),
+]
+
+# name, pages, images per page, target size in bytes
+SUITES = {
+    "quick": [
+        ("text-10k", 2, 0, 10 * 1024),
+        ("mixed-1m", 20, 1, 1024 * 1024),
+    ],
+    "default": [
+        ("text-10k", 2, 0, 10 * 1024),
+        ("text-300p", 300, 0, 0),
+        ("mixed-1m", 20, 1, 1024 * 1024),
+        ("images-8m", 50, 2, 8 * 1024 * 1024),
+        ("images-24m", 100, 3, 24 * 1024 * 1024),
+    ],
+    "full": [
+        ("text-10k", 2, 0, 10 * 1024),
+        ("text-300p", 300, 0, 0),
+        ("mixed-1m", 20, 1, 1024 * 1024),
+        ("images-8m", 50, 2, 8 * 1024 * 1024),
+        ("images-24m", 100, 3, 24 * 1024 * 1024),
+        ("images-64m", 200, 2, 64 * 1024 * 1024),
+    ],
+}
+
+
+# ---------------------------------------------------------------------------
+# Fake Supabase
+# ---------------------------------------------------------------------------
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeBucket:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeStorageBucket:
+    """In-memory replacement for `supabase.storage.from_(bucket)`"""
+
+    def __init__(self, storage, bucket):
+        self._storage = storage
+        self._bucket = bucket
+
+    def _files(self):
+        return self._storage.files.setdefault(self._bucket, {})
+
+    def list(self, *args, **kwargs):
+        self._storage.delay()
+        with self._storage.lock:
+            return [{"name": name, "metadata": {"size": len(data)}} for name, data in self._files().items()]
+
+    def download(self, path):
+        with self._storage.lock:
+            data = self._files().get(path)
+        if data is None:
+            raise Exception(f"Object not found: {path}")
+        self._storage.delay(len(data))
+        return data
+
+    def upload(self, file, path, file_options=None):
+        data = file if isinstance(file, (bytes, bytearray)) else file.read()
+        self._storage.delay(len(data))
+        with self._storage.lock:
+            self._files()[path] = bytes(data)
+        return FakeResult({"Key": f"{self._bucket}/{path}"})
+
+    def remove(self, paths):
+        with self._storage.lock:
+            for path in paths:
+                self._files().pop(path, None)
+        return FakeResult([])
+
+
+class FakeStorage:
+    def __init__(self, latency=0.0, bandwidth_mb_s=0.0):
+        self.files = {"pdfs": {}, "images": {}}
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.bandwidth = bandwidth_mb_s * 1024 * 1024
+
+    def delay(self, size=0):
+        seconds = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        if seconds:
+            time.sleep(seconds)
+
+    def from_(self, bucket):
+        return FakeStorageBucket(self, bucket)
+
+    def list_buckets(self):
+        return [FakeBucket(name) for name in self.files]
+
+    def create_bucket(self, id, options=None):
+        self.files.setdefault(id, {})
+
+    def update_bucket(self, id, options=None):
+        pass
+
+
+class FakeQuery:
+    """Supports the subset of the postgrest query builder used by app.py"""
+
+    def __init__(self, db, table):
+        self._db = db
+        self._table = table
+        self._action = "select"
+        self._payload = None
+        self._filters = []
+        self._in_filters = []
+        self._order = None
+        self._limit = None
+
+    def select(self, *columns, **kwargs):
+        self._action = "select"
+        return self
+
+    def insert(self, rows, **kwargs):
+        self._action, self._payload = "insert", rows
+        return self
+
+    def upsert(self, rows, **kwargs):
+        self._action, self._payload = "upsert", rows
+        return self
+
+    def update(self, values):
+        self._action, self._payload = "update", values
+        return self
+
+    def delete(self):
+        self._action = "delete"
+        return self
+
+    def eq(self, column, value):
+        self._filters.append((column, value))
+        return self
+
+    def in_(self, column, values):
+        self._in_filters.append((column, set(str(v) for v in values)))
+        return self
+
+    def gte(self, column, value):
+        return self
+
+    def order(self, column, desc=False):
+        self._order = (column, desc)
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def _matches(self, row):
+        return all(str(row.get(c)) == str(v) for c, v in self._filters) and \
+            all(str(row.get(c)) in values for c, values in self._in_filters)
+
+    def execute(self):
+        self._db.delay()
+        with self._db.lock:
+            rows = self._db.tables.setdefault(self._table, [])
+            if self._action in ("insert", "upsert"):
+                new_rows = self._payload if isinstance(self._payload, list) else [self._payload]
+                created = []
+                for values in new_rows:
+                    row = dict(values)
+                    existing = None
+                    if self._action == "upsert":
+                        existing = next((r for r in rows if r.get("file_name") == row.get("file_name")), None)
+                    if existing is not None:
+                        existing.update(row)
+                        created.append(dict(existing))
+                        continue
+                    row.setdefault("id", str(self._db.next_id()))
+                    row.setdefault("created_at", time.strftime("%Y-%m-%dT%H:%M:%S"))
+                    rows.append(row)
+                    created.append(dict(row))
+                return FakeResult(created)
+            matched = [r for r in rows if self._matches(r)]
+            if self._action == "update":
+                for row in matched:
+                    row.update(self._payload)
+            elif self._action == "delete":
+                self._db.tables[self._table] = [r for r in rows if not self._matches(r)]
+            if self._order:
+                column, desc = self._order
+                matched.sort(key=lambda r: str(r.get(column, "")), reverse=desc)
+            if self._limit is not None:
+                matched = matched[:self._limit]
+            return FakeResult([dict(r) for r in matched])
+
+
+class FakeSupabase:
+    """In-memory stand-in for the Supabase client (storage + tables)"""
+
+    def __init__(self, latency=0.0, bandwidth_mb_s=0.0):
+        self.storage = FakeStorage(latency, bandwidth_mb_s)
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.latency = latency
+        self._id = 0
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def next_id(self):
+        self._id += 1
+        return self._id
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+# ---------------------------------------------------------------------------
+# Fake Gemini
+# ---------------------------------------------------------------------------
+
+class FakeUsage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens, output_tokens):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt_tokens, output_tokens)
+
+
+class FakeModelProfile:
+    """Latency model of the fake: base + per input MB + jitter, deterministic per seed"""
+
+    def __init__(self, latency=0.05, per_mb=0.01, jitter=0.02, error_rate=0.0, seed=1234):
+        self.latency = latency
+        self.per_mb = per_mb
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self, input_bytes):
+        with self._lock:
+            jitter = self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+        return self.latency + self.per_mb * input_bytes / (1024 * 1024) + jitter, fail
+
+
+FAKE_MODEL_PROFILE = FakeModelProfile()
+FAKE_MODEL_PROFILES = {}  # Model name -> FakeModelProfile, for models that behave unlike the default
+
+
+def _content_size(contents):
+    """Bytes and approximate tokens of a contents list"""
+    size, text = 0, []
+    for part in contents if isinstance(contents, list) else [contents]:
+        if isinstance(part, dict) and "data" in part:
+            size += len(part["data"])
+        elif isinstance(part, dict) and "parts" in part:
+            nested_size, nested_text = _content_size(part["parts"])
+            size += nested_size
+            text.append(nested_text)
+        elif isinstance(part, str):
+            size += len(part)
+            text.append(part)
+    return size, "\n".join(text)
+
+
+def _fake_answer(prompt, generation_config):
+    """Builds a deterministic answer in the format the prompt asks for"""
+    config = generation_config or {}
+    bank = re.search(r"question bank of (\d+) .*? pages (\d+)-(\d+)", prompt)
+    if bank and config.get("response_mime_type") == "application/json":
+        count, first, last = (int(value) for value in bank.groups())
+        return json.dumps([
+            {"question": f"Question {i + 1} about page {first + i % (last - first + 1)}?",
+             "choices": ["First", "Second", "Third", "Fourth"], "answer": i % 4,
+             "page": first + i % (last - first + 1), "topic": f"topic {i % 3}"}
+            for i in range(count)
+        ])
+    if config.get("response_mime_type") == "application/json":
+        numbered = [line for line in prompt.splitlines() if line.strip()[:3].rstrip(".) ").isdigit()]
+        return json.dumps([{"id": i + 1, "answer": f"Answer {i + 1}."} for i in range(max(1, len(numbered)))])
+    return "Fake model answer. " * 20
+
+
+class FakeGenerativeModel:
+    """Drop-in replacement for genai.GenerativeModel"""
+
+    def __init__(self, model_name, generation_config=None, safety_settings=None, **kwargs):
+        self.model_name = model_name
+        self._generation_config = generation_config or {}
+
+    def generate_content(self, contents, generation_config=None, safety_settings=None,
+                         stream=False, request_options=None, **kwargs):
+        size, prompt = _content_size(contents)
+        seconds, fail = FAKE_MODEL_PROFILES.get(self.model_name, FAKE_MODEL_PROFILE).sample(size)
+        timeout = (request_options or {}).get("timeout")
+        if timeout is not None and seconds > timeout:
+            time.sleep(timeout)
+            raise pdf_app.google_exceptions.DeadlineExceeded("Fake model timeout")
+        time.sleep(seconds)
+        if fail:
+            raise pdf_app.google_exceptions.ServiceUnavailable("Fake model unavailable")
+        text = _fake_answer(prompt, generation_config)
+        return FakeResponse(text, size // 4, len(text) // 4)
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    def count_tokens(self, contents, **kwargs):
+        size, _ = _content_size(contents)
+        return FakeUsage(size // 4, 0)
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, generation_config=None, safety_settings=None,
+                     stream=False, request_options=None, **kwargs):
+        response = self.model.generate_content(
+            self.history + [{"role": "user", "parts": content if isinstance(content, list) else [content]}],
+            generation_config=generation_config,
+            request_options=request_options
+        )
+        self.history.append({"role": "user", "parts": content if isinstance(content, list) else [content]})
+        self.history.append({"role": "model", "parts": [response.text]})
+        return response
+
+
+def install_fakes(storage_latency=0.0, bandwidth_mb_s=0.0):
+    """Swaps Supabase and Gemini in app.py for the fakes and returns the fake database"""
+    fake = FakeSupabase(storage_latency, bandwidth_mb_s)
+    pdf_app.supabase = fake
+    pdf_app.genai.GenerativeModel = FakeGenerativeModel
+    pdf_app.genai.configure = lambda **kwargs: None
+    return fake
+
+
+# ---------------------------------------------------------------------------
+# Synthetic PDFs
+# ---------------------------------------------------------------------------
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit. Integer posuere erat a ante venenatis "
+    "dapibus posuere velit aliquet. Cras mattis consectetur purus sit amet fermentum. "
+)
+
+
+def make_pdf(pages, images_per_page=0, target_size=0, seed=0):
+    """
+    Generates a synthetic PDF.
+
+    Text is written on every page; images are random noise so they do not
+    compress, which lets `target_size` be reached with image payload.
+    """
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(
+            fitz.Rect(40, 40, 555, 400),
+            f"Chapter {number // 10 + 1}, page {number + 1}\n" + LOREM * 6,
+            fontsize=9
+        )
+    base_size = len(doc.tobytes())
+
+    image_count = pages * images_per_page
+    if image_count:
+        per_image = max(1024, (target_size - base_size) // image_count) if target_size else 32 * 1024
+        side = max(8, int((per_image / 3) ** 0.5))
+        for number in range(pages):
+            page = doc[number]
+            for index in range(images_per_page):
+                image = Image.frombytes("RGB", (side, side), rng.randbytes(side * side * 3))
+                buffer = io.BytesIO()
+                image.save(buffer, format="PNG", compress_level=0)
+                top = 420 + index * (380 // images_per_page)
+                page.insert_image(fitz.Rect(40, top, 300, top + 360 // images_per_page), stream=buffer.getvalue())
+
+    data = doc.tobytes()
+    doc.close()
+
+    # Pad text-only PDFs up to the target size with an embedded file
+    if target_size and len(data) < target_size and not image_count:
+        doc = fitz.open(stream=data, filetype="pdf")
+        doc.embfile_add("padding.bin", rng.randbytes(target_size - len(data)))
+        data = doc.tobytes()
+        doc.close()
+    return data
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """Samples RSS in a background thread and keeps the peak"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(samples, percent):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(percent / 100.0 * (len(samples) - 1))))]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Scenario driver
+# ---------------------------------------------------------------------------
+
+def run_user(pdf_id, rounds, batch_size):
+    """One virtual user: select the PDF, poll the load status, then use every mode"""
+    client = pdf_app.app.test_client()
+    timings = []
+
+    def timed(name, call):
+        started = time.perf_counter()
+        response = call()
+        timings.append((name, time.perf_counter() - started, response.status_code))
+        return response
+
+    timed("select_pdf", lambda: client.post("/select_pdf", data={"select_existing": "1", "pdf_id": pdf_id}))
+    timed("pdf_load_status", lambda: client.get(f"/pdf_load_status?pdf_id={pdf_id}"))
+    timed("page_image", lambda: client.get(f"/pdf/{pdf_id}/page/1?zoom=0.5"))
+    for _ in range(rounds):
+        for name, form in CHAT_REQUESTS:
+            timed(name, lambda: client.post("/chat", data=form))
+        timed("multi_chat", lambda: client.post("/multi_chat", json={
+            "question": "Which chapters mention lorem ipsum?", "pdf_ids": [pdf_id]
+        }))
+        if batch_size:
+            questions = [f"Question {i + 1} about the document?" for i in range(batch_size)]
+            timed("batch_chat", lambda: client.post("/batch_chat", json={"questions": questions}))
+    return timings
+
+
+def run_scenario(fake, name, pages, images_per_page, target_size, users, rounds, batch_size):
+    pdf_bytes = make_pdf(pages, images_per_page, target_size, seed=zlib.crc32(name.encode()))
+    filename = f"bench_{name}.pdf"
+    fake.storage.files["pdfs"][filename] = pdf_bytes
+    row = fake.table("pdfs").insert({
+        "file_name": filename, "file_path": f"pdfs/{filename}", "title": name, "description": "benchmark"
+    }).execute().data[0]
+
+    timings = []
+    started = time.perf_counter()
+    with RssSampler() as sampler:
+        with ThreadPoolExecutor(max_workers=users) as executor:
+            for user_timings in executor.map(lambda _: run_user(row["id"], rounds, batch_size), range(users)):
+                timings.extend(user_timings)
+    wall = time.perf_counter() - started
+
+    endpoints = {}
+    for endpoint, latency, status in timings:
+        endpoints.setdefault(endpoint, []).append(latency)
+    errors = sum(1 for _, _, status in timings if status >= 400)
+
+    fake.storage.files["pdfs"].pop(filename, None)
+    return {
+        "scenario": name,
+        "pdf_bytes": len(pdf_bytes),
+        "pages": pages,
+        "images_per_page": images_per_page,
+        "users": users,
+        "requests": len(timings),
+        "errors": errors,
+        "wall_seconds": wall,
+        "throughput_rps": len(timings) / wall if wall else None,
+        "peak_rss_bytes": sampler.peak,
+        "latency": summarize([latency for _, latency, _ in timings]),
+        "endpoints": {endpoint: summarize(values) for endpoint, values in endpoints.items()},
+    }
+
+
+def run_load_scenario(fake, size_mb, loads):
+    """
+    Loads one large PDF `loads` times with a fresh assistant and cold caches
+    and measures what a single load allocates: Python heap allocations
+    beyond the downloaded file (tracemalloc) and peak RSS.
+    """
+    pdf_bytes = make_pdf(max(8, size_mb * 3), 1, size_mb * 1024 * 1024, seed=size_mb)
+    filename = f"bench_load_{size_mb}m.pdf"
+    fake.storage.files["pdfs"][filename] = pdf_bytes
+    row = fake.table("pdfs").insert({
+        "file_name": filename, "file_path": f"pdfs/{filename}", "title": filename, "description": "benchmark"
+    }).execute().data[0]
+
+    samples = []
+    for _ in range(loads):
+        pdf_app.forget_document(row["id"])
+        for cache in (pdf_app._pdf_cache, pdf_app._subdocument_cache, pdf_app._page_cost_cache,
+                      pdf_app._page_passage_cache):
+            for key in cache.keys():
+                cache.pop(key)
+        pdf_app.artifact_store.delete(pdf_app.document_version(pdf_bytes), "page_texts.json")
+        pdf_app.artifact_store.delete(pdf_app.document_version(pdf_bytes), "page_hashes.json")
+        pdf_app.artifact_store.delete(pdf_app.document_version(pdf_bytes), "pages.json")
+
+        rss_before = current_rss()
+        tracemalloc.start()
+        started = time.perf_counter()
+        with RssSampler() as sampler:
+            assistant = pdf_app.InteractivePDFAssistant(os.environ["GOOGLE_API_KEY"])
+            loaded = assistant.load_pdf_from_supabase(row["id"], filename)
+        seconds = time.perf_counter() - started
+        _, heap_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del assistant
+        samples.append({
+            "loaded": loaded,
+            "seconds": seconds,
+            "heap_peak_bytes": heap_peak,
+            "rss_growth_bytes": max(0, sampler.peak - rss_before),
+        })
+
+    fake.storage.files["pdfs"].pop(filename, None)
+    heap_peak = max(sample["heap_peak_bytes"] for sample in samples)
+    return {
+        "pdf_bytes": len(pdf_bytes),
+        "loads": loads,
+        "errors": sum(1 for sample in samples if not sample["loaded"]),
+        "seconds": summarize([sample["seconds"] for sample in samples]),
+        "heap_peak_bytes": heap_peak,
+        "heap_ratio": heap_peak / len(pdf_bytes),
+        "budget_ratio": pdf_app.LOAD_ALLOCATION_BUDGET,
+        "rss_growth_bytes": max(sample["rss_growth_bytes"] for sample in samples),
+    }
+
+
+def print_load_report(result):
+    mb = 1024 * 1024
+    within = result["heap_ratio"] <= result["budget_ratio"]
+    print(f"\nPDF load: {result['pdf_bytes'] / mb:.1f} MB x {result['loads']} loads, {result['errors']} errors")
+    print(f"    seconds           p50={result['seconds']['p50']:.3f} p95={result['seconds']['p95']:.3f}")
+    print(f"    heap allocations  {result['heap_peak_bytes'] / mb:.1f} MB = {result['heap_ratio']:.2f}x the PDF "
+          f"(budget {result['budget_ratio']:.2f}x, {'ok' if within else 'OVER BUDGET'})")
+    print(f"    peak RSS growth   {result['rss_growth_bytes'] / mb:.1f} MB")
+    return within
+
+
+def make_page_texts(pages, seed=0):
+    """Page texts drawn from a Zipf-like vocabulary, so they compress like real prose"""
+    rng = random.Random(seed)
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 11)))
+                  for _ in range(5000)]
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    texts = []
+    for _ in range(pages):
+        words = rng.choices(vocabulary, weights, k=450)
+        lines = [" ".join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        texts.append("\n".join(lines))
+    return texts
+
+
+def run_page_store_scenario(pages=300, reads=2000, block_sizes=(1, 2, 4, 8, 16, 32)):
+    """Memory and random/sequential access time of CompressedPageTexts against a plain list"""
+    texts = make_page_texts(pages)
+    rng = random.Random(1)
+    order = [rng.randrange(pages) for _ in range(reads)]
+
+    def measure(store):
+        started = time.perf_counter()
+        for index in order:
+            store[index]
+        random_us = (time.perf_counter() - started) / reads * 1e6
+        started = time.perf_counter()
+        for _ in store:
+            pass
+        return random_us, (time.perf_counter() - started) * 1000
+
+    plain_bytes = sys.getsizeof(texts) + sum(sys.getsizeof(text) for text in texts)
+    rows = [("list", plain_bytes) + measure(texts)]
+    for block_pages in block_sizes:
+        store = pdf_app.CompressedPageTexts(texts, block_pages=block_pages)
+        assert list(store) == texts
+        rows.append((f"block={block_pages}", store.size_bytes) + measure(store))
+
+    print(f"\nPage texts: {pages} pages, {plain_bytes / 1024:.0f} KB as Python strings")
+    print(f"{'store':<12}{'KB':>9}{'ratio':>8}{'random read us':>16}{'full scan ms':>14}")
+    for name, size, random_us, scan_ms in rows:
+        print(f"{name:<12}{size / 1024:>9.0f}{plain_bytes / size:>7.1f}x{random_us:>16.1f}{scan_ms:>14.2f}")
+    return [
+        {"store": name, "bytes": size, "random_read_us": random_us, "full_scan_ms": scan_ms}
+        for name, size, random_us, scan_ms in rows
+    ]
+
+
+def print_report(results):
+    header = f"{'scenario':<14}{'size':>9}{'reqs':>6}{'err':>5}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'rss MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        lat = r["latency"]
+        print(f"{r['scenario']:<14}{r['pdf_bytes'] / 1024 / 1024:>8.1f}M{r['requests']:>6}{r['errors']:>5}"
+              f"{r['throughput_rps']:>8.2f}{lat['p50']:>9.3f}{lat['p95']:>9.3f}{lat['p99']:>9.3f}"
+              f"{r['peak_rss_bytes'] / 1024 / 1024:>9.1f}")
+        for endpoint, stats in sorted(r["endpoints"].items()):
+            print(f"    {endpoint:<22}n={stats['count']:<4} p50={stats['p50']:.3f} p95={stats['p95']:.3f} p99={stats['p99']:.3f}")
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change against a baseline; returns True if nothing regressed beyond `tolerance`"""
+    by_name = {r["scenario"]: r for r in baseline["results"]}
+    ok = True
+    print(f"\nComparison with baseline '{baseline['name']}' (tolerance {tolerance:.0%}):")
+    for r in results:
+        base = by_name.get(r["scenario"])
+        if not base:
+            print(f"  {r['scenario']}: no baseline")
+            continue
+        checks = [
+            ("p50", r["latency"]["p50"], base["latency"]["p50"], True),
+            ("p95", r["latency"]["p95"], base["latency"]["p95"], True),
+            ("p99", r["latency"]["p99"], base["latency"]["p99"], True),
+            ("rps", r["throughput_rps"], base["throughput_rps"], False),
+            ("rss", r["peak_rss_bytes"], base["peak_rss_bytes"], True),
+        ]
+        parts = []
+        for label, value, reference, lower_is_better in checks:
+            if not reference:
+                continue
+            change = (value - reference) / reference
+            regressed = change > tolerance if lower_is_better else change < -tolerance
+            ok = ok and not regressed
+            parts.append(f"{label} {change:+.1%}{' !' if regressed else ''}")
+        print(f"  {r['scenario']}: " + ", ".join(parts))
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the PDF assistant")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="default")
+    parser.add_argument("--scenario", action="append", help="Run only the named scenario(s)")
+    parser.add_argument("--users", type=int, default=4, help="Concurrent virtual users per scenario")
+    parser.add_argument("--rounds", type=int, default=2, help="Passes over every /chat mode per user")
+    parser.add_argument("--batch-size", type=int, default=20, help="Questions per /batch_chat call (0 to skip)")
+    parser.add_argument("--model-latency", type=float, default=0.05, help="Fake model base latency (s)")
+    parser.add_argument("--model-latency-per-mb", type=float, default=0.01, help="Extra fake latency per input MB (s)")
+    parser.add_argument("--model-jitter", type=float, default=0.02, help="Uniform fake latency jitter (s)")
+    parser.add_argument("--model-error-rate", type=float, default=0.0, help="Share of fake calls failing with 503")
+    parser.add_argument("--storage-latency", type=float, default=0.0, help="Fake Supabase round trip (s)")
+    parser.add_argument("--storage-bandwidth", type=float, default=0.0, help="Fake download bandwidth (MB/s, 0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression for --compare")
+    parser.add_argument("--verbose", action="store_true", help="Keep the application's log output")
+    parser.add_argument("--load-size-mb", type=int, help="Only measure the memory of loading a PDF of this size")
+    parser.add_argument("--loads", type=int, default=3, help="Repetitions for --load-size-mb")
+    parser.add_argument("--page-store", action="store_true", help="Only measure the compressed page-text store")
+    args = parser.parse_args(argv)
+
+    global FAKE_MODEL_PROFILE
+    FAKE_MODEL_PROFILE = FakeModelProfile(
+        args.model_latency, args.model_latency_per_mb, args.model_jitter, args.model_error_rate, args.seed
+    )
+    fake = install_fakes(args.storage_latency, args.storage_bandwidth)
+
+    if args.page_store:
+        result = run_page_store_scenario()
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        return 0
+
+    if args.load_size_mb:
+        print(f"Loading a {args.load_size_mb} MB PDF {args.loads} times...", file=sys.stderr)
+        log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with log:
+            result = run_load_scenario(fake, args.load_size_mb, args.loads)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        return 0 if print_load_report(result) and not result["errors"] else 1
+
+    scenarios = [s for s in SUITES[args.suite] if not args.scenario or s[0] in args.scenario]
+    results = []
+    for name, pages, images_per_page, target_size in scenarios:
+        print(f"Running {name} ({pages} pages, {images_per_page} images/page)...", file=sys.stderr)
+        log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with log:
+            results.append(run_scenario(
+                fake, name, pages, images_per_page, target_size, args.users, args.rounds, args.batch_size
+            ))
+
+    print_report(results)
+
+    report = {
+        "name": args.save_baseline or "run",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("output", "save_baseline", "compare")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved: {path}")
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,347 @@
+"""
+Bulk ingestion of a PDF library.
+
+Enumerates the PDFs of a Supabase bucket or a local directory and prepares
+everything the assistant needs for them in parallel worker processes: page
+texts, image manifest, page costs and class of the API payload, passage
+index and the model overview. Artifacts land in the shared ARTIFACT_DIR, so
+the web workers of this machine pick them up on the first question.
+
+Missing pdfs rows are created with bulk upserts. A checkpoint file records
+finished documents; an interrupted run continues where it stopped and a
+repeated run only ingests new or changed files.
+
+Usage:
+    python ingest.py                            # every PDF in the 'pdfs' bucket
+    python ingest.py --dir ./semester           # upload and ingest a local directory
+    python ingest.py --workers 8 --no-overview  # skip the model call per document
+    python ingest.py --force                    # ignore the checkpoint
+    python ingest.py --memory                   # report memory peaks and allocation sites per stage
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from werkzeug.utils import secure_filename
+
+import app as pdf_app
+
+STAGES = ["read", "upload", "text", "images", "payload", "index", "overview"]
+DEFAULT_CHECKPOINT = ".ingest_checkpoint.json"
+LIST_PAGE_SIZE = 1000  # Storage listings return at most 100 entries unless asked for more
+
+
+# ---------------------------------------------------------------------------
+# Sources
+# ---------------------------------------------------------------------------
+
+def list_bucket(bucket_name: str) -> list:
+    """Every entry of a storage bucket, fetched page by page"""
+    entries = []
+    while True:
+        page = pdf_app.supabase.storage.from_(bucket_name).list(
+            options={"limit": LIST_PAGE_SIZE, "offset": len(entries)}
+        )
+        entries.extend(page)
+        if len(page) < LIST_PAGE_SIZE:
+            return entries
+
+
+def bucket_sources(bucket_name: str) -> list:
+    """PDFs in a storage bucket as (file name, source fingerprint, path, size)"""
+    sources = []
+    for entry in list_bucket(bucket_name):
+        name = entry.get("name") or ""
+        if name.lower().endswith(".pdf"):
+            size = (entry.get("metadata") or {}).get("size") or 0
+            sources.append((name, pdf_app.storage_fingerprint(entry), None, size))
+    return sources
+
+
+def directory_sources(directory: str) -> list:
+    """PDFs under a local directory as (file name, source fingerprint, path, size)"""
+    sources = {}
+    for root, _, files in os.walk(directory):
+        for file in sorted(files):
+            if not file.lower().endswith(".pdf"):
+                continue
+            path = os.path.join(root, file)
+            name = secure_filename(file)
+            if name in sources:
+                print(f"Skipping {path}: another file is already named {name}", file=sys.stderr)
+                continue
+            stat = os.stat(path)
+            sources[name] = (name, f"{stat.st_size}-{stat.st_mtime_ns}", path, stat.st_size)
+    return list(sources.values())
+
+
+# ---------------------------------------------------------------------------
+# Checkpoint
+# ---------------------------------------------------------------------------
+
+def load_checkpoint(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    """Writes the checkpoint atomically so an interrupted run never leaves it half written"""
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(temporary, path)
+
+
+def is_done(checkpoint: dict, name: str, fingerprint: str) -> bool:
+    """True if the same file was ingested before and its artifacts are still on disk"""
+    done = checkpoint.get(name)
+    return bool(
+        done and fingerprint and done.get("source") == fingerprint
+        and pdf_app.artifact_store.read_bytes(done["version"], "page_hashes.json") is not None
+    )
+
+
+# ---------------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------------
+
+def init_worker(verbose: bool, memory: bool = False):
+    # The application logs every step; keep the report readable
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    if memory:
+        pdf_app.memory_profiler.start()
+
+
+def ingest_document(task: dict) -> dict:
+    """Runs every ingestion stage for one PDF and returns the time spent per stage"""
+    timings = {}
+
+    @contextlib.contextmanager
+    def stage(name):
+        started = time.perf_counter()
+        try:
+            with pdf_app.memory_profiler.track("ingest", name):
+                yield
+        finally:
+            timings[name] = time.perf_counter() - started
+
+    name, pdf_id, bucket_name = task["name"], task["pdf_id"], task["bucket"]
+    fingerprint = task["fingerprint"] if task["path"] is None else None
+    try:
+        with stage("read"):
+            if task["path"] is None:
+                pdf_bytes = pdf_app.supabase.storage.from_(bucket_name).download(name)
+            else:
+                with open(task["path"], "rb") as f:
+                    pdf_bytes = f.read()
+        if task["path"] is not None:
+            with stage("upload"):
+                with contextlib.suppress(Exception):
+                    pdf_app.supabase.storage.from_(bucket_name).remove([name])
+                pdf_app.supabase.storage.from_(bucket_name).upload(
+                    file=pdf_bytes, path=name, file_options={"content-type": "application/pdf"}
+                )
+
+        version = pdf_app.document_version(pdf_bytes)
+        with stage("text"):
+            page_texts, page_hashes, _ = pdf_app.ingest_page_texts(
+                pdf_bytes, version, pdf_app.previous_document_version(pdf_id)
+            )
+            document = pdf_app.remember_document(pdf_id, name, version, page_texts, fingerprint, page_hashes)
+        with stage("images"):
+            pdf_app.get_image_manifest(version, pdf_bytes)
+            image_index = pdf_app.get_image_index(version, pdf_bytes)
+        with stage("payload"):
+            pdf_app.get_page_costs(version, pdf_bytes, document.page_texts)
+            payload_class = pdf_app.get_payload_class(version, document.page_texts, image_index, len(pdf_bytes))
+        with stage("index"):
+            document.index
+        if task["overview"]:
+            with stage("overview"):
+                # A full load reuses the artifacts above and caches the overview for this version
+                pdf_app.InteractivePDFAssistant(pdf_app.api_key).load_pdf_bytes(pdf_id, name, pdf_bytes, fingerprint)
+
+        return {"name": name, "pdf_id": pdf_id, "version": version, "bytes": len(pdf_bytes),
+                "pages": len(page_hashes), "payload": payload_class["kind"], "timings": timings,
+                "memory": worker_memory()}
+    except Exception as e:
+        return {"name": name, "pdf_id": pdf_id, "error": str(e), "timings": timings, "memory": worker_memory()}
+
+
+def worker_memory():
+    """The worker's memory profile so far (None unless --memory), keyed by its process id"""
+    if not pdf_app.memory_profiler.enabled:
+        return None
+    return {"pid": os.getpid(), "profile": pdf_app.memory_profiler.report()}
+
+
+# ---------------------------------------------------------------------------
+# Run
+# ---------------------------------------------------------------------------
+
+def record_fingerprints(results: list, bucket_name: str):
+    """Uploaded files get their storage fingerprint only after upload; store it with one listing"""
+    entries = {entry.get("name"): entry for entry in list_bucket(bucket_name)}
+    for result in results:
+        pointer = pdf_app.artifact_store.read_json("documents", str(result["pdf_id"]))
+        fingerprint = pdf_app.storage_fingerprint(entries.get(result["name"]))
+        if pointer and fingerprint:
+            pdf_app.artifact_store.write_json("documents", str(result["pdf_id"]), {**pointer, "fingerprint": fingerprint})
+
+
+def merge_memory(profiles: list) -> dict:
+    """
+    Combines the cumulative profiles of the workers: runs and retained bytes
+    add up, the peak and its allocation sites come from the worst worker.
+    """
+    merged = {}
+    for profile in profiles:
+        for kind, names in profile.items():
+            for name, stats in names.items():
+                entry = merged.setdefault(kind, {}).setdefault(name, {
+                    "count": 0, "retained_bytes": 0, "max_retained_bytes": 0, "max_peak_bytes": -1, "top_sites": [],
+                })
+                entry["count"] += stats["count"]
+                entry["retained_bytes"] += stats["retained_bytes"]
+                entry["max_retained_bytes"] = max(entry["max_retained_bytes"], stats["max_retained_bytes"])
+                if stats["max_peak_bytes"] > entry["max_peak_bytes"]:
+                    entry["max_peak_bytes"] = stats["max_peak_bytes"]
+                    entry["top_sites"] = stats["top_sites"]
+    return merged
+
+
+def run(args) -> dict:
+    sources = directory_sources(args.dir) if args.dir else bucket_sources(args.bucket)
+    checkpoint = {} if args.force else load_checkpoint(args.checkpoint)
+    pending = [source for source in sources if not is_done(checkpoint, source[0], source[1])]
+    print(f"{len(sources)} PDFs found, {len(sources) - len(pending)} already ingested, {len(pending)} to ingest.",
+          file=sys.stderr)
+
+    started = time.perf_counter()
+    records = pdf_app.upsert_pdf_records([name for name, _, _, _ in pending])
+    tasks = [
+        {"name": name, "fingerprint": fingerprint, "path": path, "pdf_id": records[name]["id"],
+         "bucket": args.bucket, "overview": not args.no_overview}
+        for name, fingerprint, path, _ in pending
+    ]
+    results, failures = [], []
+    memory_profiles = {}  # worker pid -> its latest cumulative profile
+    if tasks:
+        context = multiprocessing.get_context("spawn")  # workers must not share the parent's HTTP connections
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=context,
+                                 initializer=init_worker, initargs=(args.verbose, args.memory)) as executor:
+            futures = [executor.submit(ingest_document, task) for task in tasks]
+            fingerprints = {task["name"]: task["fingerprint"] for task in tasks}
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                if result.get("memory"):
+                    memory_profiles[result["memory"]["pid"]] = result["memory"]["profile"]
+                if "error" in result:
+                    failures.append(result)
+                    print(f"[{done}/{len(tasks)}] {result['name']}: FAILED {result['error']}", file=sys.stderr)
+                    continue
+                results.append(result)
+                checkpoint[result["name"]] = {
+                    "source": fingerprints[result["name"]], "version": result["version"],
+                    "pdf_id": result["pdf_id"], "ingested_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                }
+                save_checkpoint(args.checkpoint, checkpoint)
+                print(f"[{done}/{len(tasks)}] {result['name']}: {result['pages']} pages, "
+                      f"{sum(result['timings'].values()):.2f} s", file=sys.stderr)
+        if args.dir and results:
+            record_fingerprints(results, args.bucket)
+
+    return {
+        "found": len(sources),
+        "skipped": len(sources) - len(pending),
+        "ingested": len(results),
+        "failed": [{"name": failure["name"], "error": failure["error"]} for failure in failures],
+        "workers": args.workers,
+        "seconds": time.perf_counter() - started,
+        "bytes": sum(result["bytes"] for result in results),
+        "pages": sum(result["pages"] for result in results),
+        "stage_seconds": {
+            name: sum(result["timings"].get(name, 0.0) for result in results + failures)
+            for name in STAGES
+        },
+        "payload_classes": {
+            kind: sum(result["payload"] == kind for result in results)
+            for kind in sorted({result["payload"] for result in results})
+        },
+        "memory": merge_memory(memory_profiles.values()) if args.memory else None,
+    }
+
+
+def print_report(report: dict):
+    seconds = max(report["seconds"], 1e-9)
+    megabytes = report["bytes"] / (1024 * 1024)
+    print(f"\nIngested {report['ingested']} of {report['found']} PDFs "
+          f"({report['skipped']} up to date, {len(report['failed'])} failed) "
+          f"with {report['workers']} workers in {report['seconds']:.1f} s")
+    print(f"Throughput: {report['ingested'] / seconds:.2f} docs/s, {megabytes / seconds:.2f} MB/s, "
+          f"{report['pages'] / seconds:.1f} pages/s")
+    if report["payload_classes"]:
+        print("Payload classes: " + ", ".join(f"{kind} {count}" for kind, count in report["payload_classes"].items()))
+    total = sum(report["stage_seconds"].values())
+    if total:
+        print(f"\n{'stage':<10} {'total s':>9} {'per doc':>9} {'share':>7}")
+        for name in STAGES:
+            value = report["stage_seconds"][name]
+            if value:
+                print(f"{name:<10} {value:9.2f} {value / max(1, report['ingested']):9.3f} {value / total:7.1%}")
+    if report.get("memory"):
+        print_memory(report["memory"])
+    for failure in report["failed"]:
+        print(f"FAILED {failure['name']}: {failure['error']}")
+
+
+def print_memory(memory: dict):
+    megabyte = 1024 * 1024
+    for kind, title in (("ingest", "stage"), ("stage", "pipeline")):
+        names = memory.get(kind) or {}
+        if not names:
+            continue
+        print(f"\n{title:<24} {'peak MB':>9} {'kept MB':>9} {'runs':>6}")
+        for name, stats in sorted(names.items(), key=lambda item: item[1]["max_peak_bytes"], reverse=True):
+            print(f"{name:<24} {stats['max_peak_bytes'] / megabyte:9.2f} "
+                  f"{stats['retained_bytes'] / megabyte:9.2f} {stats['count']:6d}")
+    for name, stats in (memory.get("ingest") or {}).items():
+        if stats["top_sites"]:
+            print(f"\nTop allocation sites of '{name}' (largest sampled run):")
+            for site in stats["top_sites"][:5]:
+                print(f"  {site['size_diff'] / megabyte:8.2f} MB  {site['site']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest a library of PDFs in parallel")
+    parser.add_argument("--bucket", default="pdfs", help="Storage bucket to read from (or upload to with --dir)")
+    parser.add_argument("--dir", help="Ingest the PDFs of this local directory instead of the bucket")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="Progress file used to resume")
+    parser.add_argument("--force", action="store_true", help="Ingest every PDF, ignoring the checkpoint")
+    parser.add_argument("--no-overview", action="store_true", help="Skip the model overview of each PDF")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the application's log output")
+    parser.add_argument("--memory", action="store_true",
+                        help="Profile memory with tracemalloc and report peaks and allocation sites per stage")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
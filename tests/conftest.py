@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+
+import fitz
+import pytest
+
+# app.py reads its configuration at import time
+os.environ["ARTIFACT_DIR"] = tempfile.mkdtemp(prefix="pdf_assistant_tests_")
+os.environ.setdefault("PREFETCH_ENABLED", "0")
+os.environ.setdefault("WARMUP_ON_STARTUP", "0")
+os.environ.setdefault("ADMIN_TOKEN", "test-admin-token")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402  (sets the fake credentials, then imports app)
+import app as pdf_app  # noqa: E402
+
+
+def make_text_pdf(pages: int, tag: str) -> bytes:
+    """Text-only PDF whose pages are unique to `tag`"""
+    doc = fitz.open()
+    for number in range(1, pages + 1):
+        doc.new_page().insert_textbox(fitz.Rect(40, 40, 555, 800), f"{tag} page {number}\n" + benchmark.LOREM * 4,
+                                      fontsize=9)
+    try:
+        return doc.tobytes()
+    finally:
+        doc.close()
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    """Fake Supabase and Gemini with a fast, error-free model"""
+    monkeypatch.setattr(benchmark, "FAKE_MODEL_PROFILE", benchmark.FakeModelProfile(latency=0.0, per_mb=0.0, jitter=0.0))
+    monkeypatch.setattr(benchmark, "FAKE_MODEL_PROFILES", {})
+    return benchmark.install_fakes()
+
+
+@pytest.fixture
+def store_pdf(fake):
+    """Adds a PDF to the fake database and storage; returns its id"""
+    def store(pdf_bytes, name="doc.pdf"):
+        record = fake.table("pdfs").insert({"file_name": name, "file_path": f"pdfs/{name}", "title": name,
+                                            "description": ""}).execute().data[0]
+        fake.storage.files["pdfs"][name] = pdf_bytes
+        return record["id"]
+    return store
+
+
+@pytest.fixture
+def load_assistant(store_pdf):
+    """Loads PDF bytes into a new assistant; documents differ by content, so caches never mix tests"""
+    def load(pdf_bytes, name="doc.pdf"):
+        assistant = pdf_app.InteractivePDFAssistant(pdf_app.api_key)
+        assert assistant.load_pdf_bytes(store_pdf(pdf_bytes, name), name, pdf_bytes)
+        return assistant
+    return load
+
+
+@pytest.fixture
+def client(fake, monkeypatch):
+    """Flask test client with a model API key"""
+    monkeypatch.setenv("GOOGLE_API_KEY", "test-key")
+    return pdf_app.app.test_client()
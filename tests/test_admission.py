@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+import app as pdf_app
+import benchmark
+from conftest import make_text_pdf
+
+LANES = {
+    "interactive": {"priority": 0, "limit": 2, "max_wait": 5.0},
+    "ingestion": {"priority": 2, "limit": 2, "max_wait": 5.0},
+    "speculative": {"priority": 3, "limit": 1, "max_wait": 0.0},
+}
+
+
+def hold_slot(controller, lane, release):
+    """Takes a slot of `lane` in a thread and keeps it until `release` is set"""
+    acquired = threading.Event()
+
+    def run():
+        with controller.slot(lane, client="holder"):
+            acquired.set()
+            release.wait(5)
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert acquired.wait(5)
+    return thread
+
+
+def test_free_slot_goes_to_the_highest_priority_lane():
+    controller = pdf_app.AdmissionController(1, LANES)
+    release = threading.Event()
+    holder = hold_slot(controller, "interactive", release)
+    order = []
+
+    def wait_for(lane):
+        with controller.slot(lane, client=lane):
+            order.append(lane)
+    waiters = [threading.Thread(target=wait_for, args=(lane,)) for lane in ("ingestion", "interactive")]
+    for waiter in waiters:
+        waiter.start()
+        time.sleep(0.05)  # ingestion queues first
+    release.set()
+    for thread in [holder] + waiters:
+        thread.join(5)
+    assert order == ["interactive", "ingestion"]
+
+
+def test_call_that_cannot_wait_is_rejected():
+    controller = pdf_app.AdmissionController(4, LANES)
+    release = threading.Event()
+    holder = hold_slot(controller, "speculative", release)
+    try:
+        with pytest.raises(pdf_app.Overloaded) as error:
+            controller.acquire("speculative", client="other")
+        assert error.value.lane == "speculative"
+        assert controller.snapshot()["speculative"] == {"running": 1, "waiting": 0, "rejected": 1}
+    finally:
+        release.set()
+        holder.join(5)
+    assert controller.snapshot()["speculative"]["running"] == 0
+
+
+def test_reserved_slots_stay_free_for_their_lane():
+    lanes = {**LANES, "interactive": {**LANES["interactive"], "reserved": 2},
+             "ingestion": {"priority": 2, "limit": 4, "max_wait": 0.0}}
+    controller = pdf_app.AdmissionController(4, lanes)
+    for _ in range(2):
+        controller.acquire("ingestion", client="background")
+    with pytest.raises(pdf_app.Overloaded):
+        controller.acquire("ingestion", client="background")  # under its limit, but the rest is reserved
+    for _ in range(2):
+        controller.acquire("interactive", client="user")
+    assert controller.snapshot()["interactive"]["running"] == 2
+
+
+def test_upstream_429_is_returned_as_429(client, store_pdf, request, monkeypatch):
+    pdf_id = store_pdf(make_text_pdf(2, request.node.name), "limited.pdf")
+    client.post("/select_pdf", data={"select_existing": "1", "pdf_id": pdf_id})
+    monkeypatch.setattr(pdf_app, "MODEL_MAX_RETRIES", 0)
+
+    def rate_limited(self, *args, **kwargs):
+        raise pdf_app.google_exceptions.TooManyRequests("quota")
+    monkeypatch.setattr(benchmark.FakeGenerativeModel, "generate_content", rate_limited)
+    response = client.post("/batch_chat", json={"questions": ["One?", "Two?"]})
+    assert response.status_code == 429 and response.headers["Retry-After"]
+
+
+class SlowModel:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def generate_content(self, contents, generation_config=None, request_options=None):
+        time.sleep(self.seconds)
+        return object()
+
+
+def test_model_latency_excludes_the_admission_queue(monkeypatch):
+    controller = pdf_app.AdmissionController(1, LANES)
+    monkeypatch.setattr(pdf_app, "admission", controller)
+    stats = pdf_app.ModelCallStats()
+    client = pdf_app.ModelClient(SlowModel(0.05), "slow-model", stats)
+    release = threading.Event()
+    holder = hold_slot(controller, "interactive", release)
+    threading.Timer(0.3, release.set).start()
+
+    started = time.monotonic()
+    client.generate(["question"], hedge=False)
+    holder.join(5)
+    assert time.monotonic() - started >= 0.3  # queued behind the holder
+    assert stats.percentile("slow-model", "generate", 50) < 0.2  # but only the call itself is latency
@@ -0,0 +1,67 @@
+import pytest
+
+import app as pdf_app
+from conftest import make_text_pdf
+
+parse = pdf_app.InteractivePDFAssistant._parse_batch_answers
+
+
+def test_parse_batch_answers_by_id_and_position():
+    text = '```json\n[{"id": 2, "answer": " second "}, {"id": 1, "answer": "first"}, {"id": 9, "answer": "x"}]\n```'
+    assert parse(text, 3) == ["first", "second", None]
+    assert parse('{"answers": ["a", "b"]}', 2) == ["a", "b"]
+
+
+def test_parse_batch_answers_falls_back_to_numbered_sections():
+    assert parse("1. Alpha\nstill alpha\n2) Beta\n", 3) == ["Alpha\nstill alpha", "Beta", None]
+    assert parse("", 2) == [None, None]
+
+
+def test_batch_keeps_question_order_and_retries_unparsed_answers(load_assistant, request, monkeypatch):
+    assistant = load_assistant(make_text_pdf(3, request.node.name), "batch.pdf")
+    sent = []
+
+    def send(document_parts, questions):
+        sent.append(list(questions))
+        if questions == ["q5"]:
+            raise RuntimeError("pack failed")
+        if questions == ["q2"]:
+            return '["a-q2 retried"]'
+        # q2 is left out of its pack's answer
+        return "[" + ", ".join(f'{{"id": {i}, "answer": "a-{q}"}}' for i, q in enumerate(questions, start=1)
+                               if q != "q2") + "]"
+    monkeypatch.setattr(assistant, "_send_question_pack", send)
+
+    answers = assistant.ask_questions_batch(["q1", "q2", "q3", "q4", "q5"], pack_size=2, max_workers=1)
+    assert answers[0] == "a-q1" and answers[2:4] == ["a-q3", "a-q4"]
+    assert answers[1] == "a-q2 retried"  # the unparsed answer was asked again on its own
+    assert ["q2"] in sent
+    assert answers[4].startswith("Question answer failed")  # one failed pack does not fail the batch
+
+
+@pytest.fixture
+def selected(client, store_pdf, request):
+    pdf_id = store_pdf(make_text_pdf(3, request.node.name), "batch.pdf")
+    assert client.post("/select_pdf", data={"select_existing": "1", "pdf_id": pdf_id}).status_code == 200
+    return client
+
+
+def test_batch_chat_answers_every_question(selected):
+    response = selected.post("/batch_chat", json={"questions": ["First?", " ", "Second?", "Third?"]})
+    body = response.get_json()
+    assert response.status_code == 200 and body["mode"] == "batch"
+    assert [item["question"] for item in body["answers"]] == ["First?", "Second?", "Third?"]
+    assert [item["answer"] for item in body["answers"]] == ["Answer 1.", "Answer 2.", "Answer 3."]
+
+    response = selected.post("/batch_chat", data={"questions": "One?\nTwo?"})
+    assert [item["question"] for item in response.get_json()["answers"]] == ["One?", "Two?"]
+
+
+@pytest.mark.parametrize("payload", [{"questions": []}, {"questions": "not a list"},
+                                     {"questions": ["q"] * (pdf_app.BATCH_MAX_QUESTIONS + 1)}])
+def test_batch_chat_rejects_invalid_question_lists(selected, payload):
+    assert selected.post("/batch_chat", json=payload).status_code == 400
+
+
+def test_batch_chat_needs_a_selected_pdf(client):
+    assert client.post("/batch_chat", json={"questions": ["q"]}).status_code == 400
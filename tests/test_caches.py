@@ -0,0 +1,55 @@
+import pytest
+
+import app as pdf_app
+
+
+def test_lru_cache_evicts_least_recently_used_entry():
+    cache = pdf_app.LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is now the oldest
+    cache.put("c", 3)
+    assert cache.keys() == ["a", "c"]
+    assert cache.get("b") is None
+
+
+def test_lru_cache_byte_budget_keeps_the_newest_entry():
+    cache = pdf_app.LRUCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.size_bytes == 10
+    cache.put("c", b"123")
+    assert cache.keys() == ["b", "c"]
+    assert cache.size_bytes == 8
+    cache.put("big", b"x" * 50)  # larger than the budget, but the only entry left
+    assert cache.keys() == ["big"]
+
+
+def test_lru_cache_replacing_and_popping_update_the_size():
+    cache = pdf_app.LRUCache(max_bytes=100)
+    cache.put("a", b"1234")
+    cache.put("a", b"12")
+    assert cache.size_bytes == 2
+    assert cache.pop("a") == b"12"
+    assert cache.size_bytes == 0 and len(cache) == 0
+    assert cache.pop("a", "missing") == "missing"
+
+
+@pytest.mark.parametrize("block_pages", [1, 3, 4])
+def test_compressed_page_texts_reads_like_a_list(block_pages):
+    pages = [f"Page {number} ünicode ✓ " * (number % 5) for number in range(11)] + [None, ""]
+    texts = pdf_app.CompressedPageTexts(pages, block_pages=block_pages)
+    expected = [page or "" for page in pages]
+    assert len(texts) == len(expected)
+    assert list(texts) == expected
+    assert [texts[i] for i in (12, 0, 7, 3, -1)] == [expected[i] for i in (12, 0, 7, 3, -1)]
+    assert texts[2:6] == expected[2:6]
+    assert texts.full_text() == "".join(expected)
+    with pytest.raises(IndexError):
+        texts[len(expected)]
+
+
+def test_compact_page_texts_compresses_lists_only():
+    compressed = pdf_app.compact_page_texts(["a", "b"])
+    assert isinstance(compressed, pdf_app.CompressedPageTexts)
+    assert pdf_app.compact_page_texts(compressed) is compressed
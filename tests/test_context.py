@@ -0,0 +1,90 @@
+import pytest
+
+import app as pdf_app
+from conftest import make_text_pdf
+
+PAGES = 6
+
+
+def figure(page, size, decorative=False):
+    return {"page": page, "xref": page * 10, "bytes": size, "decorative": decorative}
+
+
+def test_text_quality_counts_unreadable_characters():
+    assert pdf_app.text_quality([]) == 1.0
+    assert pdf_app.text_quality(["abc�", None, "bcd"]) == pytest.approx(0.75)
+
+
+def test_classify_payload_by_image_share_and_weak_pages():
+    texts = ["long enough text " * 10] * 4
+    assert pdf_app.classify_payload(texts, [figure(1, 50)], 1000)["kind"] == "text"
+    assert pdf_app.classify_payload(texts, [figure(1, 300)], 1000)["kind"] == "mixed"
+    assert pdf_app.classify_payload(texts, [figure(1, 600)], 1000)["kind"] == "image_heavy"
+    assert pdf_app.classify_payload(texts, [figure(1, 600, decorative=True)], 10000)["kind"] == "text"
+
+    scanned = pdf_app.classify_payload(["", " ", texts[0], ""], [figure(1, 10), figure(2, 10), figure(3, 10)], 10000)
+    assert (scanned["kind"], scanned["weak_pages"]) == ("scanned", [1, 2])
+
+
+@pytest.fixture
+def assistant(load_assistant, request):
+    return load_assistant(make_text_pdf(PAGES, request.node.name), "context.pdf")
+
+
+def page_tokens(assistant, pages):
+    return sum(text_tokens + pdf_app.PAYLOAD_PAGE_MARKER_TOKENS for _, _, text_tokens in assistant._page_costs()[:pages])
+
+
+def test_document_that_fits_is_sent_whole(assistant, monkeypatch):
+    monkeypatch.setattr(pdf_app, "PAYLOAD_TEXT_FIRST", False)
+    assert assistant._fit_context("overview") == [{"mime_type": "application/pdf", "data": assistant.pdf_raw_bytes}]
+    report = assistant.last_context_report
+    assert (report["pdf_pages"], report["page_coverage"]) == (PAGES, 1.0)
+
+
+def test_pdf_payload_fills_the_budget_with_following_page_texts(assistant, monkeypatch):
+    monkeypatch.setattr(pdf_app, "PAYLOAD_TEXT_FIRST", False)
+    first_page = assistant._page_costs()[0][0]
+    budget = first_page + page_tokens(assistant, 2)
+    monkeypatch.setitem(pdf_app.CONTEXT_TOKEN_BUDGETS, "overview", pdf_app.OUTPUT_TOKEN_RESERVE + budget)
+    parts = assistant._fit_context("overview")
+    report = assistant.last_context_report
+    assert report["payload"] == "pdf" and report["tokens"] <= report["token_budget"]
+    assert 1 <= report["pdf_pages"] < PAGES and report["pdf_pages"] + report["text_pages"] < PAGES
+    assert parts[0]["mime_type"] == "application/pdf" and "original page numbers" in parts[1]
+
+
+def test_text_document_is_sent_as_page_texts(assistant):
+    assert assistant.payload_class["kind"] == "text"
+    parts = assistant._fit_context("overview")
+    report = assistant.last_context_report
+    assert len(parts) == 1 and "--- Page 6 ---" in parts[0]
+    assert (report["payload"], report["text_pages"], report["pdf_pages"]) == ("text", PAGES, 0)
+    assert report["saved_tokens"] > 0
+
+
+def test_text_payload_stops_at_the_token_budget(assistant, monkeypatch):
+    monkeypatch.setitem(pdf_app.CONTEXT_TOKEN_BUDGETS, "overview", pdf_app.OUTPUT_TOKEN_RESERVE + page_tokens(assistant, 2))
+    parts = assistant._fit_context("overview")
+    report = assistant.last_context_report
+    assert report["text_pages"] == 2 and report["tokens"] <= report["token_budget"]
+    assert "--- Page 2 ---" in parts[0] and "--- Page 3 ---" not in parts[0]
+
+    assistant._fit_context("overview", page_range=(4, 6))
+    assert assistant.last_context_report["page_range"] == [4, 6]
+    assert assistant.last_context_report["text_pages"] == 2
+
+
+def test_text_payload_falls_back_to_pdf(assistant, monkeypatch):
+    assert assistant._text_payload(0, PAGES - 1) == (True, "text")
+    monkeypatch.setitem(assistant.payload_class, "weak_pages", [5])
+    assert assistant._text_payload(0, 3) == (True, "text")
+    assert assistant._text_payload(0, PAGES - 1) == (False, "weak_pages")
+    monkeypatch.setitem(assistant.payload_class, "text_quality", 0.5)
+    assert assistant._text_payload(0, 3) == (False, "low_text_quality")
+    monkeypatch.setattr(pdf_app, "PAYLOAD_TEXT_FIRST", False)
+    assert assistant._text_payload(0, 3) == (False, "disabled")
+
+    parts = assistant._fit_context("overview")
+    assert parts == [{"mime_type": "application/pdf", "data": assistant.pdf_raw_bytes}]  # the whole document fits
+    assert assistant.last_context_report["payload_reason"] == "disabled"
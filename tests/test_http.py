@@ -0,0 +1,16 @@
+import pytest
+
+
+def test_static_files_answer_conditional_requests(client):
+    first = client.get("/static/style.css")
+    assert first.status_code == 200 and first.headers["ETag"]
+    assert client.get("/static/style.css", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+
+@pytest.mark.parametrize("path", ["/metrics", "/admin/memory"])
+def test_live_endpoints_are_never_answered_with_304(client, path):
+    headers = {"Authorization": "Bearer test-admin-token"}
+    first = client.get(path, headers=headers)
+    assert first.status_code == 200 and "ETag" not in first.headers
+    again = client.get(path, headers={**headers, "If-None-Match": "*"})
+    assert again.status_code == 200
@@ -0,0 +1,105 @@
+import io
+import threading
+
+import fitz
+from PIL import Image, ImageEnhance, ImageOps
+
+import app as pdf_app
+import benchmark
+
+
+def gradient(size=128, vertical=False):
+    image = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    return image if vertical else ImageOps.mirror(image.rotate(90))
+
+
+def checkerboard(size=128, cells=4):
+    image = Image.new("RGB", (size, size), "white")
+    step = size // cells
+    for row in range(cells):
+        for col in range(cells):
+            if (row + col) % 2:
+                image.paste((0, 0, 0), (col * step, row * step, (col + 1) * step, (row + 1) * step))
+    return image
+
+
+def png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def make_figure_pdf(tag):
+    """Four pages: two captioned figures, a repeated logo, a tiny icon and unique text per `tag`"""
+    figures = {1: (gradient(), "Figure 1: Temperature profile along the heat exchanger"),
+               2: (checkerboard(), "Figure 2: Pump performance curve at rated speed")}
+    logo, icon = png(gradient(64, vertical=True)), png(checkerboard(16, cells=2))
+    doc = fitz.open()
+    for number in range(1, 5):
+        page = doc.new_page()
+        page.insert_text((40, 40), f"{tag} page {number}")
+        page.insert_image(fitz.Rect(500, 20, 564, 84), stream=logo)
+        if number in figures:
+            image, caption = figures[number]
+            page.insert_image(fitz.Rect(100, 200, 400, 500), stream=png(image))
+            page.insert_textbox(fitz.Rect(100, 505, 400, 540), caption, fontsize=10)
+        if number == 4:
+            page.insert_image(fitz.Rect(100, 200, 116, 216), stream=icon)
+    try:
+        return doc.tobytes()
+    finally:
+        doc.close()
+
+
+def bits_apart(first, second):
+    return bin(int(first, 16) ^ int(second, 16)).count("1")
+
+
+def test_image_hash_matches_similar_images_only():
+    image = gradient()
+    brighter = ImageEnhance.Brightness(image).enhance(1.2)
+    assert len(pdf_app.image_hash(image)) == 16
+    assert bits_apart(pdf_app.image_hash(image), pdf_app.image_hash(brighter.resize((300, 300)))) <= 4
+    assert bits_apart(pdf_app.image_hash(image), pdf_app.image_hash(ImageOps.mirror(image))) > 32
+
+
+def test_image_index_flags_logos_and_tiny_images(request):
+    index = pdf_app.build_image_index(make_figure_pdf(request.node.name))
+    decorative = {(entry["page"], entry["width"]) for entry in index if entry["decorative"]}
+    figures = [entry for entry in index if not entry["decorative"]]
+    assert decorative == {(1, 64), (2, 64), (3, 64), (4, 64), (4, 16)}
+    assert [(entry["page"], entry["caption"][:8]) for entry in figures] == [(1, "Figure 1"), (2, "Figure 2")]
+
+
+def test_select_image_parts_attaches_the_figure_asked_about(load_assistant, request):
+    assistant = load_assistant(make_figure_pdf(request.node.name), "figures.pdf")
+    parts, report = assistant.select_image_parts("What does the pump performance curve show?")
+    assert report["candidates"] == 2
+    assert [image["page"] for image in report["attached"]] == [2]
+    assert parts[0]["mime_type"] == "image/jpeg" and isinstance(parts[-1], str)
+
+    _, report = assistant.select_image_parts("Explain figure 1")
+    assert report["attached"][0]["page"] == 1  # the numbered figure ranks first
+    _, report = assistant.select_image_parts("Explain figure 1", page_range=(2, 4))
+    assert [image["page"] for image in report["attached"]] == [2]  # figure 1 is outside the range
+
+
+def test_failed_image_upload_counts_as_a_bookkeeping_error(client, store_pdf, request, monkeypatch):
+    pdf_id = store_pdf(make_figure_pdf(request.node.name), "figures.pdf")
+    client.post("/select_pdf", data={"select_existing": "1", "pdf_id": pdf_id})
+
+    def broken_upload(self, file, path, file_options=None):
+        raise ConnectionError("storage down")
+    monkeypatch.setattr(benchmark.FakeStorageBucket, "upload", broken_upload)
+    errors = pdf_app.metrics._values["pdf_assistant_bookkeeping_errors_total"]
+    before = errors.get((("task", "image_upload"),), 0)
+
+    response = client.post("/chat", data={"question": "What is this?",
+                                          "image": (io.BytesIO(png(gradient())), "figure.png")})
+    assert response.status_code == 200  # the answer does not wait for the upload
+    for _ in range(500):
+        if errors.get((("task", "image_upload"),), 0) > before:
+            break
+        threading.Event().wait(0.01)
+    assert errors[(("task", "image_upload"),)] == before + 1
+    assert pdf_app.store_image(png(gradient()), "figure.png") is None  # direct callers still get None
@@ -0,0 +1,50 @@
+import threading
+import tracemalloc
+
+import pytest
+
+import app as pdf_app
+
+
+@pytest.fixture
+def profiler():
+    profiler = pdf_app.MemoryProfiler(frames=1, site_every=1)
+    profiler.start()
+    yield profiler
+    profiler.stop()
+
+
+def test_tracked_block_records_the_memory_it_kept(profiler):
+    with profiler.track("stage", "keep"):
+        kept = [bytearray(1024) for _ in range(100)]
+    stats = profiler.report()["stage"]["keep"]
+    assert stats["count"] == 1 and stats["retained_bytes"] >= 100 * 1024 and stats["top_sites"]
+    assert len(kept) == 100
+
+
+def test_stopping_during_a_block_records_no_memory(profiler):
+    with profiler.track("stage", "stopped"):
+        profiler.stop()
+    assert profiler.report()["stage"]["stopped"]["retained_bytes"] == 0
+    with pytest.raises(ValueError):
+        profiler.snapshot()
+    with profiler.track("stage", "disabled"):
+        pass
+    assert "disabled" not in profiler.report()["stage"]
+
+
+def test_stop_waits_for_a_snapshot_in_progress(profiler, monkeypatch):
+    take_snapshot, stoppers = profiler._take_snapshot, []
+
+    def stopped_meanwhile():
+        if not stoppers:  # another thread stops the profiler while the first snapshot is taken
+            stoppers.append(threading.Thread(target=profiler.stop))
+            stoppers[0].start()
+            stoppers[0].join(0.2)
+        return take_snapshot()
+    monkeypatch.setattr(profiler, "_take_snapshot", stopped_meanwhile)
+
+    with profiler.track("stage", "race"):
+        pass
+    stoppers[0].join(5)
+    assert not tracemalloc.is_tracing() and profiler.report()["stage"]["race"]["count"] == 1
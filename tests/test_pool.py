@@ -0,0 +1,147 @@
+import threading
+
+import pytest
+
+import app as pdf_app
+import benchmark
+from conftest import make_text_pdf
+
+
+class FakeAssistant:
+    loads = []
+
+    def __init__(self, api_key):
+        self.pdf_version = None
+
+    def load_pdf_from_supabase(self, pdf_id, filename):
+        FakeAssistant.loads.append(pdf_id)
+        return pdf_id != "missing"
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    FakeAssistant.loads = []
+    monkeypatch.setattr(pdf_app, "InteractivePDFAssistant", FakeAssistant)
+    monkeypatch.setattr(pdf_app, "previous_document_version", lambda pdf_id: None)
+    monkeypatch.setattr(pdf_app, "ASSISTANT_WAIT_SECONDS", 5)
+    return pdf_app.AssistantPool(max_sessions=1, idle_seconds=3600)
+
+
+def turn(pool, session_id, seen, hold=None):
+    """One conversation turn in a thread, kept open until `hold` is set"""
+    def run():
+        with pool.checkout(session_id, "doc", "doc.pdf", "key") as assistant:
+            seen.append(assistant)
+            if hold is not None:
+                hold.wait(5)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("condition not reached")
+
+
+def test_conversation_stays_loaded_between_turns(pool):
+    with pool.checkout("s1", "doc", "doc.pdf", "key") as first:
+        pass
+    with pool.checkout("s1", "doc", "doc.pdf", "key") as second:
+        pass
+    assert first is second and FakeAssistant.loads == ["doc"]
+    with pool.checkout("s1", "missing", "missing.pdf", "key") as assistant:
+        assert assistant is None
+    assert ("s1", "missing") not in pool._entries  # failed loads are not kept
+
+
+def test_conversation_in_use_is_not_evicted(pool):
+    with pool.checkout("s1", "doc", "doc.pdf", "key"):
+        with pool.checkout("s2", "doc", "doc.pdf", "key"):
+            pass
+        assert len(pool) == 2  # over the cap, but s1 is in use
+    with pool.checkout("s3", "doc", "doc.pdf", "key"):
+        pass
+    assert list(pool._entries) == [("s3", "doc")]
+
+
+def test_queued_turn_keeps_its_conversation(pool):
+    seen = []
+    first_done, second_done = threading.Event(), threading.Event()
+    first = turn(pool, "s1", seen, first_done)
+    wait_until(lambda: len(seen) == 1)
+    second = turn(pool, "s1", seen, second_done)
+    wait_until(lambda: pool._entries[("s1", "doc")]["users"] == 2)  # queued behind the first turn
+
+    first_done.set()
+    first.join(5)
+    with pool.checkout("s2", "doc", "doc.pdf", "key"):
+        pass
+    assert ("s1", "doc") in pool._entries  # the queued turn still holds it
+    second_done.set()
+    second.join(5)
+    assert seen[0] is seen[1] and FakeAssistant.loads == ["doc", "doc"]  # s1 once, s2 once
+
+
+def test_busy_conversation_rejects_turns_after_the_wait(pool, monkeypatch):
+    monkeypatch.setattr(pdf_app, "ASSISTANT_WAIT_SECONDS", 0.05)
+    errors = []
+
+    def late_turn():
+        try:
+            with pool.checkout("s1", "doc", "doc.pdf", "key"):
+                pass
+        except pdf_app.Overloaded as error:
+            errors.append(error)
+    with pool.checkout("s1", "doc", "doc.pdf", "key"):
+        thread = threading.Thread(target=late_turn)
+        thread.start()
+        thread.join(5)
+    assert [error.lane for error in errors] == ["session"]
+    assert pool._entries[("s1", "doc")]["users"] == 0
+
+
+def pdf_blobs(contents):
+    """Inline PDFs in a request, chat history included"""
+    count = 0
+    for part in contents:
+        if isinstance(part, dict) and "parts" in part:
+            count += pdf_blobs(part["parts"])
+        elif isinstance(part, dict) and part.get("mime_type") == "application/pdf":
+            count += 1
+    return count
+
+
+def test_chat_turns_send_the_document_once(client, store_pdf, request, monkeypatch):
+    monkeypatch.setattr(pdf_app, "PAYLOAD_TEXT_FIRST", False)  # pages go as an inline PDF
+    pdf_id = store_pdf(make_text_pdf(3, request.node.name), "turns.pdf")
+    client.post("/select_pdf", data={"select_existing": "1", "pdf_id": pdf_id})
+    chat_requests = []
+    generate_content = benchmark.FakeGenerativeModel.generate_content
+
+    def recording(self, contents, *args, **kwargs):
+        if any(isinstance(part, dict) and "role" in part for part in contents):
+            chat_requests.append(contents)
+        return generate_content(self, contents, *args, **kwargs)
+    monkeypatch.setattr(benchmark.FakeGenerativeModel, "generate_content", recording)
+
+    for number in range(4):
+        assert client.post("/chat", data={"question": f"Question {number}?"}).status_code == 200
+    assert [pdf_blobs(contents) for contents in chat_requests] == [1, 1, 1, 1]
+    sizes = [benchmark._content_size(contents)[0] for contents in chat_requests]
+    # Each turn adds only the previous question and answer
+    assert max(later - earlier for earlier, later in zip(sizes, sizes[1:])) < 1000
+
+
+def test_history_tokens_count_inline_documents(load_assistant, request):
+    assistant = load_assistant(make_text_pdf(3, request.node.name), "history.pdf")
+    assistant.chat_session.history = []
+    assert assistant._history_tokens() == 0
+    assistant.chat_session.history = [
+        {"role": "user", "parts": [{"mime_type": "application/pdf", "data": assistant.pdf_raw_bytes}, "x" * 40]},
+        {"role": "model", "parts": ["y" * 40]},
+    ]
+    assert assistant._history_tokens() == 3 * pdf_app.PDF_PAGE_TOKENS + 80 // pdf_app.CHARS_PER_TOKEN
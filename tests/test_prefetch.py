@@ -0,0 +1,29 @@
+import threading
+
+import app as pdf_app
+import benchmark
+from conftest import make_text_pdf
+
+
+def test_prefetch_loads_the_document_once(fake, store_pdf, request, monkeypatch):
+    session_id, name = request.node.name, "prefetch.pdf"
+    pdf_id = store_pdf(make_text_pdf(3, request.node.name), name)
+    loads, model_calls = [], []
+    load_pdf_bytes = pdf_app.InteractivePDFAssistant.load_pdf_bytes
+    monkeypatch.setattr(pdf_app.InteractivePDFAssistant, "load_pdf_bytes",
+                        lambda self, *args, **kwargs: loads.append(args[0]) or load_pdf_bytes(self, *args, **kwargs))
+    monkeypatch.setattr(pdf_app, "most_requested_generation", lambda pdf_id: "summary")
+
+    state = {"cancel": threading.Event(), "done": threading.Event(), "task": "queued", "planned": None,
+             "pdf_id": str(pdf_id)}
+    pdf_app.prefetch_document(state, session_id, pdf_id, name, pdf_app.api_key)
+    assert state["done"].is_set() and loads == [pdf_id]
+
+    generate_content = benchmark.FakeGenerativeModel.generate_content
+    monkeypatch.setattr(benchmark.FakeGenerativeModel, "generate_content",
+                        lambda self, *args, **kwargs: model_calls.append(args) or generate_content(self, *args, **kwargs))
+    with pdf_app.assistant_pool.checkout(session_id, pdf_id, name, pdf_app.api_key) as assistant:
+        assert (assistant.last_context_report or {}).get("mode") != "summary"  # the prefetch did not report here
+        assert assistant.generate_summary(pdf_app.PREFETCH_SUMMARY_DETAIL)
+    assert loads == [pdf_id] and model_calls == []  # the pooled load and the cached summary were reused
+    pdf_app.assistant_pool.release_session(session_id)
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+
+import pytest
+
+import app as pdf_app
+from conftest import make_text_pdf
+
+
+def question(page, text="What is shown?", topic="", answer=0):
+    return {"question": text, "choices": ["A one", "B two", "C three"], "answer": answer, "page": page, "topic": topic}
+
+
+def test_parse_quiz_questions_accepts_fenced_json_and_letter_answers():
+    text = "```json\n" + json.dumps([
+        {"question": "Q1?", "choices": ["x", "y"], "answer": "B)", "page": 3, "topic": "t"},
+        {"question": "Q2?", "choices": ["alpha", "beta"], "answer": "beta", "page": 99},
+    ]) + "\n```"
+    questions = pdf_app.parse_quiz_questions(text, (2, 5))
+    assert [(q["answer"], q["page"]) for q in questions] == [(1, 3), (1, 2)]  # out-of-range page moves to the first
+
+
+def test_parse_quiz_questions_drops_invalid_items():
+    text = json.dumps({"questions": [
+        {"question": "", "choices": ["x", "y"], "answer": 0},
+        {"question": "One choice?", "choices": ["x"], "answer": 0},
+        {"question": "Bad answer?", "choices": ["x", "y"], "answer": 5},
+        "not a question",
+        {"question": "Good?", "choices": ["x", "y"], "answer": 1, "page": "4"},
+    ]})
+    assert [q["question"] for q in pdf_app.parse_quiz_questions(text, (1, 10))] == ["Good?"]
+    assert pdf_app.parse_quiz_questions("not json", (1, 1)) == []
+
+
+def test_quiz_bank_selects_by_page_range_and_topic():
+    bank = pdf_app.QuizBank([
+        question(5, "Where is the heat exchanger?", topic="heat exchanger"),
+        question(1, "What is entropy?", topic="entropy"),
+        question(3, "Define heat capacity", topic="heat"),
+    ])
+    assert [q["page"] for q in bank.questions] == [1, 3, 5]
+    assert bank.select((2, 5)) == [1, 2]
+    assert bank.select(topic="heat exchanger") == [2]
+    assert bank.select((1, 3), topic="heat") == [1]
+    assert bank.sample(4) is None
+    assert [q["page"] for q in bank.sample(3)] == [1, 3, 5]
+
+
+@pytest.fixture
+def bank_assistant(load_assistant, request):
+    # Two bank sections of QUIZ_BANK_CHUNK_PAGES pages, with text of its own so no test sees cached sections
+    return load_assistant(make_text_pdf(pdf_app.QUIZ_BANK_CHUNK_PAGES + 5, request.node.name), "bank.pdf")
+
+
+def test_quiz_bank_does_not_cache_empty_sections(bank_assistant, monkeypatch):
+    calls = []
+
+    def generate(page_range):
+        calls.append(page_range)
+        return [] if page_range[0] > 1 and len(calls) <= 2 else [question(page_range[0])]
+    monkeypatch.setattr(bank_assistant, "_generate_quiz_chunk", generate)
+
+    first = bank_assistant._quiz_bank(wait=True)
+    assert len(first) == 1  # built from the section that worked
+    second = bank_assistant._quiz_bank(wait=True)
+    assert len(second) == 2  # the empty section was retried, the good one came from the cache
+    assert sorted(calls) == [(1, 20), (21, 25), (21, 25)]
+    assert bank_assistant._quiz_bank(wait=True) is second  # complete banks are kept
+
+
+def test_quiz_bank_keeps_finished_sections_when_one_raises(bank_assistant, monkeypatch):
+    def generate(page_range):
+        if page_range[0] > 1:
+            raise RuntimeError("model failed")
+        return [question(page_range[0])]
+    monkeypatch.setattr(bank_assistant, "_generate_quiz_chunk", generate)
+    assert len(bank_assistant._quiz_bank(wait=True)) == 1
+
+
+def test_quiz_bank_raises_when_no_section_has_questions(bank_assistant, monkeypatch):
+    def generate(page_range):
+        raise RuntimeError(f"failed {page_range}")
+    monkeypatch.setattr(bank_assistant, "_generate_quiz_chunk", generate)
+    with pytest.raises(RuntimeError):
+        bank_assistant._quiz_bank(wait=True)
+
+
+def test_quiz_does_not_wait_for_the_bank(bank_assistant, monkeypatch):
+    release = threading.Event()
+
+    def generate(page_range):
+        release.wait(5)
+        return [question(page_range[0], f"Question {number}?") for number in range(5)]
+    monkeypatch.setattr(bank_assistant, "_generate_quiz_chunk", generate)
+
+    started = time.monotonic()
+    assert bank_assistant.generate_quiz(3)
+    assert time.monotonic() - started < 2
+    assert bank_assistant.last_quiz_questions is None  # generated directly, the bank is still building
+
+    release.set()
+    assert len(bank_assistant._quiz_bank(wait=True)) == 10
+    bank_assistant.generate_quiz(3)
+    assert len(bank_assistant.last_quiz_questions) == 3
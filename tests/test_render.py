@@ -0,0 +1,19 @@
+import app as pdf_app
+from conftest import make_text_pdf
+
+
+def test_render_etag_differs_per_page_without_page_hashes():
+    document = pdf_app.DocumentArtifacts("render", "render.pdf", "v" * 64, ["one", "two"])
+    etags = {pdf_app.render_etag(document.page_key(page), 1.0, "png") for page in (1, 2)}
+    assert len(etags) == 2
+    assert pdf_app.render_etag(document.page_key(1), 1.0, "png") != pdf_app.render_etag(document.page_key(1), 2.0, "png")
+
+
+def test_page_render_answers_conditional_requests(client, store_pdf, request):
+    pdf_id = store_pdf(make_text_pdf(2, request.node.name), "render.pdf")
+    first = client.get(f"/pdf/{pdf_id}/page/1?zoom=0.5")
+    assert first.status_code == 200 and first.mimetype == "image/png"
+    etag = first.headers["ETag"]
+    assert client.get(f"/pdf/{pdf_id}/page/1?zoom=0.5", headers={"If-None-Match": etag}).status_code == 304
+    other_page = client.get(f"/pdf/{pdf_id}/page/2?zoom=0.5", headers={"If-None-Match": etag})
+    assert other_page.status_code == 200 and other_page.headers["ETag"] != etag
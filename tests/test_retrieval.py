@@ -0,0 +1,36 @@
+import app as pdf_app
+
+
+def make_document(pdf_id, pages):
+    return pdf_app.DocumentArtifacts(pdf_id, f"{pdf_id}.pdf", f"version-{pdf_id}", pages)
+
+
+def test_passage_index_records_postings_per_page():
+    index = pdf_app.PassageIndex(pdf_app.document_passage_entries(["alpha beta beta", "gamma"]))
+    assert index.passages == [(1, "alpha beta beta"), (2, "gamma")]
+    assert index.postings["beta"] == [(0, 2)]
+    assert index.total_length == 4
+
+
+def test_search_ranks_the_page_with_the_rare_terms_first():
+    document = make_document("bm25", [
+        "The heat exchanger transfers thermal energy between two fluids.",
+        "General notes about the course and the exam.",
+        "Thermal resistance of the exchanger wall and fouling factors.",
+    ])
+    results = pdf_app.search_passages([document], "heat exchanger", token_budget=1000)
+    assert [page for _, _, page, _ in results][:2] == [1, 3]
+    assert results[0][0] > results[1][0] > 0
+
+
+def test_search_respects_the_token_budget():
+    document = make_document("budget", [f"keyword {'x' * 400}", f"keyword {'y' * 400}"])
+    results = pdf_app.search_passages([document], "keyword", token_budget=130)
+    assert len(results) == 1
+
+
+def test_search_without_matches_takes_the_first_passages_of_every_document():
+    first = make_document("first", ["one", "two"])
+    second = make_document("second", ["three"])
+    results = pdf_app.search_passages([first, second], "unrelated", token_budget=1000)
+    assert [(document.pdf_id, page) for _, document, page, _ in results] == [("first", 1), ("second", 1), ("first", 2)]
@@ -0,0 +1,56 @@
+import pytest
+
+import app as pdf_app
+
+PROFILES = {
+    "fast": {"model": "test-fast", "max_context_tokens": 10000},
+    "standard": {"model": "test-standard", "max_context_tokens": 100000},
+}
+ROUTES = {"chat": ("standard", 2048), "chat_short": ("fast", 512), "summary": ("standard", 8192)}
+
+
+@pytest.fixture
+def router(fake):
+    return pdf_app.ModelRouter(PROFILES, ROUTES, "standard", stats=pdf_app.ModelCallStats())
+
+
+def test_plan_routes_short_questions_to_the_fast_tier(router):
+    assert router.plan("chat", prompt_chars=40, context_tokens=1000) == (["fast"], 512, "short")
+    assert router.plan("chat", prompt_chars=4000, context_tokens=1000) == (["standard", "fast"], 2048, "mode")
+
+
+def test_plan_skips_tiers_whose_context_is_too_small(router):
+    # A short question, but with more context than the fast tier takes
+    cascade, _, reason = router.plan("chat", prompt_chars=40, context_tokens=20000)
+    assert (cascade, reason) == (["standard"], "context")
+
+
+def test_context_larger_than_every_tier_goes_to_the_largest(router):
+    assert router.plan("chat", prompt_chars=4000, context_tokens=500000) == (["standard"], 2048, "context")
+    assert router.generate(["question"], mode="summary", context_tokens=500000).text
+    assert router.last_route["tier"] == "standard"
+
+
+def test_plan_steps_down_when_the_deadline_is_too_near(router):
+    for _ in range(pdf_app.ROUTE_LATENCY_MIN_SAMPLES):
+        router.stats.record("test-standard", "generate", 5.0)
+    assert router.plan("summary")[2] == "mode"
+    with pdf_app.model_deadline(1.0):
+        assert router.plan("summary") == (["fast"], 8192, "deadline")
+
+
+def test_transient_error_falls_back_to_the_faster_tier(router, monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise pdf_app.google_exceptions.ServiceUnavailable("down")
+    monkeypatch.setattr(router.clients["standard"], "generate", unavailable)
+    response = router.generate(["question"], mode="summary")
+    assert response.text
+    assert router.last_route["tier"] == "fast" and router.last_route["reason"] == "fallback"
+
+
+def test_permanent_error_does_not_fall_back(router, monkeypatch):
+    def invalid(*args, **kwargs):
+        raise pdf_app.google_exceptions.InvalidArgument("bad request")
+    monkeypatch.setattr(router.clients["standard"], "generate", invalid)
+    with pytest.raises(pdf_app.google_exceptions.InvalidArgument):
+        router.generate(["question"], mode="summary")
@@ -0,0 +1,36 @@
+from datetime import datetime, timezone
+
+import app as pdf_app
+import benchmark
+from conftest import make_text_pdf
+
+
+def test_warm_up_prepares_the_first_load(fake, store_pdf, request, monkeypatch):
+    pdf_id = store_pdf(make_text_pdf(3, request.node.name), "warm.pdf")
+    fake.table("qa_sessions").insert({"pdf_id": pdf_id, "question": "q", "answer": "a",
+                                      "created_at": datetime.now(timezone.utc).isoformat()}).execute()
+    report = pdf_app.warm_popular_documents(limit=1)
+    assert [document["pdf_id"] for document in report["warmed"]] == [str(pdf_id)]
+
+    downloads, model_calls = [], []
+    download, generate_content = benchmark.FakeStorageBucket.download, benchmark.FakeGenerativeModel.generate_content
+    monkeypatch.setattr(benchmark.FakeStorageBucket, "download",
+                        lambda self, path: downloads.append(path) or download(self, path))
+    monkeypatch.setattr(benchmark.FakeGenerativeModel, "generate_content",
+                        lambda self, *args, **kwargs: model_calls.append(args) or generate_content(self, *args, **kwargs))
+
+    assistant = pdf_app.InteractivePDFAssistant(pdf_app.api_key)
+    assert assistant.load_pdf_from_supabase(pdf_id, "warm.pdf")
+    assert downloads == [] and model_calls == []  # file from memory, overview from the cache
+    assert assistant.chat_history[0]["parts"][0]
+
+
+def test_changed_file_is_downloaded_again(fake, store_pdf, request):
+    name = "changing.pdf"
+    pdf_id = store_pdf(make_text_pdf(2, request.node.name), name)
+    assert pdf_app.InteractivePDFAssistant(pdf_app.api_key).load_pdf_from_supabase(pdf_id, name)
+    new_bytes = make_text_pdf(4, request.node.name)
+    fake.storage.files["pdfs"][name] = new_bytes  # another size, so another storage fingerprint
+    assistant = pdf_app.InteractivePDFAssistant(pdf_app.api_key)
+    assert assistant.load_pdf_from_supabase(pdf_id, name)
+    assert assistant.pdf_raw_bytes == new_bytes and len(assistant.page_texts) == 4